@@ -1,15 +1,19 @@
 # Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
 
+import argparse
+import json
 import socket
 import sys
-import re
 import threading
+import time
+from collections import deque
 from status import (
   Status, RegistrationStatus, JoinStatus, MessageStatus, DisconnectStatus,
-  LeaveStatus, RoomUserListStatus, ListRoomStatus)
+  LeaveStatus, RoomUserListStatus, ListRoomStatus, HeartbeatStatus, PressureStatus,
+  PresenceStatus, FrameDecoder, parse_status)
 from server import RunningSignal
 from clientlib import (
-  EmptyUsernameException, ClientApiArgumentError, Client)
+  EmptyUsernameException, ClientApiArgumentError, Client, RoomCache)
 
 
 class CmdError(Exception):
@@ -20,17 +24,18 @@ class CmdError(Exception):
 
 class ClientCmd:
 
-  def __init__(self, socket):
+  def __init__(self, socket, options: set = None):
     self.cmds = { "register", "join", "send to rooms", "quit" }
     self.socket = socket
     self.client = Client(socket)
+    self.options = options  # registration options
 
   def set_username(self, username: str):
     self.client.set_username(username)
 
   def parse(self, input: str):
     if input == "register":
-      return Registration(self.client)
+      return Registration(self.client, self.options)
     elif input == "join":
       return Joining(self.client)
     elif input == "room message":
@@ -114,13 +119,14 @@ class CmdExecution:
 
 class Registration(CmdExecution):
 
-  def __init__(self, client):
+  def __init__(self, client, options: set = None):
     super().__init__(client)
+    self.options = options
 
   def execute(self):
     name = CmdExecution.input_username()
     if name != None:
-      self.client.register(name)
+      self.client.register(name, self.options)
     return name
 
 
@@ -201,7 +207,13 @@ class ListUsers(CmdExecution):
     room = CmdExecution.input_room()
     if room == None:
       return None
-    self.client.list_room_users(room)
+    users = None
+    if self.client.cache != None:
+      users = self.client.cache.room_users(room)
+    if users != None:   # answered locally, no round trip
+      RoomUserListStatus(200, "success", room, users).print()
+    else:
+      self.client.list_room_users(room)
     return room
 
 
@@ -210,23 +222,137 @@ class ListRooms(CmdExecution):
     super().__init__(client)
 
   def execute(self):
-    self.client.list_rooms()
+    rooms = None
+    if self.client.cache != None:
+      rooms = self.client.cache.room_list()
+    if rooms != None:   # answered locally, no round trip
+      ListRoomStatus(200, "success", rooms).print()
+    else:
+      self.client.list_rooms()
     return bytes
 
 
+class StatusRenderer:
+  """ Writes the statuses received by the interactive client to the
+      terminal in batches, so a slow terminal never blocks the receiving
+      thread (and through it the server's queue for this user).
+
+      The receiving thread only submits statuses. A rendering thread wakes
+      at most refresh_rate times per second, formats everything submitted
+      since, and writes it with one write while holding the app's lock.
+      When a batch is longer than max_lines, only its last max_lines lines
+      are written after a "N more messages" line. Every line also goes to
+      a scrollback ring of the last scrollback lines.
+
+      Attributes:
+        pending (list)             : statuses submitted but not rendered
+        lines (deque)              : the scrollback ring
+        changed (threading.Condition): signals new statuses or stop
+  """
+  def __init__(self, format_status, lock, refresh_rate: float = 20.0,
+               max_lines: int = 50, scrollback: int = 1000, out=None):
+    self.format_status = format_status
+    self.lock       = lock
+    self.interval   = 1 / refresh_rate if refresh_rate > 0 else 0
+    self.max_lines  = max_lines
+    self.lines      = deque(maxlen=scrollback)
+    self.out        = out
+    self.pending    = []
+    self.changed    = threading.Condition()
+    self.running    = True
+    self.thread     = threading.Thread(target=self.__rendering_thread, daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    """ Render what is still pending and end the rendering thread.
+    """
+    self.changed.acquire()
+    self.running = False
+    self.changed.notify()
+    self.changed.release()
+    self.thread.join()
+
+  def submit(self, statuses: list):
+    self.changed.acquire()
+    self.pending.extend(statuses)
+    self.changed.notify()
+    self.changed.release()
+
+  def print_scrollback(self, count: int = None):
+    lines = list(self.lines)
+    if count != None:
+      lines = lines[-count:]
+    self.__write(lines)
+
+  def __rendering_thread(self):
+    while True:
+      self.changed.acquire()
+      while len(self.pending) == 0 and self.running:
+        self.changed.wait()
+      statuses = self.pending
+      self.pending = []
+      running = self.running
+      self.changed.release()
+
+      lines = self.__format(statuses)
+      self.lines.extend(lines)
+      if len(lines) > self.max_lines:
+        skipped = len(lines) - self.max_lines
+        lines = ["... " + str(skipped) + " more messages (type 'scrollback' to see them)"] \
+          + lines[skipped:]
+      self.lock.acquire()
+      self.__write(lines)
+      self.lock.release()
+
+      if not running:
+        return
+      time.sleep(self.interval)   # bound the refresh rate; statuses keep batching
+
+  def __format(self, statuses: list):
+    lines = []
+    for status in statuses:
+      lines.extend(self.format_status(status).splitlines())
+    return lines
+
+  def __write(self, lines: list):
+    if len(lines) == 0:
+      return
+    out = self.out or sys.stdout
+    out.write('\n'.join(lines) + '\n')
+    out.flush()
+
+
+def registration_options(compress: bool, presence: bool):
+  """ Return the registration options for the flags, or None for none.
+  """
+  options = set()
+  if compress:
+    options.add('deflate')
+  if presence:
+    options.add('presence')
+  return options if len(options) != 0 else None
+
+
 class App:
 
-  def __init__(self, host, port):
+  def __init__(self, host, port, refresh_rate: float = 20.0, max_lines: int = 50,
+               scrollback: int = 1000, compress: bool = False, presence: bool = False):
     self.s    = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.host = host
     self.port = port
     self.s.connect((self.host, self.port))
-    self.cmd  = ClientCmd(self.s)
+    self.compress = compress
+    self.cmd  = ClientCmd(self.s, registration_options(compress, presence))
+    self.cmd.client.cache = RoomCache()
 
-    self.status_pattern = re.compile('\$[^\$]+\$')
+    self.decoder        = FrameDecoder()
     self.user_unset     = True
     
     self.lock = threading.Lock()
+    self.renderer = StatusRenderer(
+      self.format_status, self.lock, refresh_rate, max_lines, scrollback)
 
   def parse_cmd(self, msg: str, cmd_limits: iter):
     if len(msg) >= 8:
@@ -248,21 +374,31 @@ class App:
         return RoomUserListStatus.parse(msg)
       elif command_code == '00007':
         return ListRoomStatus.parse(msg)
+      elif command_code == '00008' or command_code == '00009':
+        return HeartbeatStatus.parse(msg)
+      elif command_code == '00011':
+        return PressureStatus.parse(msg)
+      elif command_code == '00013':
+        return PresenceStatus.parse(msg)
       else:
         return Status.parse(msg)
 
     else:
       return Status.parse(msg)
 
-  def print_status(self, status):
+  def format_status(self, status):
     if status.code in { 
-      400, 401, 402, 403, 411, 420, 450, 451, 462, 496, 497, 498, 499 
+      400, 401, 402, 403, 408, 411, 420, 421, 429, 450, 451, 462, 496, 497, 498, 499,
+      503, 507
     }:  # errors...
-      status.print()
+      return status.format()
     elif status.code in { 200 }:  # success
-      status.print()
+      return status.format()
     else:
-      print("unknown status code...")
+      return "unknown status code..."
+
+  def print_status(self, status):
+    print(self.format_status(status))
 
   def get_input_command(self):
     sys.stdout.write('>>> ')
@@ -271,17 +407,20 @@ class App:
     return msg
 
   def receive_server_status(self):
+    """ Receive once and return an iterator over the complete frames
+        received so far. Frames are split lazily, so the decoder can be
+        switched to inflate between two of them.
+    """
     data = self.s.recv(10240)
-    data = data.decode(encoding="utf-8")
-    status = self.status_pattern.findall(data)
-    return status
+    self.decoder.feed(data)
+    return iter(self.decoder)
 
   def print_prompt(self):
     print('Internet Relay Chatting Client')
     print('Copyright (c) 2020 Yiming Lin')
     print("\n\ntype in 'register' first to register a username")
     print("\nAfter registration success, the following commands are available:")
-    print("join\nroom message\nprivate message\nquit\nleave\nroom users\nrooms\n\n")
+    print("join\nroom message\nprivate message\nquit\nleave\nroom users\nrooms\nscrollback\n\n")
 
   def run(self):
     disconn = self.registeration_phrase()
@@ -306,18 +445,16 @@ class App:
           continue
         to_execute.execute()
 
-        status = self.receive_server_status()
-        parsed = []
-        for msg in status:
-          msg = msg[1:-1]
-          status = self.parse_cmd(msg, { '00001' })
-          parsed.append(status)
-        for msg in parsed:
+        for msg in self.receive_server_status():
+          msg = self.parse_cmd(msg, { '00001' })
+          self.print_status(msg)
           if msg.code == 200 and msg.command_code == '00001':
             if isinstance(to_execute, Registration):
               self.cmd.set_username(msg.username)
               self.user_unset = False
-          self.print_status(msg)
+              if self.compress:   # the rest of the stream is compressed
+                self.decoder.start_inflate()
+              break   # later frames are left to the receiving thread
         
         if not self.user_unset:
           return False
@@ -337,11 +474,13 @@ class App:
     sending = threading.Thread(target=self.__sending_thread, args=(signal,))
     receiving = threading.Thread(target=self.__receiving_thread, args=(signal,))
 
+    self.renderer.start()
     sending.start()
     receiving.start()
 
     sending.join()
     receiving.join()
+    self.renderer.stop()
       
     print("Disconnected from server successfully.")
 
@@ -356,6 +495,9 @@ class App:
         self.lock.acquire()
         msg = self.get_input_command()
         try:
+          if msg == 'scrollback':
+            self.renderer.print_scrollback()
+            continue
           to_execute = self.cmd.parse(msg)
           to_execute.execute()   
         except CmdError as e:
@@ -376,24 +518,24 @@ class App:
         if data == b'':
           break
 
-        data = data.decode(encoding="utf-8")
-        status = self.status_pattern.findall(data)
+        self.decoder.feed(data)
         parsed = []
 
-        for msg in status:
-          msg = msg[1:-1]
+        for msg in self.decoder:
           msg = self.parse_cmd(
             msg, 
-            {'00001', '00002', '00003', '00004', '00005', '00006', '00007', '00010'})
+            {'00001', '00002', '00003', '00004', '00005', '00006', '00007', '00008', '00010',
+             '00011', '00013'})
+          if isinstance(msg, HeartbeatStatus):   # answered, not shown
+            self.cmd.client.pong(msg.data)
+            continue
           parsed.append(msg)
+          self.cmd.client.cache.update(msg, self.cmd.client.username)
           if isinstance(msg, DisconnectStatus):
             if msg.username == self.cmd.client.username:
               signal.set_stop()
 
-        self.lock.acquire()
-        for status in parsed:
-          self.print_status(status)
-        self.lock.release()
+        self.renderer.submit(parsed)
       
       except ConnectionResetError as _: # server crash
         print("server disconnected. Enter a new line to quit")
@@ -402,14 +544,276 @@ class App:
         signal.set_stop()
 
 
+class ScriptedApp:
+  """ The non-interactive client. Runs the commands of a script or of a
+      JSON-lines stream through a buffered Client as fast as the socket
+      takes them, or at most rate commands per second, and writes every
+      status received to out as one JSON object per line.
+
+      A script line is a command followed by its arguments, separated by
+      spaces; names are padded to 20 characters and lists are separated
+      by commas:
+        register NAME
+        join ROOM
+        leave ROOM
+        room_message ROOM[,ROOM...] MESSAGE
+        private_message USER[,USER...] MESSAGE
+        room_users ROOM
+        rooms
+        sleep SECONDS
+        quit
+      A line starting with '{' is a JSON object with the same command and
+      named arguments, e.g.
+        {"command": "room_message", "rooms": ["a", "b"], "message": "hi"}
+      Empty lines and lines starting with '#' are ignored.
+
+      The commands after register are only issued once the registration
+      succeeded. At the end of the input the app waits wait seconds for
+      the remaining statuses and disconnects, unless the input did.
+  """
+  ARGUMENTS = {
+    'register'       : ('name',),
+    'join'           : ('room',),
+    'leave'          : ('room',),
+    'room_message'   : ('rooms', 'message'),
+    'private_message': ('users', 'message'),
+    'room_users'     : ('room',),
+    'rooms'          : (),
+    'sleep'          : ('seconds',),
+    'quit'           : (),
+  }
+
+  def __init__(self, host, port, rate: float = 0, wait: float = 1.0, out=sys.stdout,
+               compress: bool = False, presence: bool = False):
+    self.s      = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.s.connect((host, port))
+    self.client = Client(self.s, buffered=True)
+    self.compress = compress
+    self.options  = registration_options(compress, presence)
+    self.rate   = rate
+    self.wait   = wait
+    self.out    = out
+    self.lock   = threading.Lock()   # lock for out
+    self.errors = 0
+    self.registered = threading.Condition()
+    self.registration = None
+    self.closed = threading.Event()
+
+  @staticmethod
+  def parse_line(line: str):
+    """ Parse a script line or a JSON line into a dict with a 'command'
+        key and the named arguments of the command. Return None for
+        empty and comment lines.
+    """
+    line = line.strip()
+    if line == '' or line.startswith('#'):
+      return None
+    if line.startswith('{'):
+      command = json.loads(line)
+    else:
+      words = line.split(' ')
+      if words[0] not in ScriptedApp.ARGUMENTS:
+        raise CmdError("Command not found: " + words[0])
+      names = ScriptedApp.ARGUMENTS[words[0]]
+      args = ' '.join(words[1:]).split(' ', max(0, len(names) - 1)) if names else []
+      command = { 'command': words[0] }
+      for name, arg in zip(names, args):
+        command[name] = arg.split(',') if name in { 'rooms', 'users' } else arg
+    if command.get('command') not in ScriptedApp.ARGUMENTS:
+      raise CmdError("Command not found: " + str(command.get('command')))
+    for name in ScriptedApp.ARGUMENTS[command['command']]:
+      if name not in command:
+        raise CmdError("Missing argument: " + name)
+    return command
+
+  @staticmethod
+  def pad(name: str):
+    padded = CmdExecution.room_name_sanitize(name)
+    if padded == None:
+      raise CmdError("Name longer than 20 characters: " + name)
+    return padded
+
+  def run(self, lines):
+    """ Execute every line and return the exit status: 1 if the
+        registration failed or a line could not be executed, else 0.
+    """
+    receiving = threading.Thread(target=self.__receiving_thread, daemon=True)
+    receiving.start()
+    quit = False
+    next_time = time.monotonic()
+    for number, line in enumerate(lines, 1):
+      if self.closed.is_set():
+        break
+      try:
+        command = ScriptedApp.parse_line(line)
+        if command == None:
+          continue
+        if self.rate > 0 and command['command'] != 'sleep':
+          delay = next_time - time.monotonic()
+          if delay > 0:
+            self.client.flush()
+            time.sleep(delay)
+          next_time = max(next_time, time.monotonic() - 1) + 1 / self.rate
+        if not self.execute(command):
+          self.errors += 1
+          break
+        quit = command['command'] == 'quit'
+        if quit:
+          break
+      except CmdError as e:
+        self.__report(number, e.message)
+      except EmptyUsernameException as _:
+        self.__report(number, "register a username first")
+      except ClientApiArgumentError as e:
+        self.__report(number, e.msg)
+      except ValueError as e:   # bad JSON or number
+        self.__report(number, str(e))
+      except OSError as e:
+        self.__report(number, str(e))
+        break
+
+    try:
+      if not quit and not self.closed.is_set():
+        self.client.flush()
+        self.closed.wait(self.wait)
+        if self.client.username:
+          self.client.disconnect()
+      self.closed.wait(self.wait)
+    except OSError as _:
+      pass
+    self.s.close()
+    return 1 if self.errors else 0
+
+  def execute(self, command: dict):
+    """ Issue one command. Return False if the app cannot go on, i.e. the
+        registration failed.
+    """
+    name = command['command']
+    if name == 'register':
+      username = ScriptedApp.pad(command['name'])
+      self.registered.acquire()
+      self.registration = None
+      self.client.register(username, self.options)
+      while self.registration == None and not self.closed.is_set():
+        self.registered.wait(0.1)
+      status = self.registration
+      self.registered.release()
+      if status == None or status.code != 200:
+        print("registration failed", file=sys.stderr)
+        return False
+      self.client.set_username(username)
+    elif name == 'join':
+      self.client.join(ScriptedApp.pad(command['room']))
+    elif name == 'leave':
+      self.client.leave(ScriptedApp.pad(command['room']))
+    elif name == 'room_message':
+      self.client.room_message(
+        [ScriptedApp.pad(room) for room in command['rooms']], command['message'])
+    elif name == 'private_message':
+      self.client.private_message(
+        [ScriptedApp.pad(user) for user in command['users']], command['message'])
+    elif name == 'room_users':
+      self.client.list_room_users(ScriptedApp.pad(command['room']))
+    elif name == 'rooms':
+      self.client.list_rooms()
+    elif name == 'sleep':
+      self.client.flush()
+      time.sleep(float(command['seconds']))
+    elif name == 'quit':
+      self.client.disconnect()
+    return True
+
+  def __report(self, number: int, message: str):
+    print("line " + str(number) + ": " + message, file=sys.stderr)
+    self.errors += 1
+
+  @staticmethod
+  def status_to_json(status: Status):
+    fields = { 'type': type(status).__name__ }
+    fields.update(vars(status))
+    return json.dumps(fields, default=sorted)   # sets become sorted lists
+
+  def __receiving_thread(self):
+    decoder = FrameDecoder()
+    while True:
+      try:
+        data = self.s.recv(65536)
+      except OSError as _:
+        data = b''
+      if data == b'':
+        break
+      decoder.feed(data)
+      lines = []
+      for frame in decoder:
+        status = parse_status(frame)
+        if isinstance(status, HeartbeatStatus) and status.command_code == HeartbeatStatus.PING:
+          self.client.pong(status.data)
+        lines.append(ScriptedApp.status_to_json(status))
+        if self.client.username == None:   # only registration is answered yet
+          if self.compress and isinstance(status, RegistrationStatus) and status.code == 200:
+            decoder.start_inflate()
+          self.registered.acquire()
+          self.registration = status
+          self.registered.notify()
+          self.registered.release()
+      self.lock.acquire()
+      self.out.write('\n'.join(lines) + '\n')
+      self.out.flush()
+      self.lock.release()
+    self.client.set_disconnected()
+    self.closed.set()
+
+
 def main():
-  if len(sys.argv) < 3:
-    print("USAGE: echo_client_sockets.py <HOST> <PORT>") 
-    sys.exit(0)
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    'host', type=str, help="host")
+
+  parser.add_argument(
+    'port', type=int, help="port")
+
+  parser.add_argument(
+    '--script', type=str,
+    help="run the commands of this script or JSON-lines file, '-' for stdin, "
+         "and print the statuses as JSON lines instead of the interactive client")
+
+  parser.add_argument(
+    '--rate', type=float, help="commands per second in script mode, 0 for no limit", default=0)
+
+  parser.add_argument(
+    '--compress', action='store_true', help="ask the server to compress what it sends")
+
+  parser.add_argument(
+    '--presence', action='store_true',
+    help="get the membership changes of rooms as one digest per room and tick")
+
+  parser.add_argument(
+    '--refresh-rate', type=float, help="terminal refreshes per second, 0 for no limit",
+    default=20.0)
+
+  parser.add_argument(
+    '--max-lines', type=int, help="lines written per refresh before collapsing", default=50)
+
+  parser.add_argument(
+    '--scrollback', type=int, help="lines kept for the scrollback command", default=1000)
+
+  parser.add_argument(
+    '--wait', type=float, help="seconds to wait for statuses at the end of the script",
+    default=1.0)
+
+  args = parser.parse_args()
+
+  if args.script:
+    app = ScriptedApp(args.host, args.port, args.rate, args.wait, compress=args.compress,
+                      presence=args.presence)
+    if args.script == '-':
+      sys.exit(app.run(sys.stdin))
+    with open(args.script) as lines:
+      sys.exit(app.run(lines))
 
-  host = sys.argv[1]
-  port = int(sys.argv[2])
-  app = App(host, port)
+  app = App(args.host, args.port, args.refresh_rate, args.max_lines, args.scrollback,
+            args.compress, args.presence)
   app.run()
 
 
@@ -0,0 +1,214 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# Microbenchmarks for the wire codec: Status.to_bytes and parse of every
+# Status subclass, App.parse_cmd, and the constructors of the Msg subclasses
+# that parse client commands on the server.
+#
+# Payloads follow what the protocol allows: 1 to 99 rooms per room message,
+# short and 8 KB messages, and large user lists in RoomUserListStatus.
+#
+# For every case the program reports operations per second (best of several
+# repeats) and the memory allocated by a single call, as traced by
+# tracemalloc. Results can be saved as JSON and a later run can be compared
+# with a saved baseline; cases that got slower than the threshold are flagged
+# and make the program exit with status 1.
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from status import (
+  Status, RegistrationStatus, JoinStatus, MessageStatus, DisconnectStatus,
+  LeaveStatus, RoomUserListStatus, ListRoomStatus)
+from message import (
+  CommandFactory, RegistrationCommand, JoinCommand, UserMessageToRooms,
+  UserMessageToUsers, UserDisconnect, LeaveRoom, ListJoinedUsers)
+from app import App, CmdExecution
+
+
+ALL_COMMANDS = {'00001', '00002', '00003', '00004', '00005', '00006', '00007', '00010'}
+
+
+def name(prefix: str, i: int):
+  return CmdExecution.room_name_sanitize(prefix + str(i))
+
+
+def build_cases():
+  """ Return a list of (case name, zero-argument callable).
+  """
+  short = 'hello everyone in this room'
+  long  = 'x' * 8192
+  user  = name('user-', 0)
+  room  = name('room-', 0)
+  cases = []
+
+  statuses = [
+    ('Status', Status(400, "Bad command")),
+    ('RegistrationStatus', RegistrationStatus(200, "success", user)),
+    ('JoinStatus', JoinStatus(200, "success", room, user, True)),
+    ('MessageStatus/room/short', MessageStatus(200, 'success', True, user, room, '', short)),
+    ('MessageStatus/room/8KB', MessageStatus(200, 'success', True, user, room, '', long)),
+    ('MessageStatus/private/short', MessageStatus(200, 'success', False, user, '', user, short)),
+    ('MessageStatus/private/8KB', MessageStatus(200, 'success', False, user, '', user, long)),
+    ('DisconnectStatus', DisconnectStatus(200, "success", user, room=room)),
+    ('LeaveStatus', LeaveStatus(200, "success", room, user)),
+  ]
+  for n in (10, 1000, 10000):
+    users = { name('user-', i) for i in range(n) }
+    statuses.append(('RoomUserListStatus/' + str(n), RoomUserListStatus(200, "success", room, users)))
+  for n in (1, 99, 1000):
+    rooms = { name('room-', i) for i in range(n) }
+    statuses.append(('ListRoomStatus/' + str(n), ListRoomStatus(200, "success", rooms)))
+
+  for label, status in statuses:
+    cases.append(('to_bytes/' + label, status.to_bytes))
+    frame = status.to_bytes().decode(encoding="utf-8")[1:-1]
+    cls = type(status)
+    cases.append(('parse/' + label, lambda cls=cls, frame=frame: cls.parse(frame)))
+    cases.append(('parse_cmd/' + label,
+                  lambda frame=frame: App.parse_cmd(None, frame, ALL_COMMANDS)))
+
+  factory = CommandFactory()
+  commands = [
+    ('RegistrationCommand', RegistrationCommand, '00001' + user),
+    ('JoinCommand', JoinCommand, '00002' + room + user),
+    ('UserDisconnect', UserDisconnect, '00010' + user),
+    ('LeaveRoom', LeaveRoom, '00005' + room + user),
+    ('ListJoinedUsers', ListJoinedUsers, '00006' + room),
+  ]
+  for n in (1, 10, 99):
+    rooms = ''.join(name('room-', i) for i in range(n))
+    for label, data in (('short', short), ('8KB', long)):
+      commands.append(('UserMessageToRooms/' + str(n) + '/' + label, UserMessageToRooms,
+                       '00003' + '%02d' % n + rooms + data))
+  for n in (1, 99):
+    users = '&'.join(name('user-', i) for i in range(n))
+    for label, data in (('short', short), ('8KB', long)):
+      commands.append(('UserMessageToUsers/' + str(n) + '/' + label, UserMessageToUsers,
+                       '00004' + '%02d' % n + users + '#' + data))
+
+  for label, cls, frame in commands:
+    cases.append(('construct/' + label, lambda cls=cls, frame=frame: cls(frame, None)))
+    cases.append(('produce/' + label,
+                  lambda frame=frame: factory.produce(frame, None)))
+  return cases
+
+
+def measure_speed(func, min_time: float, repeat: int):
+  """ Return the best operations per second over several repeats. The
+      number of calls per repeat is calibrated to take about min_time.
+  """
+  loops = 1
+  while True:
+    start = time.perf_counter()
+    for _ in range(loops):
+      func()
+    elapsed = time.perf_counter() - start
+    if elapsed >= min_time:
+      break
+    loops *= 10 if elapsed < min_time / 10 else 2
+  best = elapsed
+  for _ in range(repeat - 1):
+    start = time.perf_counter()
+    for _ in range(loops):
+      func()
+    best = min(best, time.perf_counter() - start)
+  return loops / best
+
+
+def measure_allocations(func, calls: int = 100):
+  """ Return (peak bytes allocated during one call, blocks retained per call).
+  """
+  func()    # warm up caches such as compiled regex and interned strings
+  tracemalloc.start()
+  try:
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    peak_bytes = peak - before
+
+    snapshot_before = tracemalloc.take_snapshot()
+    kept = [func() for _ in range(calls)]
+    snapshot_after = tracemalloc.take_snapshot()
+    blocks = sum(stat.count_diff for stat in
+                 snapshot_after.compare_to(snapshot_before, 'filename'))
+    del kept
+  finally:
+    tracemalloc.stop()
+  return peak_bytes, max(0, blocks) / calls
+
+
+def run(cases, min_time: float, repeat: int, pattern: str):
+  results = {}
+  for label, func in cases:
+    if pattern and pattern not in label:
+      continue
+    ops = measure_speed(func, min_time, repeat)
+    peak_bytes, blocks = measure_allocations(func)
+    results[label] = { 'ops_per_sec': ops, 'alloc_bytes': peak_bytes, 'alloc_blocks': blocks }
+    print("%-48s %14.0f ops/s %10d B/call %8.1f blocks/call" % (label, ops, peak_bytes, blocks))
+  return results
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+  """ Print the change against baseline for every case both runs have and
+      return the list of cases slower than threshold (a fraction).
+  """
+  regressions = []
+  print("\ncomparison with baseline (threshold %.0f%%):" % (threshold * 100))
+  for label in results:
+    if label not in baseline:
+      continue
+    old = baseline[label]['ops_per_sec']
+    new = results[label]['ops_per_sec']
+    change = (new - old) / old
+    flag = ''
+    if change < -threshold:
+      flag = '  REGRESSION'
+      regressions.append(label)
+    print("%-48s %+7.1f%%%s" % (label, change * 100, flag))
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    '-o', '--output', type=str, help="write results to this JSON file")
+
+  parser.add_argument(
+    '-b', '--baseline', type=str, help="compare against results in this JSON file")
+
+  parser.add_argument(
+    '-t', '--threshold', type=float, help="slowdown in percent flagged as regression", default=10.0)
+
+  parser.add_argument(
+    '-k', '--filter', type=str, help="only run cases whose name contains this string", default='')
+
+  parser.add_argument(
+    '--min-time', type=float, help="minimum seconds per repeat", default=0.2)
+
+  parser.add_argument(
+    '--repeat', type=int, help="number of repeats, the best one is reported", default=5)
+
+  args = parser.parse_args()
+
+  results = run(build_cases(), args.min_time, args.repeat, args.filter)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({ 'python': sys.version, 'results': results }, f, indent=2, sort_keys=True)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold / 100)
+    if len(regressions) != 0:
+      print("\n" + str(len(regressions)) + " regression(s) found")
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
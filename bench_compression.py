@@ -0,0 +1,136 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# Measures what the 'deflate' registration option saves: the status stream a
+# client in busy rooms receives is compressed the way the server's sending
+# thread does it (one FrameCompressor per connection, one sync flush per
+# batch taken from the queue) and decompressed with FrameDecoder.
+#
+# The stream mixes room messages from a set of senders over a few rooms,
+# private messages, and joins and leaves, with message text drawn from a
+# small vocabulary. For every zlib level and batch size the program reports
+# the bytes saved, the CPU time spent per frame on both ends, and the memory
+# one connection's compressor holds.
+
+import argparse
+import random
+import time
+import tracemalloc
+from status import (
+  FrameCompressor, FrameDecoder, JoinStatus, MessageStatus, LeaveStatus)
+from app import CmdExecution
+
+
+WORDS = ('the', 'a', 'room', 'message', 'hello', 'server', 'thanks', 'see', 'you',
+         'later', 'is', 'anyone', 'here', 'lunch', 'build', 'failed', 'again', 'ok')
+
+
+def build_stream(frames: int, senders: int, rooms: int, seed: int):
+  """ Return the encoded statuses one client receives, in order.
+  """
+  rng = random.Random(seed)
+  users = [CmdExecution.room_name_sanitize('user-' + str(i)) for i in range(senders)]
+  room_names = [CmdExecution.room_name_sanitize('room-' + str(i)) for i in range(rooms)]
+  stream = []
+  for _ in range(frames):
+    user = rng.choice(users)
+    room = rng.choice(room_names)
+    kind = rng.random()
+    if kind < 0.85:
+      text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+      status = MessageStatus(200, 'success', True, user, room, '', text)
+    elif kind < 0.93:
+      text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+      status = MessageStatus(200, 'success', False, user, '', users[0], text)
+    elif kind < 0.97:
+      status = JoinStatus(200, 'success', room, user)
+    else:
+      status = LeaveStatus(200, 'success', room, user)
+    stream.append(status.to_bytes())
+  return stream
+
+
+def batches(stream: list, size: int):
+  return [b''.join(stream[i:i + size]) for i in range(0, len(stream), size)]
+
+
+def measure(stream: list, level: int, batch_size: int):
+  data = batches(stream, batch_size)
+
+  compressor = FrameCompressor(level)
+  start = time.process_time()
+  compressed = [compressor.compress(batch) for batch in data]
+  compress_time = time.process_time() - start
+
+  decoder = FrameDecoder()
+  decoder.start_inflate()
+  received = 0
+  start = time.process_time()
+  for chunk in compressed:
+    decoder.feed(chunk)
+    for _ in decoder:
+      received += 1
+  decompress_time = time.process_time() - start
+  assert received == len(stream), "decoded %d of %d frames" % (received, len(stream))
+
+  return {
+    'raw'        : sum(len(batch) for batch in data),
+    'compressed' : sum(len(chunk) for chunk in compressed),
+    'compress'   : compress_time / len(stream),
+    'decompress' : decompress_time / len(stream),
+  }
+
+
+def compressor_memory(stream: list, level: int):
+  """ Bytes allocated by one connection's compressor after it sent a batch.
+  """
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  compressor = FrameCompressor(level)
+  compressor.compress(b''.join(stream[:16]))
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return after - before
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    '-n', '--frames', type=int, help="statuses in the stream", default=50000)
+
+  parser.add_argument(
+    '--senders', type=int, help="distinct senders", default=50)
+
+  parser.add_argument(
+    '--rooms', type=int, help="distinct rooms", default=5)
+
+  parser.add_argument(
+    '-l', '--level', type=int, action='append', help="zlib level (repeatable)")
+
+  parser.add_argument(
+    '-b', '--batch', type=int, action='append', help="frames per sync flush (repeatable)")
+
+  parser.add_argument(
+    '--seed', type=int, help="random seed", default=1)
+
+  args = parser.parse_args()
+  levels = args.level or [1, 6, 9]
+  sizes  = args.batch or [1, 8, 64]
+
+  stream = build_stream(args.frames, args.senders, args.rooms, args.seed)
+  raw_size = sum(len(frame) for frame in stream)
+  print("%d frames, %.1f bytes per frame uncompressed" % (len(stream), raw_size / len(stream)))
+  print("%5s %6s %10s %8s %14s %16s %12s" % (
+    'level', 'batch', 'bytes', 'saved', 'compress us/f', 'decompress us/f', 'memory KB'))
+  for level in levels:
+    memory = compressor_memory(stream, level)
+    for size in sizes:
+      result = measure(stream, level, size)
+      saved = 1 - result['compressed'] / result['raw']
+      print("%5d %6d %10d %7.1f%% %14.2f %16.2f %12.1f" % (
+        level, size, result['compressed'], saved * 100,
+        result['compress'] * 1e6, result['decompress'] * 1e6, memory / 1024))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,201 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# A multithreaded stress benchmark for Table, the concurrent data structure
+# every client thread of the server shares.
+#
+# Each worker thread owns a disjoint set of registered users and, until the
+# time is up, picks operations at random: with the given read ratio it lists
+# the users of a room, otherwise it performs a write (join_room, leave_room,
+# enqueue_message to a room, or user_disconnection followed by a new
+# registration). Rooms are shared by all threads, so writers contend with
+# each other and with the readers on Table.lock.
+#
+# Table.lock is replaced by a TimedLock that records how long each acquire
+# waited. The run is repeated for every thread count, giving throughput and
+# lock wait time versus thread count.
+#
+# With --table sharded the same run drives a ShardedTable instead, whose
+# shard locks are all TimedLocks; the waits and acquisitions of all its
+# locks are added up.
+
+import argparse
+import random
+import threading
+import time
+from serverlib import Table, ShardedTable
+from status import Status
+from app import CmdExecution
+
+
+class TimedLock:
+  """ A drop-in for threading.Lock that accumulates the time spent waiting
+      in acquire() and the number of acquisitions.
+  """
+  def __init__(self):
+    self.lock  = threading.Lock()
+    self.wait  = 0.0
+    self.count = 0
+
+  def acquire(self, blocking=True, timeout=-1):
+    start = time.perf_counter()
+    acquired = self.lock.acquire(blocking, timeout)
+    if acquired:
+      # updated while holding the lock, so no extra synchronization needed
+      self.wait  += time.perf_counter() - start
+      self.count += 1
+    return acquired
+
+  def release(self):
+    self.lock.release()
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+
+class Worker(threading.Thread):
+  """ A thread that drives Table operations on behalf of its own users.
+  """
+  def __init__(self, table: Table, users: list, rooms: list, read_ratio: float,
+               deadline: float, seed: int):
+    super().__init__()
+    self.table      = table
+    self.users      = users
+    self.rooms      = rooms
+    self.read_ratio = read_ratio
+    self.deadline   = deadline
+    self.rng        = random.Random(seed)
+    self.joined     = { username: set() for username, _ in users }
+    self.ops        = { 'read': 0, 'join': 0, 'leave': 0, 'enqueue': 0, 'disconnect': 0 }
+
+  def run(self):
+    writes = ['join', 'leave', 'enqueue', 'disconnect']
+    weights = [4, 3, 4, 1]
+    done = 0
+    while time.perf_counter() < self.deadline:
+      username, addr = self.rng.choice(self.users)
+      room = self.rng.choice(self.rooms)
+      if self.rng.random() < self.read_ratio:
+        self.table.list_room_users(room)
+        op = 'read'
+      else:
+        op = self.rng.choices(writes, weights)[0]
+        if op == 'join':
+          self.table.join_room(room, username)
+          self.joined[username].add(room)
+        elif op == 'leave':
+          self.table.leave_room(room, username)
+          self.joined[username].discard(room)
+        elif op == 'enqueue':
+          receivers = self.table.list_room_users(room)
+          self.table.enqueue_message(Status(200, "stress"), receivers)
+        else:
+          self.table.user_disconnection(username)
+          self.table.clear_user_conn(addr)
+          self.table.user_registration(username, None, addr)
+          self.joined[username] = set()
+      self.ops[op] += 1
+      done += 1
+      if done % 100 == 0:
+        self.drain()
+
+  def drain(self):
+    """ Empty the queues of this worker's users, standing in for their
+        sending threads.
+    """
+    for username, _ in self.users:
+      self.table.trim_queue(username, 0)
+
+
+def build_table(num_users: int, num_rooms: int, kind: str, shards: int):
+  if kind == 'sharded':
+    table = ShardedTable(TimedLock(), shards=shards, new_lock=TimedLock)
+  else:
+    table = Table(TimedLock())
+  users = []
+  for i in range(num_users):
+    username = CmdExecution.room_name_sanitize('bench-user-' + str(i))
+    addr = ('bench', i)
+    table.user_registration(username, None, addr)
+    users.append((username, addr))
+  rooms = [CmdExecution.room_name_sanitize('bench-room-' + str(i)) for i in range(num_rooms)]
+  for i, room in enumerate(rooms):
+    table.join_room(room, users[i % num_users][0])
+  return table, users, rooms
+
+
+def run(threads: int, args):
+  table, users, rooms = build_table(args.users, args.rooms, args.table, args.shards)
+  locks = getattr(table, 'locks', [table.lock])
+  for lock in locks:
+    lock.wait  = 0.0
+    lock.count = 0
+  start = time.perf_counter()
+  deadline = start + args.duration
+  workers = [
+    Worker(table, users[i::threads], rooms, args.read_ratio, deadline, args.seed + i)
+    for i in range(threads)
+  ]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  elapsed = time.perf_counter() - start
+  ops = {}
+  for worker in workers:
+    for op in worker.ops:
+      ops[op] = ops.get(op, 0) + worker.ops[op]
+  return (ops, elapsed, sum(lock.wait for lock in locks),
+          sum(lock.count for lock in locks))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    '-t', '--threads', type=str, help="comma separated thread counts", default='1,2,4,8,16')
+
+  parser.add_argument(
+    '-r', '--read-ratio', type=float, help="fraction of operations that only read", default=0.5)
+
+  parser.add_argument(
+    '-u', '--users', type=int, help="registered users, split among threads", default=256)
+
+  parser.add_argument(
+    '--rooms', type=int, help="number of shared rooms", default=16)
+
+  parser.add_argument(
+    '-d', '--duration', type=float, help="seconds per thread count", default=3.0)
+
+  parser.add_argument(
+    '--table', choices=('table', 'sharded'), help="Table or ShardedTable", default='table')
+
+  parser.add_argument(
+    '--shards', type=int, help="shards of a ShardedTable", default=16)
+
+  parser.add_argument(
+    '--seed', type=int, help="random seed", default=1)
+
+  args = parser.parse_args()
+  thread_counts = [int(t) for t in args.threads.split(',')]
+
+  print("%8s %12s %14s %14s %10s" % ('threads', 'ops/s', 'lock acquires', 'wait us/acq', 'wait %'))
+  for threads in thread_counts:
+    if threads > args.users:
+      print("skipping", threads, "threads: fewer users than threads")
+      continue
+    ops, elapsed, wait, count = run(threads, args)
+    total = sum(ops.values())
+    per_acquire = wait / count * 1e6 if count else 0.0
+    # share of the threads' combined time spent blocked on the table's locks
+    waiting = wait / (elapsed * threads) * 100
+    print("%8d %12.0f %14d %14.2f %9.1f%%" % (
+      threads, total / elapsed, count, per_acquire, waiting))
+    print("         " + ', '.join(op + ' ' + str(ops[op]) for op in ops))
+
+
+if __name__ == '__main__':
+  main()
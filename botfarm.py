@@ -0,0 +1,280 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# A client-side session manager that hosts many bot identities in one
+# process and one thread.
+#
+# Every session is a Client whose socket is non-blocking and registered with
+# a single selector. Commands issued through a session's Client are appended
+# to that session's output buffer and written when the socket is writable,
+# so a slow connection never blocks the others. All sessions receive into
+# one shared buffer; only the tail of a frame split across reads is kept per
+# session. Every status received by any session is parsed and handed to a
+# single callback together with the session it arrived on; PING statuses
+# are answered by the farm itself.
+#
+# Run as a program, it connects the given number of bots, joins them to the
+# given rooms and reports how many statuses they receive.
+
+import argparse
+import errno
+import heapq
+import itertools
+import selectors
+import socket
+import time
+from status import FrameDecoder, Status, RegistrationStatus, HeartbeatStatus, parse_status
+from clientlib import Client
+from app import CmdExecution
+
+
+class SessionSocket:
+  """ Stands in for the socket of a Client: data sent is appended to the
+      session's output buffer and written by the farm's event loop.
+  """
+  def __init__(self, session):
+    self.session = session
+
+  def send(self, data: bytes):
+    self.session.write(data)
+    return len(data)
+
+  def sendall(self, data: bytes):
+    self.session.write(data)
+
+
+class BotSession:
+  """ One bot identity hosted by a BotFarm.
+
+      Attributes:
+        farm (BotFarm)        : the farm running this session
+        sock (socket)         : the non-blocking connection
+        client (Client)       : issues commands for this identity
+        decoder (FrameDecoder): holds a partial frame between reads
+        outbuf (bytearray)    : bytes waiting for the socket to be writable
+        connected (bool)      : True once the non-blocking connect finished
+        closed (bool)         : True once the connection has been closed
+        data                  : free slot for the application's own state
+  """
+  def __init__(self, farm, sock):
+    self.farm      = farm
+    self.sock      = sock
+    self.client    = Client(SessionSocket(self))
+    self.decoder   = FrameDecoder()
+    self.outbuf    = bytearray()
+    self.connected = False
+    self.closed    = False
+    self.data      = None
+
+  @property
+  def username(self):
+    return self.client.username
+
+  def write(self, data: bytes):
+    if self.closed:
+      return
+    self.outbuf += data
+    self.farm.update_interest(self)
+
+  def close(self):
+    self.farm.close_session(self)
+
+
+class BotFarm:
+  """ Runs many BotSession objects on one selector.
+
+      Attributes:
+        on_status (callable): called as on_status(session, status) for every
+                              status received by any session
+        on_close (callable) : called as on_close(session) when a session's
+                              connection ends, or None
+        selector            : the selector every session is registered with
+        buffer (bytearray)  : receive buffer shared by all sessions
+        sessions (set)      : sessions that are not closed
+  """
+  def __init__(self, on_status, on_close=None, buffer_size: int = 65536):
+    self.on_status = on_status
+    self.on_close  = on_close
+    self.selector  = selectors.DefaultSelector()
+    self.buffer    = bytearray(buffer_size)
+    self.view      = memoryview(self.buffer)
+    self.sessions  = set()
+    self.timers    = []
+    self.timer_seq = itertools.count()
+    self.running   = False
+
+  def connect(self, host: str, port: int, username: str = None):
+    """ Start a non-blocking connection and return its session. Commands can
+        be issued right away; they are sent once the connection is up. If a
+        username is given it is registered on the new session.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    err = sock.connect_ex((host, port))
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      sock.close()
+      raise ConnectionError(err, "cannot connect to " + host + ":" + str(port))
+    session = BotSession(self, sock)
+    self.sessions.add(session)
+    self.selector.register(sock, selectors.EVENT_WRITE, session)
+    if username != None:
+      session.client.register(username)
+    return session
+
+  def call_later(self, delay: float, func):
+    """ Run func() on the event loop after delay seconds.
+    """
+    heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_seq), func))
+
+  def update_interest(self, session: BotSession):
+    if session.closed or not session.connected:
+      return
+    events = selectors.EVENT_READ
+    if len(session.outbuf) != 0:
+      events |= selectors.EVENT_WRITE
+    self.selector.modify(session.sock, events, session)
+
+  def close_session(self, session: BotSession):
+    if session.closed:
+      return
+    session.closed = True
+    self.sessions.discard(session)
+    self.selector.unregister(session.sock)
+    session.sock.close()
+    session.client.set_disconnected()
+    if self.on_close != None:
+      self.on_close(session)
+
+  def run(self, duration: float = None):
+    """ Run the event loop until stop() is called, every session is
+        closed, or duration seconds passed.
+    """
+    self.running = True
+    deadline = None if duration == None else time.monotonic() + duration
+    while self.running and (len(self.sessions) != 0 or len(self.timers) != 0):
+      now = time.monotonic()
+      if deadline != None and now >= deadline:
+        break
+      self.run_once(self.__next_timeout(now, deadline))
+
+  def stop(self):
+    self.running = False
+
+  def run_once(self, timeout: float = None):
+    for key, events in self.selector.select(timeout):
+      session = key.data
+      if events & selectors.EVENT_WRITE and not session.closed:
+        self.__on_writable(session)
+      if events & selectors.EVENT_READ and not session.closed:
+        self.__on_readable(session)
+    now = time.monotonic()
+    while len(self.timers) != 0 and self.timers[0][0] <= now:
+      _, _, func = heapq.heappop(self.timers)
+      func()
+
+  def __next_timeout(self, now: float, deadline: float):
+    timeouts = []
+    if len(self.timers) != 0:
+      timeouts.append(self.timers[0][0] - now)
+    if deadline != None:
+      timeouts.append(deadline - now)
+    return max(0, min(timeouts)) if len(timeouts) != 0 else None
+
+  def __on_writable(self, session: BotSession):
+    if not session.connected:
+      err = session.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if err != 0:
+        self.close_session(session)
+        return
+      session.connected = True
+    try:
+      if len(session.outbuf) != 0:
+        sent = session.sock.send(session.outbuf)
+        del session.outbuf[:sent]
+    except BlockingIOError as _:
+      pass
+    except ConnectionError as _:
+      self.close_session(session)
+      return
+    self.update_interest(session)
+
+  def __on_readable(self, session: BotSession):
+    try:
+      size = session.sock.recv_into(self.buffer)
+    except BlockingIOError as _:
+      return
+    except ConnectionError as _:
+      size = 0
+    if size == 0:
+      self.close_session(session)
+      return
+    session.decoder.feed(self.view[:size])
+    for frame in session.decoder:
+      status = parse_status(frame)
+      if isinstance(status, HeartbeatStatus) and status.command_code == HeartbeatStatus.PING:
+        session.client.pong(status.data)
+        continue
+      if (isinstance(status, RegistrationStatus) and status.code == 200
+          and session.client.username == None):
+        session.client.set_username(status.username)
+      self.on_status(session, status)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    '-n', '--bots', type=int, help="number of bot identities", default=100)
+
+  parser.add_argument(
+    '-r', '--room', type=str, action='append', help="room every bot joins", default=[])
+
+  parser.add_argument(
+    '-d', '--duration', type=float, help="seconds to run", default=30.0)
+
+  parser.add_argument(
+    '--connect-rate', type=float, help="new connections per second", default=100.0)
+
+  parser.add_argument(
+    '--prefix', type=str, help="username prefix", default='bot-')
+
+  parser.add_argument(
+    '--host', type=str, help="host", default='localhost')
+
+  parser.add_argument(
+    '--port', type=int, help="port", default=8000)
+
+  args = parser.parse_args()
+  rooms = [CmdExecution.room_name_sanitize(room) for room in args.room]
+  counts = { 'registered': 0, 'statuses': 0, 'errors': 0 }
+
+  def on_status(session, status: Status):
+    counts['statuses'] += 1
+    if status.code != 200:
+      counts['errors'] += 1
+    elif isinstance(status, RegistrationStatus) and status.username == session.username:
+      counts['registered'] += 1
+      for room in rooms:
+        session.client.join(room)
+
+  farm = BotFarm(on_status)
+  for i in range(args.bots):
+    username = CmdExecution.room_name_sanitize(args.prefix + str(i))
+    farm.call_later(i / args.connect_rate,
+                    lambda username=username: farm.connect(args.host, args.port, username))
+
+  def report():
+    print("sessions %d registered %d statuses %d errors %d" % (
+      len(farm.sessions), counts['registered'], counts['statuses'], counts['errors']))
+    farm.call_later(5, report)
+  farm.call_later(5, report)
+  farm.run(args.duration)
+
+  for session in list(farm.sessions):
+    if session.username != None:
+      session.client.disconnect()
+  farm.run(1)
+  report()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,303 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# An in-process capacity simulator. It builds a Table, populates it with
+# synthetic users and rooms, and replays a command mix through
+# CommandFactory and Msg.execute using fake connections, so the cost that is
+# measured is the pure CPU cost of each command: no sockets and no threads.
+#
+# Room popularity follows a Zipf distribution: every user joins a fixed
+# number of rooms chosen with weight 1/rank^s, so a few rooms hold most of
+# the users. The population grows in stages, and after each stage the same
+# command mix is replayed. Statuses queued for the receivers are serialized
+# into the fake connections after every command, as the sending thread of
+# the server would do, and that work is counted in the command's cost.
+#
+# The report shows, for every opcode and population, the mean and p99 cost
+# of one command, and the memory held by the server state. With --budget-us
+# it also prints the first population where each opcode exceeded the budget.
+
+import argparse
+import bisect
+import random
+import resource
+import time
+import threading
+import tracemalloc
+from serverlib import Table
+from message import CommandFactory
+from app import CmdExecution
+
+
+OPCODES = {
+  'join'       : '00002',
+  'room msg'   : '00003',
+  'user msg'   : '00004',
+  'leave'      : '00005',
+  'room users' : '00006',
+  'rooms'      : '00007',
+  'disconn'    : '00010',
+}
+
+DEFAULT_MIX = 'join=10,room msg=50,user msg=20,leave=5,room users=5,rooms=5,disconn=5'
+
+
+class FakeConnection:
+  """ Stands in for a client socket; counts the bytes the server sends.
+  """
+  def __init__(self):
+    self.bytes_sent = 0
+
+  def send(self, data: bytes):
+    self.bytes_sent += len(data)
+    return len(data)
+
+
+class SimTable(Table):
+  """ Table that remembers which users received a status since the last
+      drain, so the simulator can flush only those queues.
+  """
+  def __init__(self, lock):
+    super().__init__(lock)
+    self.dirty = set()
+
+  def enqueue_message(self, message, receivers):
+    super().enqueue_message(message, receivers)
+    self.dirty.update(receivers)
+
+  def drain(self):
+    """ Serialize every queued status into its user's fake connection,
+        as the sending thread of the server does.
+    """
+    for username in self.dirty:
+      if username in self.users:
+        user = self.users[username]
+        if len(user.msg_queue) != 0:
+          for msg in user.get_messages():
+            user.conn.send(msg.to_bytes())
+    self.dirty = set()
+
+
+class Simulator:
+  """ Grows a synthetic population inside a SimTable and replays commands.
+
+      Attributes:
+        table (SimTable)     : the server state under test
+        factory              : CommandFactory producing Msg objects
+        rng (random.Random)  : source of all randomness, seeded
+        rooms (list)         : padded names of the rooms, by popularity rank
+        members (dict)       : mapping username to the set of joined rooms
+        addrs (dict)         : mapping username to its fake address
+  """
+  def __init__(self, rooms_per_user: float, joins: int, zipf: float, seed):
+    self.table   = SimTable(threading.Lock())
+    self.factory = CommandFactory()
+    self.rng     = random.Random(seed)
+    self.rooms_per_user = rooms_per_user
+    self.joins   = joins
+    self.zipf    = zipf
+    self.rooms   = []
+    self.cum_weights = []
+    self.members = {}
+    self.addrs   = {}
+    self.conns   = {}
+    self.next_id = 0
+
+  @staticmethod
+  def pad(name: str):
+    return CmdExecution.room_name_sanitize(name)
+
+  def execute(self, frame: str, username: str):
+    cmd = self.factory.produce(frame, self.table)
+    cmd.execute(self.conns[username], self.addrs[username])
+    self.table.drain()
+
+  def register(self, username: str):
+    self.addrs[username] = ('sim', self.next_id)
+    self.conns[username] = FakeConnection()
+    self.next_id += 1
+    self.members[username] = set()
+    self.execute('00001' + username, username)
+
+  def grow_rooms(self, population: int):
+    target = max(1, int(population * self.rooms_per_user))
+    while len(self.rooms) < target:
+      self.rooms.append(self.pad('sim-room-' + str(len(self.rooms))))
+    total = 0
+    self.cum_weights = []
+    for rank in range(1, len(self.rooms) + 1):
+      total += 1 / (rank ** self.zipf)
+      self.cum_weights.append(total)
+
+  def pick_room(self):
+    x = self.rng.random() * self.cum_weights[-1]
+    return self.rooms[min(bisect.bisect(self.cum_weights, x), len(self.rooms) - 1)]
+
+  def join(self, username: str, room: str):
+    self.execute('00002' + room + username, username)
+    self.members[username].add(room)
+
+  def populate(self, population: int):
+    self.grow_rooms(population)
+    while len(self.members) < population:
+      username = self.pad('sim-user-' + str(len(self.members)))
+      self.register(username)
+      while len(self.members[username]) < min(self.joins, len(self.rooms)):
+        room = self.pick_room()
+        if room not in self.members[username]:
+          self.join(username, room)
+
+  def frame(self, op: str, username: str):
+    """ Build a command frame for op on behalf of username. Returns None if
+        the user has no suitable state for it (e.g. no room to leave).
+    """
+    if op == 'join':
+      room = self.pick_room()
+      if room in self.members[username]:
+        return None
+      return '00002' + room + username
+    if op == 'room msg':
+      joined = sorted(self.members[username])
+      if len(joined) == 0:
+        return None
+      rooms = self.rng.sample(joined, min(len(joined), self.rng.randint(1, 3)))
+      return '00003' + '%02d' % len(rooms) + ''.join(rooms) + 'capacity simulation message'
+    if op == 'user msg':
+      users = self.rng.sample(list(self.members), min(len(self.members), self.rng.randint(1, 3)))
+      return '00004' + '%02d' % len(users) + '&'.join(users) + '#capacity simulation message'
+    if op == 'leave':
+      joined = sorted(self.members[username])
+      if len(joined) == 0:
+        return None
+      return '00005' + self.rng.choice(joined) + username
+    if op == 'room users':
+      return '00006' + self.pick_room()
+    if op == 'rooms':
+      return '00007'
+    if op == 'disconn':
+      return '00010' + username
+    return None
+
+  def settle(self, op: str, frame: str, username: str):
+    """ Keep the simulator's view of the population in step with the table
+        after op; restores the population size after leave and disconnect.
+        Not included in the measured cost.
+    """
+    if op == 'join':
+      self.members[username].add(frame[5:25])
+    elif op == 'leave':
+      room = frame[5:25]
+      self.members[username].discard(room)
+      self.join(username, room)
+    elif op == 'disconn':
+      rooms = self.members[username]
+      self.register(username)
+      for room in rooms:
+        self.join(username, room)
+
+  def replay(self, ops: int, mix: dict):
+    """ Execute ops commands drawn from mix, return mapping op to the list
+        of per-command costs in seconds.
+    """
+    names  = list(mix)
+    weights = [mix[op] for op in names]
+    users  = list(self.members)
+    costs  = { op: [] for op in names }
+    done   = 0
+    while done < ops:
+      op = self.rng.choices(names, weights)[0]
+      username = self.rng.choice(users)
+      frame = self.frame(op, username)
+      if frame == None:
+        continue
+      start = time.perf_counter()
+      self.execute(frame, username)
+      costs[op].append(time.perf_counter() - start)
+      self.settle(op, frame, username)
+      done += 1
+    return costs
+
+
+def parse_mix(text: str):
+  mix = {}
+  for item in text.split(','):
+    op, weight = item.split('=')
+    op = op.strip()
+    if op not in OPCODES:
+      raise ValueError("unknown operation " + op + ", choose from " + ', '.join(OPCODES))
+    mix[op] = float(weight)
+  return mix
+
+
+def memory_in_use(traced: bool):
+  if traced:
+    return tracemalloc.get_traced_memory()[0]
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    '-p', '--populations', type=str, help="comma separated population sizes to reach",
+    default='500,1000,2000,4000')
+
+  parser.add_argument(
+    '--rooms-per-user', type=float, help="rooms created per user in the population", default=0.05)
+
+  parser.add_argument(
+    '-j', '--joins', type=int, help="rooms joined by each user", default=3)
+
+  parser.add_argument(
+    '-z', '--zipf', type=float, help="Zipf exponent of room popularity", default=1.0)
+
+  parser.add_argument(
+    '-n', '--ops', type=int, help="commands replayed per population", default=2000)
+
+  parser.add_argument(
+    '-m', '--mix', type=str, help="weighted command mix, op=weight,...", default=DEFAULT_MIX)
+
+  parser.add_argument(
+    '--budget-us', type=float, help="report the population where an op's mean cost exceeds this")
+
+  parser.add_argument(
+    '--trace-memory', action='store_true',
+    help="trace allocations with tracemalloc (slower) instead of reporting max RSS")
+
+  parser.add_argument(
+    '--seed', type=int, help="random seed", default=1)
+
+  args = parser.parse_args()
+  mix = parse_mix(args.mix)
+  populations = [int(p) for p in args.populations.split(',')]
+  sim = Simulator(args.rooms_per_user, args.joins, args.zipf, args.seed)
+
+  if args.trace_memory:
+    tracemalloc.start()
+
+  exceeded = {}
+  print("%-10s %-11s %12s %12s %8s" % ('users', 'op', 'mean us', 'p99 us', 'count'))
+  for population in populations:
+    sim.populate(population)
+    costs = sim.replay(args.ops, mix)
+    for op in mix:
+      samples = sorted(costs[op])
+      if len(samples) == 0:
+        continue
+      mean = sum(samples) / len(samples) * 1e6
+      p99  = samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6
+      print("%-10d %-11s %12.1f %12.1f %8d" % (population, op, mean, p99, len(samples)))
+      if args.budget_us != None and mean > args.budget_us and op not in exceeded:
+        exceeded[op] = population
+    print("%-10d memory %.1f MB, %d rooms\n" % (
+      population, memory_in_use(args.trace_memory) / 2**20, len(sim.table.rooms)))
+
+  if args.budget_us != None:
+    for op in mix:
+      if op in exceeded:
+        print(op, "exceeded", args.budget_us, "us at", exceeded[op], "users")
+      else:
+        print(op, "stayed within", args.budget_us, "us")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,113 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+
+import struct
+import threading
+import time
+
+
+class CaptureRecord:
+  """ One event read back from a capture file.
+
+      Attributes:
+        time (float)   : seconds since the capture started
+        conn_id (int)  : id of the connection, unique within the capture
+        kind (int)     : one of CaptureRecorder.OPEN, CLOSE, INBOUND, OUTBOUND
+        frame (str)    : the frame without '$' delimiters, '' for OPEN/CLOSE
+  """
+  def __init__(self, time: float, conn_id: int, kind: int, frame: str):
+    self.time    = time
+    self.conn_id = conn_id
+    self.kind    = kind
+    self.frame   = frame
+
+
+class CaptureRecorder:
+  """ Records the frames a server receives and sends into a compact binary
+      capture file, to be reissued later by replay.py.
+
+      The file starts with MAGIC, followed by one record per event: a
+      header packed as HEADER (microseconds since start, connection id,
+      event kind, payload length) and the utf-8 payload. Connections are
+      numbered in the order they are opened; the address is only used to
+      find the id again while the connection lives.
+
+      Attributes:
+        file             : the capture file opened in binary write mode
+        lock (threading.Lock): serializes writes from all client threads
+        ids (dict)       : mapping hash of address to connection id
+        start (float)    : monotonic time the capture started
+  """
+  MAGIC    = b'IRCCAP1\n'
+  HEADER   = struct.Struct('!QIBI')
+  OPEN     = 0
+  CLOSE    = 1
+  INBOUND  = 2
+  OUTBOUND = 3
+
+  def __init__(self, path: str):
+    self.file    = open(path, 'wb')
+    self.file.write(CaptureRecorder.MAGIC)
+    self.lock    = threading.Lock()
+    self.ids     = {}
+    self.next_id = 0
+    self.start   = time.monotonic()
+
+  def open_connection(self, addr):
+    self.lock.acquire()
+    self.ids[hash(addr)] = self.next_id
+    self.next_id += 1
+    self.__write(self.ids[hash(addr)], CaptureRecorder.OPEN, b'')
+    self.lock.release()
+
+  def close_connection(self, addr):
+    self.lock.acquire()
+    if hash(addr) in self.ids:
+      self.__write(self.ids[hash(addr)], CaptureRecorder.CLOSE, b'')
+      del self.ids[hash(addr)]
+      self.file.flush()
+    self.lock.release()
+
+  def inbound(self, addr, frame: str):
+    """ Record a frame received from the client at addr, without '$'.
+    """
+    self.__record(addr, CaptureRecorder.INBOUND, frame.encode(encoding="utf-8"))
+
+  def outbound(self, addr, data: bytes):
+    """ Record bytes produced by Status.to_bytes for the client at addr.
+    """
+    self.__record(addr, CaptureRecorder.OUTBOUND, data[1:-1])
+
+  def close(self):
+    self.lock.acquire()
+    self.file.close()
+    self.lock.release()
+
+  def __record(self, addr, kind: int, payload: bytes):
+    self.lock.acquire()
+    if hash(addr) in self.ids and not self.file.closed:
+      self.__write(self.ids[hash(addr)], kind, payload)
+    self.lock.release()
+
+  def __write(self, conn_id: int, kind: int, payload: bytes):
+    elapsed = int((time.monotonic() - self.start) * 1e6)
+    self.file.write(CaptureRecorder.HEADER.pack(elapsed, conn_id, kind, len(payload)))
+    self.file.write(payload)
+
+
+def read_capture(path: str):
+  """ Yield the CaptureRecord objects of a capture file in recorded order.
+      A record truncated by a server crash ends the iteration.
+  """
+  header = CaptureRecorder.HEADER
+  with open(path, 'rb') as f:
+    if f.read(len(CaptureRecorder.MAGIC)) != CaptureRecorder.MAGIC:
+      raise ValueError(path + " is not a capture file")
+    while True:
+      raw = f.read(header.size)
+      if len(raw) < header.size:
+        return
+      elapsed, conn_id, kind, length = header.unpack(raw)
+      payload = f.read(length)
+      if len(payload) < length:
+        return
+      yield CaptureRecord(elapsed / 1e6, conn_id, kind, payload.decode(encoding="utf-8"))
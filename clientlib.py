@@ -1,8 +1,12 @@
 # Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
 
-import socket
-import sys
-import re
+import asyncio
+import threading
+import time
+from status import (
+  FrameDecoder, Status, RegistrationStatus, JoinStatus, MessageStatus, DisconnectStatus, LeaveStatus,
+  RoomUserListStatus, ListRoomStatus, ResumeStatus, HeartbeatStatus, PresenceStatus,
+  PressureStatus, parse_status)
 
 class EmptyUsernameException(Exception):
   pass
@@ -16,8 +20,28 @@ class ClientApiArgumentError(Exception):
 
 
 class Client:
+  """ Produces command frames and writes them to the socket.
 
-  def __init__(self, socket):
+      By default every command is written with its own sendall call, under
+      the lock of the buffered mode, since pong() is called from a receiving
+      thread while other threads write commands. In
+      buffered mode commands accumulate in an output buffer that is written
+      in one sendall when it reaches flush_size bytes, when flush() is
+      called, or flush_interval seconds after the first buffered command.
+      register() and disconnect() always flush, since callers wait for
+      their effect.
+
+      Attributes:
+        buffered (bool)       : True to batch commands in the output buffer
+        flush_size (int)      : buffer size in bytes that triggers a flush
+        flush_interval (float): seconds a command may wait in the buffer,
+                                0 to only flush on size or flush()
+        outbuf (bytearray)    : commands not written yet
+        cache (RoomCache)     : local room cache the application keeps
+                                current, or None
+  """
+  def __init__(self, socket, buffered: bool = False, flush_size: int = 8192,
+               flush_interval: float = 0.01):
     self.socket = socket
     self.command_code = {
       'register'  : '00001',
@@ -27,10 +51,20 @@ class Client:
       'disconn'   : '00010',
       'leave'     : '00005',
       'room users': '00006',
-      'rooms'     : '00007'
+      'rooms'     : '00007',
+      'ping'      : '00008',
+      'pong'      : '00009',
+      'resume'    : '00012'
     }
     self.username = None
     self.disconnected = False
+    self.cache = None
+    self.buffered = buffered
+    self.flush_size = flush_size
+    self.flush_interval = flush_interval
+    self.outbuf = bytearray()
+    self.lock = threading.Lock()  # lock for output buffer, timer and socket writes
+    self.timer = None
 
   def set_username(self, username: str):
     self.username = username
@@ -38,16 +72,37 @@ class Client:
   def set_disconnected(self):
     self.disconnected = True
 
-  def register(self, username: str):
+  def register(self, username: str, options: set = None):
+    """ Register username. options is a set of registration options:
+        'resume' to receive a session token in the RegistrationStatus,
+        'deflate' to receive everything after the RegistrationStatus
+        compressed (see FrameDecoder.start_inflate).
+    """
+    if options:
+      username += '#' + '&'.join(sorted(options))
     if not self.disconnected:
-      self.socket.send(
+      self.__send(
         ('$' + self.command_code['register'] + username + '$').encode(encoding="utf-8"))
+      self.flush()
+
+  def resume(self, token: str, options: set = None):
+    """ Resume the session of token on this new connection, in place of
+        register(). The server answers with a ResumeStatus followed by the
+        messages queued while the session was detached. options are the
+        registration options for the new connection.
+    """
+    if options:
+      token += '#' + '&'.join(sorted(options))
+    if not self.disconnected:
+      self.__send(
+        ('$' + self.command_code['resume'] + token + '$').encode(encoding="utf-8"))
+      self.flush()
 
   def join(self, room: str):
     if not self.username:
       raise EmptyUsernameException
     if not self.disconnected:
-      self.socket.send(
+      self.__send(
         ('$' + self.command_code['join'] + room + self.username + '$').encode(encoding="utf-8"))
     
   def room_message(self, rooms: set, msg: str):
@@ -61,7 +116,7 @@ class Client:
       str_room_num = str(len(rooms))
     if not self.disconnected:
       bytes = '$' + self.command_code['room msg'] + str_room_num + ''.join(rooms) + msg + '$'
-      self.socket.send(bytes.encode(encoding="utf-8"))
+      self.__send(bytes.encode(encoding="utf-8"))
 
   def private_message(self, users: set, msg: str):
     if not self.username:
@@ -74,32 +129,473 @@ class Client:
       str_user_num = str(len(users))
     if not self.disconnected:
       bytes = '$' + self.command_code['user msg'] + str_user_num + '&'.join(users) + '#' + msg + '$'
-      self.socket.send(bytes.encode(encoding="utf-8"))
+      self.__send(bytes.encode(encoding="utf-8"))
 
   def disconnect(self):
     if not self.username:
       raise EmptyUsernameException
     if not self.disconnected:
       bytes = ('$' + self.command_code['disconn'] + self.username + '$').encode(encoding="utf-8")
-      self.socket.send(bytes)  
+      self.__send(bytes)
+      self.flush()
 
   def leave(self, room: str):
     if not self.username:
       raise EmptyUsernameException
     if not self.disconnected:
       bytes = ('$' + self.command_code['leave'] + room + self.username + '$').encode(encoding="utf-8")
-      self.socket.send(bytes)
+      self.__send(bytes)
 
   def list_room_users(self, room: str):
     if not self.username:
       raise EmptyUsernameException
     if not self.disconnected:
       bytes = ('$' + self.command_code['room users'] + room + '$').encode(encoding="utf-8")
-      self.socket.send(bytes)
+      self.__send(bytes)
 
   def list_rooms(self):
     if not self.username:
       raise EmptyUsernameException
     if not self.disconnected:
       bytes = ('$' + self.command_code['rooms'] + '$').encode(encoding="utf-8")
-      self.socket.send(bytes)
\ No newline at end of file
+      self.__send(bytes)
+
+  def ping(self, data: str = ''):
+    if not self.disconnected:
+      self.__send(('$' + self.command_code['ping'] + data + '$').encode(encoding="utf-8"))
+
+  def pong(self, data: str = ''):
+    """ Answer a PING status; the server disconnects clients that stay
+        silent, so every client must answer pings.
+    """
+    if not self.disconnected:
+      self.__send(('$' + self.command_code['pong'] + data + '$').encode(encoding="utf-8"))
+
+  def flush(self):
+    """ Write all buffered commands. Does nothing if the buffer is empty.
+    """
+    self.lock.acquire()
+    try:
+      if self.timer != None:
+        self.timer.cancel()
+        self.timer = None
+      if len(self.outbuf) != 0:
+        data = bytes(self.outbuf)
+        self.outbuf.clear()
+        self.socket.sendall(data)
+    finally:
+      self.lock.release()
+
+  def __send(self, data: bytes):
+    if not self.buffered:
+      self.lock.acquire()
+      try:
+        self.socket.sendall(data)
+      finally:
+        self.lock.release()
+      return
+    self.lock.acquire()
+    self.outbuf += data
+    full = len(self.outbuf) >= self.flush_size
+    if not full and self.timer == None and self.flush_interval > 0:
+      self.timer = threading.Timer(self.flush_interval, self.__timed_flush)
+      self.timer.daemon = True
+      self.timer.start()
+    self.lock.release()
+    if full:
+      self.flush()
+
+  def __timed_flush(self):
+    try:
+      self.flush()
+    except OSError as _:  # the connection is gone; the reader will notice
+      self.set_disconnected()
+
+
+class RoomCache:
+  """ Client-side cache of the room list and of room memberships, kept
+      current by the statuses the client already receives.
+
+      The membership of a room this client has joined is exact once seeded
+      by one RoomUserListStatus: the server notifies every member of each
+      join, leave and disconnection in the room, one by one or as presence
+      digests. Other rooms and the room
+      list can change without this client being told (e.g. a room created
+      by someone else), so those entries are only answered for ttl seconds
+      after the list call that seeded them.
+
+      Attributes:
+        rooms (set)      : last known room names, or None if never listed
+        rooms_time (float): monotonic time rooms was last listed
+        members (dict)   : mapping room name to (set of usernames, monotonic
+                           time the list was received)
+        joined (set)     : rooms this client is a member of
+        lock (threading.Lock): lock for updates from the receiving thread
+  """
+  def __init__(self, ttl: float = 30.0):
+    self.ttl        = ttl
+    self.rooms      = None
+    self.rooms_time = 0.0
+    self.members    = {}
+    self.joined     = set()
+    self.lock       = threading.Lock()
+
+  def update(self, status: Status, username: str):
+    """ Apply a status received by the client whose name is username.
+        A PressureStatus invalidates the cache: the messages the server
+        dropped may have told of membership changes.
+    """
+    if isinstance(status, PressureStatus):
+      self.invalidate()
+      return
+    if status == None or status.code != 200:
+      return
+    self.lock.acquire()
+    now = time.monotonic()
+    if isinstance(status, ListRoomStatus):
+      self.rooms = { room for room in status.rooms if room != '' }
+      self.rooms_time = now
+    elif isinstance(status, RoomUserListStatus):
+      self.members[status.room] = ({ user for user in status.userlist if user != '' }, now)
+    elif isinstance(status, JoinStatus):
+      if self.rooms != None:
+        self.rooms.add(status.roomName)
+      if status.username == username:
+        self.joined.add(status.roomName)
+        if status.is_creation:
+          self.members[status.roomName] = ({ username }, now)
+      elif status.roomName in self.members:
+        self.members[status.roomName][0].add(status.username)
+    elif isinstance(status, LeaveStatus):
+      if status.username == username:
+        self.joined.discard(status.room)
+        self.members.pop(status.room, None)
+      elif status.room in self.members:
+        self.members[status.room][0].discard(status.username)
+    elif isinstance(status, DisconnectStatus):
+      if status.room in self.members:
+        self.members[status.room][0].discard(status.username)
+    elif isinstance(status, PresenceStatus):
+      if status.room in self.members:
+        self.members[status.room][0].update(status.joined)
+        self.members[status.room][0].difference_update(status.left)
+    elif isinstance(status, ResumeStatus):
+      self.joined = set(status.rooms)
+      if status.dropped != 0:   # membership changes may be among the dropped
+        self.members = {}
+    self.lock.release()
+
+  def invalidate(self):
+    """ Forget the room list and every membership; the joined rooms are
+        kept.
+    """
+    self.lock.acquire()
+    self.rooms   = None
+    self.members = {}
+    self.lock.release()
+
+  def room_list(self):
+    """ Return a copy of the cached room list, or None if it is unknown
+        or older than ttl.
+    """
+    self.lock.acquire()
+    rooms = None
+    if self.rooms != None and time.monotonic() - self.rooms_time < self.ttl:
+      rooms = set(self.rooms)
+    self.lock.release()
+    return rooms
+
+  def room_users(self, room: str):
+    """ Return a copy of the cached members of room, or None if they are
+        unknown or, for a room this client has not joined, older than ttl.
+    """
+    self.lock.acquire()
+    users = None
+    if room in self.members:
+      members, seeded = self.members[room]
+      if room in self.joined or time.monotonic() - seeded < self.ttl:
+        users = set(members)
+    self.lock.release()
+    return users
+
+
+class StreamSocket:
+  """ Adapter exposing an asyncio StreamWriter through the socket methods
+      used by Client, so Client keeps producing the frames.
+  """
+  def __init__(self, writer):
+    self.writer = writer
+
+  def send(self, data: bytes):
+    self.writer.write(data)
+    return len(data)
+
+  def sendall(self, data: bytes):
+    self.writer.write(data)
+
+
+class AsyncClient:
+  """ asyncio client that pipelines commands on one connection.
+
+      Every request method writes its command immediately and returns a
+      future, so many commands can be in flight at once; awaiting the
+      future gives the status that answers it. Replies are matched to
+      requests by command code and room or user name. Errors that the
+      server reports as a plain Status without command code are matched
+      to the oldest command in flight that can produce them. Room and
+      private messages have no future but stay in flight too, so their
+      errors are not taken for the answer of another request; a message
+      is done once its echo or the reply of a later request arrives.
+
+      Room and private messages are exposed as an async iterator:
+        async for message in client: ...
+      Every other status (others joining or leaving, disconnections,
+      errors of messages) is passed to on_event if it is set. PING statuses
+      are answered automatically.
+
+      If a RoomCache is given, list_rooms and list_room_users are answered
+      from it when it can, without a round trip. Registering or resuming
+      with the 'deflate' option switches the decoder to inflate after the
+      reply.
+
+      Attributes:
+        client (Client)      : produces the command frames
+        decoder (FrameDecoder): splits the received stream into frames
+        pending (list)       : (command code, name, future) in issue order,
+                               with no future for messages; the name of a
+                               room message is the set of its rooms not
+                               echoed yet
+        messages (asyncio.Queue): MessageStatus objects not yet iterated
+        on_event (callable)  : called with every status that is neither a
+                               reply nor a message, or None
+        cache (RoomCache)    : local room and membership cache, or None
+  """
+  # plain error statuses and the command codes of the commands that can
+  # produce them, None for any command but registering and resuming
+  PLAIN_ERRORS = {
+    400: { '00003', '00004' },   # bad command, a message whose text broke the frame
+    403: { '00001', '00002' },   # invalid username or room name format
+    410: { '00003', '00004' },   # room or user count not matching the names
+    420: None,                   # not registered
+    499: { '00005' },            # leaving user not found
+  }
+
+  # commands in flight above which the oldest message is taken as delivered
+  MAX_MESSAGES = 1024
+
+  def __init__(self, reader, writer, cache: RoomCache = None):
+    self.reader    = reader
+    self.writer    = writer
+    self.client    = Client(StreamSocket(writer))
+    self.decoder   = FrameDecoder()
+    self.pending   = []
+    self.messages  = asyncio.Queue()
+    self.on_event  = None
+    self.cache     = cache
+    self.inflate   = False   # switch to inflate after the registration reply
+    self.receiving = asyncio.ensure_future(self.__receive())
+
+  @staticmethod
+  async def connect(host: str, port: int, cache: RoomCache = None):
+    reader, writer = await asyncio.open_connection(host, port)
+    return AsyncClient(reader, writer, cache)
+
+  @property
+  def username(self):
+    return self.client.username
+
+  def register(self, username: str, options: set = None):
+    self.inflate = options != None and 'deflate' in options
+    self.client.register(username, options)
+    return self.__expect('00001', username)
+
+  def resume(self, token: str, options: set = None):
+    self.inflate = options != None and 'deflate' in options
+    self.client.resume(token, options)
+    return self.__expect('00012', None)
+
+  def join(self, room: str):
+    AsyncClient.__check_room(room)
+    self.client.join(room)
+    return self.__expect('00002', room)
+
+  def leave(self, room: str):
+    AsyncClient.__check_room(room)
+    self.client.leave(room)
+    return self.__expect('00005', room)
+
+  def list_room_users(self, room: str):
+    AsyncClient.__check_room(room)
+    if self.cache != None:
+      users = self.cache.room_users(room)
+      if users != None:
+        return self.__done(RoomUserListStatus(200, "success", room, users))
+    self.client.list_room_users(room)
+    return self.__expect('00006', room)
+
+  def list_rooms(self):
+    if self.cache != None:
+      rooms = self.cache.room_list()
+      if rooms != None:
+        return self.__done(ListRoomStatus(200, "success", rooms))
+    self.client.list_rooms()
+    return self.__expect('00007', None)
+
+  def room_message(self, rooms: set, msg: str):
+    self.client.room_message(rooms, msg)
+    self.__sent('00003', set(rooms))
+
+  def private_message(self, users: set, msg: str):
+    self.client.private_message(users, msg)
+    self.__sent('00004', None)
+
+  async def drain(self):
+    """ Wait until the written commands are handed to the transport.
+    """
+    await self.writer.drain()
+
+  async def disconnect(self):
+    """ Send the disconnect command and wait for the server to close.
+    """
+    self.client.disconnect()
+    self.client.set_disconnected()
+    await self.writer.drain()
+    await self.receiving
+    self.writer.close()
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    message = await self.messages.get()
+    if message == None:
+      self.messages.put_nowait(None)    # keep later iterations finished too
+      raise StopAsyncIteration
+    return message
+
+  @staticmethod
+  def __check_room(room: str):
+    # the server splits the room name off at a fixed width, a shorter
+    # name would shift the username and the reply could not be matched
+    if len(room) != 20:
+      raise ClientApiArgumentError("Room name must be padded to 20 characters")
+    if any(c in room for c in '$#&'):
+      raise ClientApiArgumentError("Room name cannot contain '$', '#' or '&'")
+
+  def __done(self, status: Status):
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(status)
+    return future
+
+  def __expect(self, command_code: str, name):
+    future = asyncio.get_running_loop().create_future()
+    self.pending.append((command_code, name, future))
+    return future
+
+  def __sent(self, command_code: str, name):
+    """ Keep a message in flight until it is done.
+    """
+    if self.client.disconnected:
+      return
+    self.pending.append((command_code, name, None))
+    if len(self.pending) > AsyncClient.MAX_MESSAGES:
+      for index in range(len(self.pending)):
+        if self.pending[index][2] == None:
+          del self.pending[index]
+          break
+
+  def __echoed(self, status: MessageStatus):
+    """ Retire the oldest message in flight that status is the echo of.
+    """
+    for index, (code, name, future) in enumerate(self.pending):
+      if future != None or code != status.command_code:
+        continue
+      if code == '00004':
+        del self.pending[index]
+        return
+      if status.room in name:
+        name.discard(status.room)
+        if len(name) == 0:
+          del self.pending[index]
+        return
+
+  def __resolve(self, status: Status):
+    """ Resolve the oldest command in flight answered by status. Returns
+        False if status does not answer any request with a future, so the
+        errors of messages still go to on_event.
+    """
+    command_code = getattr(status, 'command_code', None)
+    for index, (code, name, future) in enumerate(self.pending):
+      if command_code == None:
+        if status.code not in AsyncClient.PLAIN_ERRORS:
+          return False
+        codes = AsyncClient.PLAIN_ERRORS[status.code]
+        if codes == None:
+          matched = code not in { '00001', '00012' }
+        else:
+          matched = code in codes
+      elif command_code != code:
+        matched = False
+      elif code == '00001':
+        matched = status.username == name
+      elif code in { '00002', '00005' }:
+        room = status.roomName if code == '00002' else status.room
+        matched = room == name and status.username == self.client.username
+      elif code == '00003':
+        matched = status.room in name
+      elif code == '00006':
+        matched = status.room == name
+      else:
+        matched = True
+      if matched:
+        # the server answers a connection's commands in order, so the
+        # messages sent before this command are done
+        waiting = [entry for entry in self.pending[:index] if entry[2] != None]
+        self.pending = waiting + self.pending[index + 1:]
+        if future == None:
+          return False
+        if code == '00001' and status.code == 200:
+          self.client.set_username(name)
+        elif code == '00012' and status.code == 200:
+          self.client.set_username(status.username)
+        if not future.done():
+          future.set_result(status)
+        return True
+    return False
+
+  async def __receive(self):
+    try:
+      while True:
+        data = await self.reader.read(65536)
+        if data == b'':
+          break
+        self.decoder.feed(data)
+        for frame in self.decoder:
+          status = parse_status(frame)
+          if (self.inflate and status.code == 200
+              and isinstance(status, (RegistrationStatus, ResumeStatus))):
+            self.decoder.start_inflate()
+            self.inflate = False
+          self.__dispatch(status)
+    except ConnectionError as _:
+      pass
+    finally:
+      self.client.set_disconnected()
+      for _, _, future in self.pending:
+        if future != None and not future.done():
+          future.set_exception(ConnectionError("connection closed"))
+      self.pending = []
+      self.messages.put_nowait(None)
+
+  def __dispatch(self, status: Status):
+    if isinstance(status, HeartbeatStatus) and status.command_code == HeartbeatStatus.PING:
+      self.client.pong(status.data)
+      return
+    if self.cache != None:
+      self.cache.update(status, self.client.username)
+    if isinstance(status, MessageStatus) and status.code == 200:
+      if status.sender == self.client.username:
+        self.__echoed(status)
+      self.messages.put_nowait(status)
+    elif not self.__resolve(status) and self.on_event != None:
+      self.on_event(status)
@@ -0,0 +1,347 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# An asyncio load generator for the IRC server. Unlike test.py, which forks
+# one process per simulated client and sleeps between sends, this program
+# drives every simulated client from a single event loop, so thousands of
+# sessions can be hosted by one process.
+#
+# Each simulated client registers a username "lt<run>-<number>", joins a
+# subset of the rooms "lt-room-<number>" according to the chosen topology,
+# and then room messages are issued open-loop at the requested rate: the
+# schedule does not wait for replies, so a slow server shows up as growing
+# latency instead of a lower offered load.
+#
+# Every message carries a sequence number in its data. When a MessageStatus
+# frame comes back to any member of the room, it is matched with the send
+# time of that sequence number to compute the delivery latency.
+
+import argparse
+import asyncio
+import math
+import random
+import sys
+import time
+from status import (
+  FrameDecoder, Status, RegistrationStatus, JoinStatus, MessageStatus, HeartbeatStatus)
+from clientlib import Client, StreamSocket
+from app import CmdExecution
+
+
+class LoadStats:
+  """ Counters and latency samples shared by all simulated clients.
+
+      Attributes:
+        sent_at (dict)  : mapping sequence number to send time
+        expected (int)  : number of deliveries expected for all sent messages
+        delivered (int) : number of MessageStatus frames matched
+        latencies (list): delivery latencies in seconds
+        errors (dict)   : mapping error status code to its count
+  """
+  def __init__(self):
+    self.sent_at   = {}
+    self.expected  = 0
+    self.delivered = 0
+    self.latencies = []
+    self.errors    = {}
+
+  def record_error(self, code: int):
+    self.errors[code] = self.errors.get(code, 0) + 1
+
+  @staticmethod
+  def percentile(samples: list, p: float):
+    """ Nearest-rank percentile of an already sorted list.
+    """
+    if len(samples) == 0:
+      return float('nan')
+    rank = max(1, math.ceil(p / 100 * len(samples)))
+    return samples[rank - 1]
+
+
+class SimulatedClient:
+  """ A single IRC session driven by the event loop.
+
+      Attributes:
+        username (str)    : the 20 characters padded username
+        rooms (list)      : padded room names this client joins
+        client (Client)   : frame producer writing into the stream
+        ready (bool)      : True once registration and all joins succeeded
+  """
+  def __init__(self, username: str, rooms: list, stats: LoadStats):
+    self.username = username
+    self.rooms    = rooms
+    self.stats    = stats
+    self.client   = None
+    self.ready    = False
+    self.reader   = None
+    self.writer   = None
+    self.decoder  = FrameDecoder()
+    self.pending  = {}
+
+  async def connect(self, host: str, port: int):
+    self.reader, self.writer = await asyncio.open_connection(host, port)
+    self.client = Client(StreamSocket(self.writer))
+    loop = asyncio.get_running_loop()
+    self.pending['register'] = loop.create_future()
+    self.client.register(self.username)
+    self.client.set_username(self.username)
+    receiving = asyncio.ensure_future(self.receive())
+    if not await self.pending['register']:
+      return receiving
+    for room in self.rooms:
+      self.pending[room] = loop.create_future()
+      self.client.join(room)
+    results = await asyncio.gather(*[self.pending[room] for room in self.rooms])
+    self.ready = all(results)
+    return receiving
+
+  async def receive(self):
+    while True:
+      try:
+        data = await self.reader.read(65536)
+      except ConnectionError:
+        break
+      if data == b'':
+        break
+      now = time.perf_counter()
+      self.decoder.feed(data)
+      for frame in self.decoder:
+        self.handle_frame(frame, now)
+    for future in self.pending.values():
+      if not future.done():
+        future.set_result(False)
+
+  def handle_frame(self, frame: str, now: float):
+    command_code = frame[3:8] if len(frame) >= 8 else ''
+    if command_code in { '00003', '00004' }:
+      status = MessageStatus.parse(frame)
+      if status != None and status.code == 200 and status.data.startswith('lt:'):
+        seq = int(status.data[3:].split(' ')[0])
+        if seq in self.stats.sent_at:
+          self.stats.delivered += 1
+          self.stats.latencies.append(now - self.stats.sent_at[seq])
+        return
+    elif command_code == '00001':
+      status = RegistrationStatus.parse(frame)
+      if status != None:
+        self.resolve('register', status.code == 200)
+        if status.code != 200:
+          self.stats.record_error(status.code)
+        return
+    elif command_code == HeartbeatStatus.PING:
+      status = HeartbeatStatus.parse(frame)
+      if status != None:
+        self.client.pong(status.data)
+        return
+    elif command_code == '00002':
+      status = JoinStatus.parse(frame)
+      if status != None:
+        if status.username == self.username:
+          self.resolve(status.roomName, status.code == 200)
+        if status.code != 200:
+          self.stats.record_error(status.code)
+        return
+    status = Status.parse(frame)
+    if status.code != 200:
+      self.stats.record_error(status.code)
+
+  def resolve(self, key: str, result: bool):
+    future = self.pending.get(key)
+    if future != None and not future.done():
+      future.set_result(result)
+
+  def send(self, room: str, seq: int, padding: str):
+    self.client.room_message([room], 'lt:' + str(seq) + ' ' + padding)
+
+  async def close(self):
+    if self.writer == None:
+      return
+    try:
+      if self.ready:
+        self.client.disconnect()
+        await self.writer.drain()
+      self.writer.close()
+      await self.writer.wait_closed()
+    except ConnectionError:
+      pass
+
+
+def build_topology(num_clients: int, num_rooms: int, rooms_per_client: int,
+                   skew: float, rng: random.Random):
+  """ Return the list of room names and, for each client, the rooms it joins.
+      With skew 0 rooms are picked uniformly; a positive skew picks rooms
+      with Zipf weights 1/rank^skew so a few rooms become much larger.
+  """
+  rooms = [CmdExecution.room_name_sanitize('lt-room-' + str(i)) for i in range(num_rooms)]
+  weights = [1 / (rank ** skew) for rank in range(1, num_rooms + 1)]
+  memberships = []
+  per_client = min(rooms_per_client, num_rooms)
+  for _ in range(num_clients):
+    chosen = set()
+    while len(chosen) < per_client:
+      chosen.add(rng.choices(rooms, weights)[0])
+    memberships.append(sorted(chosen))
+  return rooms, memberships
+
+
+def offered_rate(profile: str, rate: float, elapsed: float, duration: float,
+                 ramp: float, steps: int):
+  """ Messages per second the schedule offers at time elapsed.
+  """
+  if profile == 'linear' and ramp > 0:
+    return rate * min(1.0, elapsed / ramp)
+  if profile == 'step':
+    return rate * min(steps, math.floor(steps * elapsed / duration) + 1) / steps
+  return rate
+
+
+async def run_load(args):
+  rng   = random.Random(args.seed)
+  stats = LoadStats()
+  run_id = '%04x' % rng.randrange(0x10000)
+  rooms, memberships = build_topology(
+    args.clients, args.rooms, args.rooms_per_client, args.skew, rng)
+
+  clients = []
+  for i in range(args.clients):
+    username = CmdExecution.room_name_sanitize('lt' + run_id + '-' + str(i))
+    clients.append(SimulatedClient(username, memberships[i], stats))
+
+  # connect clients at the requested connection rate
+  connect_start = time.perf_counter()
+  receivers = []
+  for i, client in enumerate(clients):
+    if args.connect_rate > 0:
+      delay = connect_start + i / args.connect_rate - time.perf_counter()
+      if delay > 0:
+        await asyncio.sleep(delay)
+    receivers.append(asyncio.ensure_future(client.connect(args.host, args.port)))
+  receivers = await asyncio.gather(*receivers, return_exceptions=True)
+  ready = [client for client in clients if client.ready]
+  print("connected", len(ready), "of", len(clients), "clients in",
+        "%.2fs" % (time.perf_counter() - connect_start))
+  if len(ready) == 0:
+    return stats
+
+  room_members = {}
+  for client in ready:
+    for room in client.rooms:
+      room_members[room] = room_members.get(room, 0) + 1
+
+  # open-loop schedule: the next send time never depends on replies
+  padding = 'x' * max(0, args.message_size)
+  start = time.perf_counter()
+  next_send = start
+  seq = 0
+  while True:
+    now = time.perf_counter()
+    elapsed = now - start
+    if elapsed >= args.duration:
+      break
+    rate = offered_rate(args.profile, args.rate, elapsed, args.duration, args.ramp, args.steps)
+    if rate <= 0:
+      await asyncio.sleep(0.01)
+      next_send = time.perf_counter()
+      continue
+    if next_send > now:
+      await asyncio.sleep(next_send - now)
+    client = rng.choice(ready)
+    room = rng.choice(client.rooms)
+    seq += 1
+    stats.sent_at[seq] = time.perf_counter()
+    stats.expected += room_members[room]
+    client.send(room, seq, padding)
+    if args.poisson:
+      next_send += rng.expovariate(rate)
+    else:
+      next_send += 1 / rate
+  send_elapsed = time.perf_counter() - start
+
+  # let in-flight deliveries arrive before tearing the sessions down
+  deadline = time.perf_counter() + args.drain
+  while stats.delivered < stats.expected and time.perf_counter() < deadline:
+    await asyncio.sleep(0.05)
+  total_elapsed = time.perf_counter() - start
+
+  await asyncio.gather(*[client.close() for client in clients])
+  for receiving in receivers:
+    if isinstance(receiving, asyncio.Future):
+      receiving.cancel()
+
+  report(stats, seq, send_elapsed, total_elapsed)
+  return stats
+
+
+def report(stats: LoadStats, sent: int, send_elapsed: float, total_elapsed: float):
+  latencies = sorted(stats.latencies)
+  print("sent:      ", sent, "messages in %.2fs (%.1f msg/s)" % (send_elapsed, sent / send_elapsed))
+  print("delivered: ", stats.delivered, "of", stats.expected, "expected",
+        "(%.1f msg/s)" % (stats.delivered / total_elapsed))
+  for p in (50, 99, 99.9):
+    print("p%-5s latency: %.3f ms" % (p, LoadStats.percentile(latencies, p) * 1000))
+  if len(latencies) != 0:
+    print("max    latency: %.3f ms" % (latencies[-1] * 1000))
+  for code in sorted(stats.errors):
+    print("error", code, "x", stats.errors[code])
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    '-n', '--clients', type=int, help="number of simulated clients", default=100)
+
+  parser.add_argument(
+    '--rooms', type=int, help="number of rooms", default=10)
+
+  parser.add_argument(
+    '--rooms-per-client', type=int, help="rooms joined by each client", default=2)
+
+  parser.add_argument(
+    '--skew', type=float, help="Zipf exponent for room popularity, 0 for uniform", default=0.0)
+
+  parser.add_argument(
+    '-r', '--rate', type=float, help="offered room messages per second", default=100.0)
+
+  parser.add_argument(
+    '-d', '--duration', type=float, help="seconds to send messages", default=10.0)
+
+  parser.add_argument(
+    '--profile', choices=['constant', 'linear', 'step'], help="rate ramp profile",
+    default='constant')
+
+  parser.add_argument(
+    '--ramp', type=float, help="seconds to reach full rate in linear profile", default=5.0)
+
+  parser.add_argument(
+    '--steps', type=int, help="number of rate steps in step profile", default=4)
+
+  parser.add_argument(
+    '--poisson', action='store_true', help="exponential inter-arrival times")
+
+  parser.add_argument(
+    '--connect-rate', type=float, help="new connections per second, 0 for no limit", default=500.0)
+
+  parser.add_argument(
+    '-s', '--message-size', type=int, help="bytes of padding per message", default=32)
+
+  parser.add_argument(
+    '--drain', type=float, help="seconds to wait for outstanding deliveries", default=5.0)
+
+  parser.add_argument(
+    '--seed', type=int, help="random seed", default=None)
+
+  parser.add_argument(
+    '--host', type=str, help="host", default='localhost')
+
+  parser.add_argument(
+    '--port', type=int, help="port", default=8000)
+
+  args = parser.parse_args()
+  if args.rooms_per_client > args.rooms:
+    print("--rooms-per-client cannot exceed --rooms")
+    sys.exit(1)
+  asyncio.run(run_load(args))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,8 @@
 # Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
 
 from status import (
-  Status, CommandError, JoinStatus, MessageStatus, DisconnectStatus,
-  LeaveStatus, RoomUserListStatus, ListRoomStatus)
+  Status, CommandError, RegistrationStatus, MessageStatus, DisconnectStatus,
+  RoomUserListStatus, ListRoomStatus, ResumeStatus, HeartbeatStatus, PressureStatus)
 
 class CommandFactory:
   """ Given a byte object, parse command and argument and produce 
@@ -38,6 +38,15 @@ class CommandFactory:
     elif cmd == '00007':
       return ListCreatedRooms(bytes, table)
 
+    elif cmd == '00008':
+      return Ping(bytes, table)
+
+    elif cmd == '00009':
+      return Pong(bytes, table)
+
+    elif cmd == '00012':
+      return ResumeSession(bytes, table)
+
     else:
       raise CommandError(400, msg="cannot find appropriate command")
 
@@ -73,21 +82,37 @@ class Msg:
 
   def execute(self, conn, addr):
     pass
+
+  def touched_rooms(self):
+    """ Return the names of the rooms the command reads or changes, if it
+        reads or changes only these. ActorTable runs the command on their
+        actors.
+    """
+    return []
     
 
 
 class RegistrationCommand(Msg):
   """ Parse the message sent from client by getting the username 
       Execute to register user into the server database.
+      The username may be followed by '#' and '&' separated options:
+        resume : issue a session token that ResumeSession accepts
+        deflate: compress everything sent after the registration status
+                 (see FrameCompressor)
+        presence: get the membership changes of the user's rooms as one
+                 PresenceStatus digest per room and tick; a 406 error code
+                 is sent back if the server does not make digests
 
       Attributes:
         receiver (list): The register's username
         username (str) : The username parsed from args
+        options (set)  : The registration options
   """
   def __init__(self, bytes, table):
     super().__init__(bytes, table)
-    self.receivers = [ self.args ]
-    self.username  = self.args
+    self.username, _, options = self.args.partition('#')
+    self.receivers = [ self.username ]
+    self.options   = set(options.split('&')) if options else set()
 
   def execute(self, conn, addr):
     # if hash(addr) in self.table.conns:
@@ -102,8 +127,41 @@ class RegistrationCommand(Msg):
         # it will return an error code 420 back to client.
         status = Status(
           420, "Not registered address " + str(addr) + ", register a username first.")
+      elif 'presence' in self.options and not self.table.has_presence():
+        status = RegistrationStatus(406, "Presence digests not available", self.username)
       else:
         status = self.table.user_registration(self.username, conn, addr)
+        if status.code == 200 and 'resume' in self.options:
+          status.token = self.table.open_session(self.username)
+        if status.code == 200 and 'presence' in self.options:
+          self.table.set_presence(self.username, True)
+    return status
+
+
+class ResumeSession(Msg):
+  """ Resume a session whose connection was lost, in place of registration.
+      The user gets its name, rooms and queued messages back without the
+      rooms being notified.
+      args:
+        session token, optionally followed by '#' and registration options
+        that apply to the new connection; 'presence' is refused with a 406
+        error code as in RegistrationCommand
+  """
+  def __init__(self, bytes, table):
+    super().__init__(bytes, table)
+    self.token, _, options = self.args.partition('#')
+    self.options = set(options.split('&')) if options else set()
+
+  def execute(self, conn, addr):
+    if self.table.has_addr(addr):
+      status = ResumeStatus(432, "Connection already registered", '', set(), 0)
+      self.table.enqueue_message(status, [self.table.get_username_by_addr(addr)])
+      return status
+    if 'presence' in self.options and not self.table.has_presence():
+      return ResumeStatus(406, "Presence digests not available", '', set(), 0)
+    status = self.table.resume_session(self.token, conn, addr)
+    if status.code == 200:
+      self.table.set_presence(status.username, 'presence' in self.options)
     return status
 
 
@@ -133,11 +191,17 @@ class JoinCommand(Msg):
       # can find receiver, enqueue status object to all receivers;
       # otherwise, simply send back status object to connection 
       # in current thread
-      self.table.enqueue_message(status, self.receivers)
+      if status.code == 200:
+        self.table.deliver_to_room(self.roomName, status, self.receivers)
+      else:
+        self.table.enqueue_message(status, self.receivers)
     else:
       self.table.enqueue_message(status, [self.table.get_username_by_addr(addr)])
     return status
 
+  def touched_rooms(self):
+    return [self.roomName]
+
   def __get_receivers(self, status: Status):
     if status.code == 200:
       self.receivers = self.table.list_room_users(self.roomName)
@@ -150,6 +214,8 @@ class JoinCommand(Msg):
 class UserMessageToRooms(Msg):
   """ Parse the message sent from client by getting the message to 
       send, the user to receive, and send message to receiver user.
+      The sender's flood control is charged one token per member of
+      every room; a 429 error code is sent back when it runs out.
       args: 
         number of rooms to send (99 max, 2 digit)
         room name (20 bytes each)
@@ -177,12 +243,24 @@ class UserMessageToRooms(Msg):
     status = self.__valid_room_names(sender_name)
     if status.code == 200:
       receivers = self.__get_receivers()
+      cost = sum(len(receivers[room]) for room in receivers)
+      wait = self.table.charge_messages(sender_name, cost)
+      if wait > 0:
+        status = MessageStatus(
+          429, "Rate limit exceeded, retry in %.2f s" % wait, True, sender_name,
+          self.rooms[0], '', self.message)
+        self.table.enqueue_message(status, [sender_name])
+        return status
       for room in receivers:
         status = MessageStatus(200, 'success', True, sender_name, room, '', self.message)
-        self.table.enqueue_message(status, receivers[room])
+        self.table.deliver_to_room(room, status, receivers[room])
     else:
       receivers = [sender_name]
       self.table.enqueue_message(status, receivers)
+    return status
+
+  def touched_rooms(self):
+    return self.rooms
 
   def __valid_arguments(self):
     """ Check whether the length of room list parsed is same as the room number argument
@@ -212,6 +290,8 @@ class UserMessageToUsers(Msg):
   """ Parse the message sent from client by getting the message to 
       send, the user to receive, and send message to receiver user.
       The sender will also receive a copy of what it sent.
+      The sender's flood control is charged one token per copy; a 429
+      error code is sent back when it runs out.
       args: 
         number of users to send (99 max, 2 digit)
         message
@@ -237,6 +317,14 @@ class UserMessageToUsers(Msg):
 
     status = self.__valid_usernames(sender_name)
     if status.code == 200:
+      cost = len(self.users) + (0 if sender_name in self.users else 1)
+      wait = self.table.charge_messages(sender_name, cost)
+      if wait > 0:
+        status = MessageStatus(
+          429, "Rate limit exceeded, retry in %.2f s" % wait, False, sender_name,
+          '', self.users[0], self.message)
+        self.table.enqueue_message(status, [sender_name])
+        return status
       for user in self.users:
         status = MessageStatus(200, 'success', False, sender_name, '', user, self.message)
         self.table.enqueue_message(status, [user])
@@ -275,12 +363,7 @@ class UserDisconnect(Msg):
       if status.code != 200:  # internal error of this protocol
         status = DisconnectStatus(status.code, status.message, self.username, addr)
       else:                   # clear user from server db successfully
-        receivers = {}        # now notify rooms that user joined before disconnected
-        for room in to_notify:
-          receivers[room] = self.table.list_room_users(room)
-        for room in receivers:  # enqueue a message to each users in rooms
-          status = DisconnectStatus(200, "success", self.username, room=room)
-          self.table.enqueue_message(status, receivers[room])
+        UserDisconnect.notify_rooms(self.table, self.username, to_notify)
 
     if status.code == 200:  
       # the returned object indicate success of curr user disconnection
@@ -291,6 +374,88 @@ class UserDisconnect(Msg):
     else:
       return status
 
+  @staticmethod
+  def notify_rooms(table, username: str, to_notify: set):
+    """ Notify the rooms that the disconnected user joined before.
+    """
+    for room in to_notify:  # enqueue a message to each users in rooms
+      table.run_in_rooms([room], lambda room=room: UserDisconnect.notify_room(table, username, room))
+
+  @staticmethod
+  def notify_room(table, username: str, room: str):
+    status = DisconnectStatus(200, "success", username, room=room)
+    table.deliver_to_room(room, status, table.list_room_users(room))
+
+
+class SessionExpiry(Msg):
+  """ A detached session was not resumed within the grace period: the user
+      is disconnected as if it had sent a disconnect command.
+      args:
+        session token
+  """
+  def __init__(self, bytes, table, detaches: int):
+    super().__init__(bytes, table)
+    self.token    = self.args
+    self.detaches = detaches
+
+  def execute(self, conn, addr):
+    username, to_notify = self.table.expire_session(self.token, self.detaches)
+    if username == None:    # resumed, or detached again since
+      return Status(200, "success")
+    UserDisconnect.notify_rooms(self.table, username, to_notify)
+    return DisconnectStatus(200, "success", username)
+
+
+class MemoryEviction(Msg):
+  """ The server is over its memory ceiling and the user is one of the
+      slowest readers: the user is sent a 507 status and removed with its
+      session, and its rooms are notified as if it had sent a disconnect
+      command.
+      args:
+        username
+  """
+  def __init__(self, bytes, table):
+    super().__init__(bytes, table)
+    self.username = self.args
+
+  def execute(self, conn, addr):
+    notice = PressureStatus(507, "Session evicted, server memory low", 0, True)
+    to_notify = self.table.evict_user(self.username, notice)
+    if to_notify == None:   # disconnected since the accountant measured
+      return Status(200, "success")
+    UserDisconnect.notify_rooms(self.table, self.username, to_notify)
+    return DisconnectStatus(200, "success", self.username)
+
+
+class Ping(Msg):
+  """ Client checks that the server is alive. The server answers with a
+      PONG status echoing the arguments.
+      args:
+        any data without '#' and '$'
+  """
+  def __init__(self, bytes, table):
+    super().__init__(bytes, table)
+    self.data = self.args
+
+  def execute(self, conn, addr):
+    status = self.valid_addr(addr)
+    if status.code == 200:
+      status = HeartbeatStatus(200, "pong", HeartbeatStatus.PONG, self.data)
+      self.table.enqueue_message(status, [self.table.get_username_by_addr(addr)])
+    return status
+
+
+class Pong(Msg):
+  """ Client answers a PING status. Receiving it is all that matters: any
+      command resets the idle time of the connection.
+  """
+  def __init__(self, bytes, table):
+    super().__init__(bytes, table)
+    self.data = self.args
+
+  def execute(self, conn, addr):
+    return self.valid_addr(addr)
+
 
 class LeaveRoom(Msg):
   """ Client leave a room. When client leave a room, the room will be notified.
@@ -308,11 +473,14 @@ class LeaveRoom(Msg):
       if status.code == 200:
         to_notify = self.table.list_room_users(self.room)
         to_notify.add(self.username)  # also notify leaver itself success of leaving
-        self.table.enqueue_message(status, to_notify)
+        self.table.deliver_to_room(self.room, status, to_notify)
       else:
         self.table.enqueue_message(status, [self.table.get_username_by_addr(addr)])
     return status
 
+  def touched_rooms(self):
+    return [self.room]
+
 
 class ListJoinedUsers(Msg):
   """ Client request to list all the joined users in a room.
@@ -336,6 +504,9 @@ class ListJoinedUsers(Msg):
       self.table.enqueue_message(status, [self.table.get_username_by_addr(addr)])
     return status
 
+  def touched_rooms(self):
+    return [self.room]
+
 
 class ListCreatedRooms(Msg):
   """ Client request to list all rooms existed. No argument should be provided.
@@ -0,0 +1,346 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# Reissues a capture file recorded by "server.py <PORT> --capture FILE"
+# against a running server, normally a fresh local one so the recorded
+# usernames are free.
+#
+# Every recorded connection is opened again and sends the same frames at the
+# recorded times divided by the speed factor (1 for real time, N for N times
+# faster, 0 for as fast as possible). To keep the replay deterministic at any
+# speed, frames and closes happen in the recorded global order, a connection
+# does not send a frame until it has received the replies the server had
+# sent it before that frame in the capture (or --settle seconds passed), and
+# a connection that stalls holds the others back --settle seconds at most.
+#
+# The frames the server sends back on each connection are compared with the
+# recorded outbound frames, both in order and as a multiset, since frames
+# caused by other connections can still interleave differently.
+#
+# A connection recorded registering or resuming with the 'deflate' option
+# switches its decoder to inflate after the successful reply, as the
+# server compresses everything it sends afterwards.
+#
+# Session tokens are random, so the token a registration reply carries in
+# the replay is mapped to the recorded one: resume frames are sent with the
+# token issued in the replay, and replies are compared with the recorded
+# token in place of the new one.
+#
+# The server pings a connection after a silence, with the time as payload,
+# so PINGs depend on timing rather than on the frames sent. They are left
+# out of the comparison and answered as any client does, and the recorded
+# PONGs are not sent again.
+#
+# The program exits with status 1 when any connection received different
+# frames than recorded.
+
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+from capture import CaptureRecorder, read_capture
+from status import FrameDecoder
+
+
+class ReplayConnection:
+  """ The recorded events of one connection and what was received during
+      the replay.
+
+      Attributes:
+        conn_id (int)    : connection id in the capture
+        opened_at (float): capture time the connection was opened
+        closed_at (float): capture time the connection was closed, or None
+        close_index (int): global index of the close event, or None
+        inbound (list)   : (global index, capture time, frame, number of
+                           outbound frames recorded before it)
+        expected (list)  : frames the server sent in the capture
+        received (list)  : frames the server sent during the replay
+        inflate (bool)   : the connection asked for deflate and the reply
+                           switching the stream has not arrived yet
+  """
+  def __init__(self, conn_id: int, opened_at: float):
+    self.conn_id   = conn_id
+    self.opened_at = opened_at
+    self.closed_at = None
+    self.close_index = None
+    self.inbound   = []
+    self.expected  = []
+    self.received  = []
+    self.arrived   = None
+    self.inflate   = False
+
+  async def run(self, host: str, port: int, replayer):
+    await replayer.schedule(self.opened_at)
+    reader, writer = await asyncio.open_connection(host, port)
+    self.arrived = asyncio.Condition()
+    receiving = asyncio.ensure_future(self.receive(reader, writer, replayer))
+    try:
+      for index, at, frame, replies_before in self.inbound:
+        await replayer.schedule(at)
+        await self.wait_received(replies_before, replayer.settle)
+        if frame[:5] == '00012':
+          token, separator, options = frame[5:].partition('#')
+          frame = '00012' + await replayer.wait_token(token) + separator + options
+        await replayer.wait_turn(index)
+        try:
+          writer.write(('$' + frame + '$').encode(encoding="utf-8"))
+          await writer.drain()
+        finally:
+          await replayer.end_turn(index)
+      if self.closed_at != None:
+        await replayer.schedule(self.closed_at)
+      # wait for the replies the capture says are still due before closing
+      await self.wait_received(len(self.expected), replayer.settle)
+      if self.close_index != None:
+        await replayer.wait_turn(self.close_index)
+      try:
+        writer.close()
+        await writer.wait_closed()
+      finally:
+        if self.close_index != None:
+          await replayer.end_turn(self.close_index)
+    except ConnectionError:
+      replayer.skip(self)
+    receiving.cancel()
+
+  async def wait_received(self, count: int, timeout: float):
+    async with self.arrived:
+      try:
+        await asyncio.wait_for(
+          self.arrived.wait_for(lambda: len(self.received) >= count), timeout)
+      except asyncio.TimeoutError:
+        pass
+
+  async def receive(self, reader, writer, replayer):
+    decoder = FrameDecoder()
+    while True:
+      try:
+        data = await reader.read(65536)
+      except ConnectionError:
+        break
+      if data == b'':
+        break
+      decoder.feed(data)
+      async with self.arrived:
+        for frame in decoder:
+          if frame[3:8] == PING:
+            writer.write(('$' + PONG + frame[8:].partition('#')[0] + '$').encode(encoding="utf-8"))
+            continue
+          token = session_token(frame)
+          if token != None and len(self.received) < len(self.expected):
+            recorded = session_token(self.expected[len(self.received)])
+            if recorded != None:
+              replayer.issue(recorded, token)
+              frame = frame[:len(frame) - len(token)] + recorded
+          self.received.append(frame)
+          if self.inflate and frame[:3] == '200' and frame[3:8] in SWITCHING_COMMANDS:
+            decoder.start_inflate()
+            self.inflate = False
+        self.arrived.notify_all()
+
+  def in_order(self):
+    return self.received == self.expected
+
+  def same_frames(self):
+    return Counter(self.received) == Counter(self.expected)
+
+
+class Replayer:
+  """ Paces all connections: maps capture time to wall time through the
+      speed factor and hands out turns so frames are written in the
+      recorded global order. tokens maps the session tokens of the capture
+      to the ones issued during the replay.
+  """
+  def __init__(self, speed: float, settle: float):
+    self.speed  = speed
+    self.settle = settle
+    self.start  = time.perf_counter()
+    self.turn   = 0
+    self.skipped = set()
+    self.tokens  = {}
+    self.changed = asyncio.Condition()
+
+  async def schedule(self, at: float):
+    if self.speed <= 0:
+      await asyncio.sleep(0)
+      return
+    delay = self.start + at / self.speed - time.perf_counter()
+    if delay > 0:
+      await asyncio.sleep(delay)
+
+  async def wait_turn(self, index: int):
+    """ Wait until the frames before index were written, at most settle
+        seconds: the turns of a connection that stalled are passed over.
+    """
+    async with self.changed:
+      try:
+        await asyncio.wait_for(
+          self.changed.wait_for(lambda: self.__advance() >= index), self.settle)
+      except asyncio.TimeoutError:
+        self.turn = max(self.turn, index)
+
+  async def end_turn(self, index: int):
+    async with self.changed:
+      self.turn = max(self.turn, index + 1)
+      self.changed.notify_all()
+
+  def issue(self, recorded: str, token: str):
+    self.tokens[recorded] = token
+    asyncio.ensure_future(self.__notify())
+
+  async def wait_token(self, recorded: str):
+    """ Return the token issued in the replay for a recorded token, waiting
+        at most settle seconds for its registration reply. The recorded
+        token is returned if it was never issued.
+    """
+    async with self.changed:
+      try:
+        await asyncio.wait_for(
+          self.changed.wait_for(lambda: recorded in self.tokens), self.settle)
+      except asyncio.TimeoutError:
+        pass
+    return self.tokens.get(recorded, recorded)
+
+  def skip(self, connection):
+    """ Give up the remaining turns of a connection the server closed.
+    """
+    indices = [index for index, _, _, _ in connection.inbound]
+    if connection.close_index != None:
+      indices.append(connection.close_index)
+    for index in indices:
+      if index >= self.turn:
+        self.skipped.add(index)
+    asyncio.ensure_future(self.__notify())
+
+  async def __notify(self):
+    async with self.changed:
+      self.changed.notify_all()
+
+  def __advance(self):
+    while self.turn in self.skipped:
+      self.turn += 1
+    return self.turn
+
+
+# a PING status from the server and the PONG command answering it
+PING = '00008'
+PONG = '00009'
+
+# commands whose successful reply is the last frame sent uncompressed
+SWITCHING_COMMANDS = { '00001', '00012' }
+
+
+def session_token(frame: str):
+  """ Return the session token of a successful registration reply, or None
+      for any other frame.
+  """
+  if frame[:8] != '20000001':
+    return None
+  args = frame[8:].split('#')
+  return args[2] if len(args) == 3 else None
+
+
+def registration_options(frame: str):
+  """ Return the options of a registration or resume frame, or an empty
+      set for any other frame.
+  """
+  if frame[:5] not in SWITCHING_COMMANDS:
+    return set()
+  _, _, options = frame[5:].partition('#')
+  return set(options.split('&'))
+
+
+def load(path: str):
+  """ Group the records of a capture file by connection.
+  """
+  connections = {}
+  index = 0
+  for record in read_capture(path):
+    if record.kind == CaptureRecorder.OPEN:
+      connections[record.conn_id] = ReplayConnection(record.conn_id, record.time)
+      continue
+    connection = connections.get(record.conn_id)
+    if connection == None:
+      continue
+    if record.kind == CaptureRecorder.INBOUND:
+      if record.frame[:5] == PONG:
+        continue
+      connection.inbound.append((index, record.time, record.frame, len(connection.expected)))
+      if 'deflate' in registration_options(record.frame):
+        connection.inflate = True
+      index += 1
+    elif record.kind == CaptureRecorder.OUTBOUND:
+      if record.frame[3:8] == PING:
+        continue
+      connection.expected.append(record.frame)
+    elif record.kind == CaptureRecorder.CLOSE:
+      connection.closed_at = record.time
+      connection.close_index = index
+      index += 1
+  return [connections[conn_id] for conn_id in sorted(connections)]
+
+
+async def replay(connections: list, host: str, port: int, speed: float, settle: float):
+  replayer = Replayer(speed, settle)
+  await asyncio.gather(*[c.run(host, port, replayer) for c in connections])
+  return time.perf_counter() - replayer.start
+
+
+def report(connections: list, elapsed: float, verbose: bool):
+  frames_in  = sum(len(c.inbound) for c in connections)
+  frames_out = sum(len(c.received) for c in connections)
+  in_order   = sum(1 for c in connections if c.in_order())
+  reordered  = sum(1 for c in connections if not c.in_order() and c.same_frames())
+  mismatched = [c for c in connections if not c.same_frames()]
+
+  print("replayed", len(connections), "connections,", frames_in, "frames sent,",
+        frames_out, "frames received in %.2fs" % elapsed)
+  print("  %.1f frames/s sent, %.1f frames/s received" % (frames_in / elapsed, frames_out / elapsed))
+  print("  matching in order:", in_order)
+  print("  matching reordered:", reordered)
+  print("  mismatched:", len(mismatched))
+  for c in mismatched:
+    missing = Counter(c.expected) - Counter(c.received)
+    extra   = Counter(c.received) - Counter(c.expected)
+    print("connection", c.conn_id, ":", sum(missing.values()), "missing,",
+          sum(extra.values()), "unexpected")
+    if verbose:
+      for frame in missing.elements():
+        print("  - " + frame)
+      for frame in extra.elements():
+        print("  + " + frame)
+  return len(mismatched) == 0
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    'capture', type=str, help="capture file recorded by server.py --capture")
+
+  parser.add_argument(
+    '-s', '--speed', type=float, help="speed factor, 1 for real time, 0 for max speed", default=1.0)
+
+  parser.add_argument(
+    '--settle', type=float, help="seconds to wait for the replies due before a frame or a close",
+    default=2.0)
+
+  parser.add_argument(
+    '-v', '--verbose', action='store_true', help="print missing and unexpected frames")
+
+  parser.add_argument(
+    '--host', type=str, help="host", default='localhost')
+
+  parser.add_argument(
+    '--port', type=int, help="port", default=8000)
+
+  args = parser.parse_args()
+
+  connections = load(args.capture)
+  elapsed = asyncio.run(replay(connections, args.host, args.port, args.speed, args.settle))
+  if not report(connections, elapsed, args.verbose):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,14 +1,21 @@
 # Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
 
+import argparse
+import selectors
 import socket
 import sys
 import threading
-import re
-from serverlib import User, Room, Table, RunningSignal
+import time
+from serverlib import (
+  Table, ActorTable, ShardedTable, RunningSignal, AdmissionController, ConnectionLimits,
+  MemoryAccountant, enable_keepalive)
 from message import (
-  CommandFactory, CommandError, RegistrationCommand, UserDisconnect)
+  CommandFactory, CommandError, RegistrationCommand, ResumeSession, SessionExpiry,
+  UserDisconnect, MemoryEviction)
 from status import(
-  Status, DisconnectStatus, UserDisconnectedException, AddrError)
+  Status, DisconnectStatus, UserDisconnectedException, AddrError, FrameDecoder,
+  FrameCompressor, HeartbeatStatus)
+from capture import CaptureRecorder
 
 
 class Server:
@@ -36,22 +43,113 @@ class Server:
         s (socket)                      : server socket object
         host (str)                      : host name
         port (int)                      : port number
+        recorder (CaptureRecorder)      : records every inbound and outbound
+                                          frame when capturing, else None
+        session_grace (float)           : seconds a session whose connection
+                                          was lost can be resumed
+        compress_level (int)            : zlib level for connections that
+                                          registered with 'deflate'
+        ping_interval (float)           : seconds of silence from a client
+                                          before it is sent a PING, 0 for none
+        idle_timeout (float)            : seconds of silence after which a
+                                          client is disconnected, 0 for never
+        keepalive (int)                 : seconds before TCP keepalive probes
+                                          start, 0 to leave keepalive off
+        registration_timeout (float)    : seconds a connection has to register,
+                                          0 for no deadline
+        limits (ConnectionLimits)       : caps on unregistered connections
+                                          and connections per IP address
+        stats_interval (float)          : seconds between two lines of
+                                          counters on stderr, 0 for none
+        admission (AdmissionController) : turns new clients away while the
+                                          server is overloaded
+        memory (MemoryAccountant)       : trims queues and evicts slow users
+                                          to keep the table's estimated
+                                          memory under a ceiling
+        started (threading.Event)       : set once run() has started the
+                                          server's background threads
+        verbose (bool)                  : print every connection and the
+                                          frames it sends
   """
-  def __init__(self, port):
-    self.database = Table(threading.Lock())
+  # registration frames are short; a longer partial frame is not a client
+  MAX_REGISTRATION_FRAME = 1024
+
+  # seconds between two load samples of the admission controller
+  ADMISSION_INTERVAL = 0.5
+
+  # seconds between two checks of the memory ceiling
+  MEMORY_INTERVAL = 1.0
+
+  def __init__(self, port, recorder: CaptureRecorder = None, *,
+               session_grace: float = 60.0, session_backlog: int = 256,
+               compress_level: int = 6, ping_interval: float = 0,
+               idle_timeout: float = 0, keepalive: int = 0,
+               registration_timeout: float = 0, max_unregistered: int = 0,
+               max_per_ip: int = 0, backlog: int = 128,
+               message_rate: float = 0, message_burst: float = 10000.0,
+               stats_interval: float = 0, max_connections: int = 0,
+               max_queued_bytes: int = 0, max_latency: float = 0,
+               memory_limit: int = 0, broadcast_threshold: int = 0,
+               broadcast_workers: int = 4, delivery: str = 'queue',
+               room_log_size: int = 1024, room_actors: int = 0, table_shards: int = 0,
+               presence_interval: float = 0, verbose: bool = False):
+    self.recorder = recorder
+    self.verbose = verbose
+    self.session_grace = session_grace
+    self.compress_level = compress_level
+    self.ping_interval = ping_interval
+    self.idle_timeout = idle_timeout
+    self.keepalive = keepalive
+    self.registration_timeout = registration_timeout
+    self.limits = ConnectionLimits(max_unregistered, max_per_ip)
+    self.stats_interval = stats_interval
+    self.admission = AdmissionController(max_connections, max_queued_bytes, max_latency)
+    self.memory = MemoryAccountant(memory_limit)
+    self.started = threading.Event()
+    if room_actors > 0:
+      self.database = ActorTable(
+        threading.Lock(), session_backlog, message_rate, message_burst,
+        broadcast_threshold, broadcast_workers, delivery, room_log_size, room_actors,
+        presence_interval=presence_interval)
+    elif table_shards > 0:
+      self.database = ShardedTable(
+        threading.Lock(), session_backlog, message_rate, message_burst,
+        broadcast_threshold, broadcast_workers, delivery, room_log_size, table_shards,
+        presence_interval=presence_interval)
+    else:
+      self.database = Table(threading.Lock(), session_backlog, message_rate, message_burst,
+                            broadcast_threshold, broadcast_workers, delivery,
+                            room_log_size, presence_interval)
     self.command_factory = CommandFactory()
     self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.host = ''
     self.port = port
     self.s.bind((self.host, self.port))
-    self.s.listen(1)
+    self.s.listen(backlog)
 
   def run(self):
     """ The main infinite loop of server. Once a client connects to the server,
         create a new thread for that client and start that thread immediately.
+        A connection over the limits, or arriving while the server is
+        overloaded, is sent an error status and closed without a thread.
     """
+    if self.admission.limited() or self.stats_interval > 0:
+      threading.Thread(target=self.__admission_thread, daemon=True).start()
+    if self.memory.limit > 0:
+      threading.Thread(target=self.__memory_thread, daemon=True).start()
+    if self.stats_interval > 0:
+      threading.Thread(target=self.__stats_thread, daemon=True).start()
+    self.started.set()
     while (1):
       conn, addr = self.s.accept()
+      status = self.admission.admit()
+      if status == None:
+        status = self.limits.admit(addr[0])
+      if status != None:
+        self.__reject(conn, status)
+        continue
+      if self.keepalive > 0:
+        enable_keepalive(conn, self.keepalive, max(1, self.keepalive // 6), 4)
       t = threading.Thread(target=self.client_connection, args=(conn, addr))
       t.start()
 
@@ -60,77 +158,135 @@ class Server:
         Registration phrase goes first. If client does not close the connection
         from registration pharse, then enter into communication phrase.
     """
-    communication_init_signal, remained_msgs = self.registration_phrase(conn, addr)
-    if communication_init_signal:
-      self.communication_phrase(
-        conn, addr, RunningSignal(communication_init_signal), remained_msgs)
+    if self.recorder:
+      self.recorder.open_connection(addr)
+    decoder = FrameDecoder()
+    registration = None
+    try:
+      registration = self.registration_phrase(conn, addr, decoder)
+      if registration:
+        self.limits.registered()
+        compressor = None
+        if 'deflate' in registration.options:
+          compressor = FrameCompressor(self.compress_level)
+        self.communication_phrase(
+          conn, addr, RunningSignal(True), decoder, compressor)
+    finally:
+      self.limits.release(addr[0], registration != None)
+    if self.recorder:
+      self.recorder.close_connection(addr)
 
-  def registration_phrase(self, conn, addr):
+  def registration_phrase(self, conn, addr, decoder: FrameDecoder):
     """ The registration phrase for the client. 
     
         If the client closes the connection during this phrase, this function
-        returns False to indicate communication phrase will not be entered.
+        returns None to indicate communication phrase will not be entered.
         
         Otherwise, this function receives client's message. For each message
         the client sent, this function treats message as RegistrationCommand,
         and attempting to parse. Once a valid registration occurs, in other words,
         the client's entity has been recorded into server's database successfully,
-        this function returns True with a list of unexecuted commands that are
-        to executed in the communication phrase.
+        this function returns the command, whose options apply to the rest of
+        the connection. Commands received after the registration
+        stay in decoder and are executed in the communication phrase.
+        A resume command in place of the registration reattaches a session
+        and also enters the communication phrase.
+
+        The whole phrase must end within registration_timeout seconds, however
+        slowly the client sends, or the connection is sent a 408 error code
+        and closed. A registration arriving while the server is overloaded is
+        sent a 503 error code and the connection closed; resuming a session
+        is still allowed.
     """
-    print('client is at', addr) 
-    init_signal = True
+    if self.verbose:
+      print('client is at', addr)
+    deadline = None
+    if self.registration_timeout > 0:
+      deadline = time.monotonic() + self.registration_timeout
     while(1):
-      client_msg = conn.recv(10240)
+      try:
+        if deadline != None:
+          conn.settimeout(max(0.001, deadline - time.monotonic()))
+        client_msg = conn.recv(10240)
+      except ConnectionError as _:
+        client_msg = b''
+      except socket.timeout as _:
+        self.__reject(conn, Status(408, "Registration timeout"))
+        return None
 
       if client_msg == b'':
-        init_signal = False   # client close the conn during registration
-        conn.close()
-        return init_signal, []
+        conn.close()    # client close the conn during registration
+        return None
 
-      # decode the message into string. Split the message into a list of 
-      # un-parsed commands (in case of multiple commands are received together)
-      client_msg = client_msg.decode(encoding="utf-8")
-      msg_pattern = re.compile('\$[^\$]+\$')
-      msg_list = msg_pattern.findall(client_msg)
-      print("addr: ", addr, "client message:", msg_list)
+      # Split the received bytes into commands. A command split across two
+      # reads stays in the decoder until the rest of it arrives.
+      decoder.feed(client_msg)
 
       # for each un-parsed command in the list, treat it as a registration command
       # (since at this point, the user entity has not been in database)
       # once a RegistrationCommand is executed and a success code 200 is returned,
       # this function returns and the rest of the commands are to execute in the
       # next phrase.
-      for index, msg in enumerate(msg_list):
-        msg = msg[1:-1]
-        registration = RegistrationCommand(msg, self.database)
+      for msg in decoder:
+        if self.verbose:
+          print("addr: ", addr, "client message:", msg)
+        if self.recorder:
+          self.recorder.inbound(addr, msg)
+        if msg[:5] == '00012':
+          registration = ResumeSession(msg, self.database)
+        else:
+          busy = self.admission.admit()
+          if busy != None:
+            self.__reject(conn, busy)
+            return None
+          registration = RegistrationCommand(msg, self.database)
         status = registration.execute(conn, addr)
-        conn.send(status.to_bytes())
+        data = status.to_bytes()
+        if self.recorder:
+          self.recorder.outbound(addr, data)
+        conn.send(data)
         
         if status.code == 200:
-          return init_signal, msg_list[index+1:]
+          return registration
           # now a user identity has been added into db
           # then go to concurrent receiving and sending stage...
 
+      # every complete frame has been taken out; what is left is the start
+      # of a frame whose closing '$' has not arrived yet
+      if len(decoder.buffer) > Server.MAX_REGISTRATION_FRAME:
+        self.__reject(conn, Status(400, "Bad command"))
+        return None
+
   def communication_phrase(self, conn, addr, signal: RunningSignal, 
-                           remained_msgs: list):
+                           decoder: FrameDecoder, compressor: FrameCompressor = None):
     """ The communication phrase for the client.
 
         This function will produce two child threads which are to run concurrently.
         One thread receives messages that are sent from connected client. The other 
         thread get all the messages in the user's message queue and clear the message
         queue, then convert all the message into bytes and send them back to client.
+        With a compressor, each batch taken from the queue is sent compressed.
+
+        A client that sends nothing for ping_interval seconds is sent a PING;
+        one that sends nothing, not even a pong, for idle_timeout seconds is
+        disconnected like a closed connection. A send that blocks that long
+        (the client stopped reading) ends the connection as well. The socket
+        timeout is left to sends; the receiving thread waits for input with
+        a selector instead.
     """
+    conn.settimeout(self.idle_timeout if self.idle_timeout > 0 else None)
+
     # the producer thread that generate messages that are to send to clients.
     # and enqueue them to message queue
     producer_thread = threading.Thread(
       target=self.__receiving_thread, 
-      args=(conn, addr, signal, remained_msgs))
+      args=(conn, addr, signal, decoder))
 
     # the consumer thread that fetch messages from client's message queue then 
     # send them back to client
     consumer_thread = threading.Thread(
       target=self.__sending_thread, 
-      args=(conn, addr, signal))
+      args=(conn, addr, signal, compressor))
     
     producer_thread.start()   
     consumer_thread.start()
@@ -139,84 +295,332 @@ class Server:
     consumer_thread.join()
 
     # once the user has disconnected, close the connection.
-    print(conn, addr, " joined")
+    if self.verbose:
+      print(conn, addr, " joined")
     conn.close()
 
   def __receiving_thread(self, conn, addr, signal: RunningSignal, 
-                         remained_msgs: list):
+                         decoder: FrameDecoder):
+    timeouts = [t for t in (self.ping_interval, self.idle_timeout) if t > 0]
+    wait = min(timeouts) if len(timeouts) != 0 else None
+    selector = selectors.DefaultSelector()
+    selector.register(conn, selectors.EVENT_READ)
+    last_seen = time.monotonic()
     while(signal.is_run()):
       try:
-        client_msg = conn.recv(10240)
+        # commands left over from the registration phrase run before the
+        # next read
+        msg_list = list(decoder)
+        if len(msg_list) == 0:
+          if len(selector.select(wait)) == 0:
+            if self.idle_timeout > 0 and time.monotonic() - last_seen >= self.idle_timeout:
+              self.__disconnect(conn, addr, signal)   # dead or silent peer
+              break
+            if self.ping_interval > 0:
+              ping = HeartbeatStatus(200, "ping", HeartbeatStatus.PING, str(int(time.time())))
+              self.database.enqueue_message(ping, [self.database.get_username_by_addr(addr)])
+            continue
+          client_msg = conn.recv(10240)
+          last_seen = time.monotonic()
+
+          if client_msg == b'':   # client closed without a disconnect command
+            self.__disconnect(conn, addr, signal)
+            break 
+
+          decoder.feed(client_msg)
+          msg_list = list(decoder)
+        if self.verbose:
+          print("addr: ", addr, "client message:", msg_list)
 
-        if client_msg == b'':
-          conn.close()
-          break 
-
-        client_msg = client_msg.decode(encoding="utf-8")
-        msg_pattern = re.compile('\$[^\$]+\$')
-        msg_list = msg_pattern.findall(client_msg)
-        if len(remained_msgs) != 0:
-          msg_list = remained_msgs + msg_list
-          remained_msgs = []
-        print("addr: ", addr, "client message:", msg_list)
-
-        for msg in msg_list:
-          msg = msg[1:-1]
-          cmd = self.command_factory.produce(msg, self.database)
-          status = cmd.execute(conn, addr)
-          if isinstance(status, DisconnectStatus) and status.code == 200:
-            # status.print()
-            signal.set_stop()
+        # the frames of one read run as a batch (see Table.batch)
+        with self.database.batch():
+          for msg in msg_list:
+            if self.recorder:
+              self.recorder.inbound(addr, msg)
+            started = time.perf_counter()
+            cmd = self.command_factory.produce(msg, self.database)
+            status = self.database.run_command(cmd, conn, addr)
+            self.admission.record_latency(time.perf_counter() - started)
+            if isinstance(status, DisconnectStatus) and status.code == 200:
+              # status.print()
+              signal.set_stop()
 
       except CommandError as _:
         status = Status(400, "Bad command")
-        self.database.enqueue_message(status, [self.database.conns[hash(addr)]])
-
-      except ConnectionResetError as _:
         try:
-          username_to_disconnect = self.database.get_username_by_addr(addr)
-          diconnect_bytes = '00010' + username_to_disconnect
-          disconn_cmd = UserDisconnect(diconnect_bytes, self.database)
-          status = disconn_cmd.execute(conn, addr)
-          signal.set_stop()
-        except AddrError as _:  # another thread has already cleared the connection record
+          self.database.enqueue_message(status, [self.database.get_username_by_addr(addr)])
+        except AddrError as _:  # detached or evicted since the command was read
           signal.set_stop()
-        
 
-  def __sending_thread(self, conn, addr, signal: RunningSignal):
+      except ConnectionError as _:
+        self.__disconnect(conn, addr, signal)
+
+      except AddrError as _:  # the sending thread has already disconnected the user
+        signal.set_stop()
+    selector.close()
+
+  def __sending_thread(self, conn, addr, signal: RunningSignal,
+                       compressor: FrameCompressor):
     run = True
     while(signal.is_run() and run):
       try:
         messages = self.database.flush_message_queue(addr)
         if messages == None:  # unblocked by disconnection_release
           run = False
+        elif compressor:      # one sync flush per batch
+          batch = []
+          for msg in messages:
+            data = msg.encoded()
+            if self.recorder:
+              self.recorder.outbound(addr, data)
+            batch.append(data)
+          conn.sendall(compressor.compress(b''.join(batch)))
         else:                 # unblocked by enqueu_message
           for msg in messages:  
-            conn.send(msg.to_bytes())
+            data = msg.encoded()
+            if self.recorder:
+              self.recorder.outbound(addr, data)
+            conn.sendall(data)
       
       except UserDisconnectedException as _:
         run = False
-
-      except ConnectionResetError as _:
         try:
-          diconnect_bytes = '00010' + self.database.get_username_by_addr(addr)
-          disconn_cmd = UserDisconnect(diconnect_bytes, self.database)
-          status = disconn_cmd.execute(conn, addr)
-          signal.set_stop()
-          run = False
-        except AddrError as _:  # another thread has already cleared the connection record
-          signal.set_stop()
-          run = False
+          conn.shutdown(socket.SHUT_RDWR)   # evicted: unblock the receiving thread
+        except OSError as _:
+          pass
+
+      except (ConnectionError, socket.timeout) as _:
+        self.__disconnect(conn, addr, signal)
+        run = False
+
+  def __disconnect(self, conn, addr, signal: RunningSignal):
+    """ Disconnect the user of a connection that ended without a disconnect
+        command (closed, reset or broken pipe) and stop both of its threads.
+        A user with a session is detached instead, and only disconnected if
+        the session is not resumed within session_grace seconds.
+        Both threads can get here for the same connection; the second one
+        finds the connection record already cleared.
+    """
+    try:
+      session = self.database.detach_user(addr)
+      if session == None:
+        diconnect_bytes = '00010' + self.database.get_username_by_addr(addr)
+        disconn_cmd = UserDisconnect(diconnect_bytes, self.database)
+        disconn_cmd.execute(conn, addr)
+      else:
+        token, detaches = session
+        expiry = threading.Timer(
+          self.session_grace, self.__expire_session, args=(token, detaches))
+        expiry.daemon = True
+        expiry.start()
+    except AddrError as _:  # another thread has already cleared the connection record
+      pass
+    signal.set_stop()
+    try:
+      conn.shutdown(socket.SHUT_RDWR)   # unblock a recv in the other thread
+    except OSError as _:
+      pass
+
+  def __admission_thread(self):
+    while True:
+      time.sleep(Server.ADMISSION_INTERVAL)
+      self.admission.update(self.limits.open, self.database.queued_bytes())
+
+  def __memory_thread(self):
+    while True:
+      time.sleep(Server.MEMORY_INTERVAL)
+      for username in self.memory.enforce(self.database):
+        MemoryEviction('00010' + username, self.database).execute(None, None)
+
+  def __stats_thread(self):
+    """ Print the server's counters every stats_interval seconds. The
+        server logs every command on stdout, so they go to stderr.
+    """
+    while True:
+      time.sleep(self.stats_interval)
+      flood, limited = self.database.flood_stats()
+      line = "[stats] messages allowed %d limited %d deliveries %d" % (
+        flood['allowed'], flood['limited'], flood['delivered'])
+      if len(limited) != 0:
+        line += " top limited: " + ", ".join(
+          name.strip() + " " + str(count) for name, count in limited)
+      print(line, file=sys.stderr)
+      print("[stats] connections %d queued %d bytes latency %.2f ms rejected busy %d" % (
+        self.admission.connections, self.admission.queued_bytes,
+        self.admission.latency * 1000, self.admission.rejected), file=sys.stderr)
+      broadcaster = self.database.broadcaster
+      if broadcaster != None:
+        print("[stats] broadcasts %d deliveries %d" % (
+          broadcaster.broadcasts, broadcaster.deliveries), file=sys.stderr)
+      presence = self.database.presence
+      if presence != None:
+        print("[stats] presence statuses coalesced %d digests %d" % (
+          presence.diverted, presence.digests), file=sys.stderr)
+      if self.database.delivery == 'log':
+        overruns, lagging = self.database.log_stats()
+        line = "[stats] room log messages missed %d" % overruns
+        if len(lagging) != 0:
+          line += " top lagging: " + ", ".join(
+            name.strip() + " " + str(lag) for name, lag in lagging)
+        print(line, file=sys.stderr)
+      if self.memory.limit > 0:
+        print("[stats] memory %d of %d bytes in %d users %d rooms trimmed %d evicted %d" % (
+          self.memory.total, self.memory.limit, len(self.memory.users),
+          len(self.memory.rooms), self.memory.trimmed, self.memory.evicted), file=sys.stderr)
+
+  def __reject(self, conn, status: Status):
+    """ Send status if the socket takes it right away and close conn.
+    """
+    try:
+      conn.setblocking(False)
+      conn.send(status.to_bytes())
+    except OSError as _:
+      pass
+    conn.close()
+
+  def __expire_session(self, token: str, detaches: int):
+    SessionExpiry('00010' + token, self.database, detaches).execute(None, None)
 
 
 def main():
-  if len(sys.argv) < 2:
-    print("USAGE:   echo_server_sockets.py <PORT>") 
-    sys.exit(0)
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    'port', type=int, help="port to listen on")
+
+  parser.add_argument(
+    '--session-grace', type=float, default=60.0,
+    help="seconds a session can be resumed after its connection is lost")
+
+  parser.add_argument(
+    '--session-backlog', type=int, default=256,
+    help="messages kept for a session while its connection is lost")
+
+  parser.add_argument(
+    '--backlog', type=int, default=128, help="accept queue length")
+
+  parser.add_argument(
+    '--registration-timeout', type=float, default=0,
+    help="seconds a new connection has to register, 0 for no deadline")
+
+  parser.add_argument(
+    '--max-unregistered', type=int, default=0,
+    help="connections allowed to be registering at once, 0 for no limit")
+
+  parser.add_argument(
+    '--max-per-ip', type=int, default=0,
+    help="open connections allowed per client IP address, 0 for no limit")
+
+  parser.add_argument(
+    '--max-connections', type=int, default=0,
+    help="live connections above which new clients are turned away, 0 for no limit")
+
+  parser.add_argument(
+    '--max-queued-bytes', type=int, default=0,
+    help="bytes waiting in queues above which new clients are turned away, 0 for no limit")
+
+  parser.add_argument(
+    '--max-latency', type=float, default=0,
+    help="mean command latency in seconds above which new clients are turned away, "
+         "0 for no limit")
+
+  parser.add_argument(
+    '--memory-limit', type=int, default=0,
+    help="estimated bytes of users, rooms and queues above which queues are trimmed "
+         "and the slowest readers evicted, 0 for no limit")
+
+  parser.add_argument(
+    '--broadcast-threshold', type=int, default=0,
+    help="members from which a room's messages are delivered by the broadcaster "
+         "threads, 0 to deliver all messages in the sender's thread")
+
+  parser.add_argument(
+    '--broadcast-workers', type=int, default=4, help="broadcaster threads")
+
+  parser.add_argument(
+    '--delivery', choices=('queue', 'log'), default='queue',
+    help="'queue' copies a room message into every member's queue, "
+         "'log' appends it once to the room's log that members read from")
+
+  parser.add_argument(
+    '--room-log-size', type=int, default=1024,
+    help="messages a room log keeps for members reading behind")
+
+  parser.add_argument(
+    '--room-actors', type=int, default=0,
+    help="actor threads that own the rooms and run their commands, "
+         "0 to run every command in its client's thread")
+
+  parser.add_argument(
+    '--table-shards', type=int, default=0,
+    help="lock shards of the rooms, users and connections, 0 for one lock; "
+         "not used with --room-actors")
+
+  parser.add_argument(
+    '--presence-interval', type=float, default=0,
+    help="seconds over which membership changes are coalesced for clients that "
+         "registered with the presence option, 0 to refuse the option; "
+         "the option is always refused with --delivery log")
+
+  parser.add_argument(
+    '--message-rate', type=float, default=0,
+    help="deliveries per second a user's messages may cause, 0 for no flood control")
+
+  parser.add_argument(
+    '--message-burst', type=float, default=10000.0,
+    help="deliveries a user's messages may cause at once")
+
+  parser.add_argument(
+    '--stats-interval', type=float, default=0,
+    help="seconds between counter lines on stderr, 0 for none")
+
+  parser.add_argument(
+    '--ping-interval', type=float, default=0,
+    help="seconds of client silence before a PING is sent, 0 to never ping")
+
+  parser.add_argument(
+    '--idle-timeout', type=float, default=0,
+    help="seconds of client silence before it is disconnected, 0 to never disconnect")
+
+  parser.add_argument(
+    '--keepalive', type=int, default=0,
+    help="seconds of silence before TCP keepalive probes, 0 to disable")
+
+  parser.add_argument(
+    '--compress-level', type=int, default=6,
+    help="zlib level for clients that register with the deflate option")
+
+  parser.add_argument(
+    '--capture', type=str, help="record all frames into this capture file for replay.py")
+
+  parser.add_argument(
+    '-v', '--verbose', action='store_true', help="print every connection and the frames it sends")
+
+  args = parser.parse_args()
 
-  port = int(sys.argv[1])
-  server = Server(port)
-  server.run()
+  recorder = None
+  if args.capture:
+    recorder = CaptureRecorder(args.capture)
+  server = Server(
+    args.port, recorder, session_grace=args.session_grace,
+    session_backlog=args.session_backlog, compress_level=args.compress_level,
+    ping_interval=args.ping_interval, idle_timeout=args.idle_timeout,
+    keepalive=args.keepalive, registration_timeout=args.registration_timeout,
+    max_unregistered=args.max_unregistered, max_per_ip=args.max_per_ip,
+    backlog=args.backlog, message_rate=args.message_rate,
+    message_burst=args.message_burst, stats_interval=args.stats_interval,
+    max_connections=args.max_connections, max_queued_bytes=args.max_queued_bytes,
+    max_latency=args.max_latency, memory_limit=args.memory_limit,
+    broadcast_threshold=args.broadcast_threshold,
+    broadcast_workers=args.broadcast_workers, delivery=args.delivery,
+    room_log_size=args.room_log_size, room_actors=args.room_actors,
+    table_shards=args.table_shards, presence_interval=args.presence_interval,
+    verbose=args.verbose)
+  try:
+    server.run()
+  finally:
+    if recorder:
+      recorder.close()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,72 @@
 # Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
 
+import collections
+import contextlib
+import itertools
+import secrets
 import socket
-import sys
 import threading
+import time
+import traceback
 from status import (
-  CommandError, UserDisconnectedException, Status, RegistrationStatus, 
-  JoinStatus, MessageStatus, DisconnectStatus, LeaveStatus, AddrError)
-from message import (
-  Msg, RegistrationCommand, JoinCommand, CommandFactory, UserDisconnect)
+  UserDisconnectedException, Status, RegistrationStatus, JoinStatus, DisconnectStatus,
+  LeaveStatus, ResumeStatus, AddrError, PressureStatus, PresenceStatus)
+
+
+def enable_keepalive(sock, idle: int, interval: int, count: int):
+  """ Turn on TCP keepalive for sock: the first probe is sent after idle
+      seconds without traffic, then every interval seconds, and the
+      connection is reset after count unanswered probes. The timing options
+      are set only where the platform has them.
+  """
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+  for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+                        ('TCP_KEEPCNT', count)):
+    if hasattr(socket, option):
+      sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class TokenBucket:
+  """ Flood control for the messages of one user. Tokens refill at rate per
+      second up to burst; a message costs one token per delivery it causes.
+      A message costing more than burst is allowed once the bucket is full
+      and leaves it in debt, so its full cost is still paid.
+
+      Attributes:
+        tokens (float)  : tokens available, negative while in debt
+        allowed (int)   : messages allowed
+        limited (int)   : messages refused
+        delivered (int) : deliveries charged for the allowed messages
+  """
+  def __init__(self, rate: float, burst: float):
+    self.rate      = rate
+    self.burst     = burst
+    self.tokens    = burst
+    self.time      = time.monotonic()
+    self.allowed   = 0
+    self.limited   = 0
+    self.delivered = 0
+    self.lock      = threading.Lock()
+
+  def consume(self, cost: int):
+    """ Take cost tokens. Return 0 if they were taken, or the seconds to
+        wait until they can be.
+    """
+    self.lock.acquire()
+    try:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+      self.time = now
+      needed = min(cost, self.burst)
+      if self.tokens >= needed:
+        self.tokens -= cost
+        self.allowed += 1
+        self.delivered += cost
+        return 0
+      self.limited += 1
+      return (needed - self.tokens) / self.rate
+    finally:
+      self.lock.release()
 
 
 class User:
@@ -23,6 +82,25 @@ class User:
                                        queue is not empty
         msg_queue (list)             : message queue that stores Status object
         is_disconnected (bool)       : indicates if the user has disconnected
+        token (str)                  : session token to resume with, or None
+        detached (bool)              : True while the connection of a user
+                                       with a session is gone and the session
+                                       waits to be resumed
+        detaches (int)               : number of times the session detached
+        backlog (int)                : queue size kept while detached
+        dropped (int)                : messages dropped since detaching
+        bucket (TokenBucket)         : flood control of the user's messages,
+                                       or None when not limited
+        queued_bytes (int)           : encoded size of the queued messages
+        queued_since (float)         : time.monotonic() the oldest queued
+                                       message was queued, None while the
+                                       queue is empty
+        cursors (dict)               : mapping room name to the RoomLog of
+                                       the room and the sequence number of
+                                       the next message to read from it,
+                                       for rooms delivering through a log
+        presence (bool)              : True if the user gets membership
+                                       changes as PresenceStatus digests
   """
   def __init__(self, username, conn, addr):
     self.name      = username
@@ -32,30 +110,117 @@ class User:
     self.has_msg   = threading.Condition(self.lock)
     self.msg_queue = []
     self.is_disconnected = False
+    self.token     = None
+    self.detached  = False
+    self.detaches  = 0
+    self.backlog   = 0
+    self.dropped   = 0
+    self.bucket    = None
+    self.queued_bytes = 0
+    self.queued_since = None
+    self.cursors      = {}
+    self.presence     = False
 
-  def get_messages(self):
-    """ Block until message queue is not empty. Return all the messages
-        and empty the message queue.
+  def get_messages(self, addr=None):
+    """ Block until message queue is not empty or a room log has messages
+        past the user's cursor. Return all the messages in the order they
+        were sent, and empty the message queue. The room log messages are
+        newer than the queued ones, since enqueue_messages moves what the
+        logs hold into the queue first.
+        If addr is given and the user is no longer connected from addr
+        (the session was resumed on another connection), return None.
     """
     self.has_msg.acquire()
     try:
-      while len(self.msg_queue) <= 0 and not self.is_disconnected:
+      while True:
+        if self.is_disconnected or (addr != None and self.addr != addr):
+          return None
+        logged = self.__read_logs()
+        if len(self.msg_queue) > 0 or len(logged) > 0:
+          break
         self.has_msg.wait()
-      if not self.is_disconnected:
-        messages = [msg for msg in self.msg_queue]
-        self.msg_queue = []
-        return messages
-      else:
-        return None
+      messages = self.msg_queue + logged
+      self.msg_queue = []
+      self.queued_bytes = 0
+      self.queued_since = None
+      return messages
     finally:
       self.has_msg.release()
+
+  def follow(self, roomName: str, log):
+    """ Start reading the room log of roomName at its next message. A
+        blocked get_messages is woken to wait on the new log as well.
+    """
+    self.lock.acquire()
+    self.cursors[roomName] = [log, log.next]
+    self.has_msg.notify()
+    self.lock.release()
+
+  def unfollow(self, roomName: str):
+    self.lock.acquire()
+    self.cursors.pop(roomName, None)
+    self.lock.release()
+
+  def wake(self):
+    """ Unblock get_messages to read the room logs again.
+    """
+    self.lock.acquire()
+    self.has_msg.notify()
+    self.lock.release()
+
+  def log_lag(self):
+    """ Return the most messages the user is behind in one room log.
+    """
+    self.lock.acquire()
+    lag = max([log.next - cursor for log, cursor in self.cursors.values()], default=0)
+    self.lock.release()
+    return lag
+
+  def __read_logs(self):
+    """ Read the room logs past the cursors, in the order the messages were
+        appended. Messages a log dropped before they were read are
+        reported by a 507 status in front of them.
+    """
+    entries = []
+    missed  = 0
+    for cursor in self.cursors.values():
+      new, cursor[1], lost = cursor[0].read(cursor[1], self)
+      entries.extend(new)
+      missed += lost
+    entries.sort(key=lambda entry: entry[0])
+    messages = [msg for _, msg in entries]
+    if missed != 0:
+      messages.insert(0, PressureStatus(507, "Reading too slowly, room messages dropped", missed))
+    return messages
       
   def enqueue_message(self, msg: Status):
     """ Enqueue an Status object into msg_queue, also notify conditional
         variable. 
     """
+    self.enqueue_messages([msg])
+
+  def enqueue_messages(self, msgs: list):
+    """ Enqueue Status objects in order, taking the lock and notifying
+        the conditional variable once for all of them. The messages the
+        followed room logs hold past the cursors are sent before them, so
+        they are queued first.
+    """
+    sizes = [len(msg.encoded()) for msg in msgs]
     self.lock.acquire()
-    self.msg_queue.append(msg)
+    if len(self.cursors) != 0:
+      logged = self.__read_logs()
+      msgs = logged + msgs
+      sizes = [len(msg.encoded()) for msg in logged] + sizes
+    if self.queued_since == None and len(msgs) != 0:
+      self.queued_since = time.monotonic()
+    self.msg_queue.extend(msgs)
+    self.queued_bytes += sum(sizes)
+    if self.detached and len(self.msg_queue) > self.backlog:
+      dropped = len(self.msg_queue) - self.backlog
+      for msg in self.msg_queue[:dropped]:
+        self.queued_bytes -= len(msg.encoded())
+      del self.msg_queue[:dropped]   # keep the newest backlog messages
+      self.dropped += dropped
     self.has_msg.notify()
     self.lock.release()
 
@@ -67,32 +232,671 @@ class User:
     self.is_disconnected = True
     self.has_msg.notify()
     self.lock.release()
+
+  def detach(self, backlog: int):
+    """ The connection is gone but the session is kept: release the sending
+        thread like disconnection_release, and from now on keep at most
+        backlog messages in the queue for a resume.
+    """
+    self.lock.acquire()
+    self.conn     = None
+    self.addr     = None
+    self.detached = True
+    self.detaches += 1
+    self.backlog  = backlog
+    self.dropped  = max(0, len(self.msg_queue) - backlog)
+    for msg in self.msg_queue[:self.dropped]:
+      self.queued_bytes -= len(msg.encoded())
+    del self.msg_queue[:self.dropped]
+    self.is_disconnected = True
+    self.has_msg.notify()
+    self.lock.release()
+
+  def attach(self, conn, addr):
+    """ Resume a detached session on a new connection. The queued messages
+        are sent by the new sending thread. Return the number of messages
+        dropped while detached.
+    """
+    self.lock.acquire()
+    self.conn     = conn
+    self.addr     = addr
+    self.detached = False
+    self.is_disconnected = False
+    dropped = self.dropped
+    self.dropped  = 0
+    self.lock.release()
+    return dropped
+
+  def trim(self, keep: int):
+    """ Drop the oldest queued messages so that at most keep are left.
+        Return the number of messages dropped and the bytes they took.
+    """
+    self.lock.acquire()
+    dropped = max(0, len(self.msg_queue) - keep)
+    freed = 0
+    for msg in self.msg_queue[:dropped]:
+      freed += len(msg.encoded())
+    del self.msg_queue[:dropped]
+    self.queued_bytes -= freed
+    self.lock.release()
+    return dropped, freed
+
+  def evict(self, notice: Status):
+    """ Empty the queue of a user removed to free memory. A connected
+        user's sending thread still gets notice, then finds the user gone.
+    """
+    self.lock.acquire()
+    self.msg_queue = [] if self.detached else [notice]
+    self.queued_bytes = 0
+    self.queued_since = None if self.detached else time.monotonic()
+    self.is_disconnected = self.detached
+    self.has_msg.notify()
+    self.lock.release()
     
 
+class Broadcaster:
+  """ Delivers messages to large rooms on a pool of worker threads, so the
+      thread of the sender does not run the fan-out. A room is always
+      handled by the same worker, in submission order, which keeps the
+      order of the room's messages. A worker takes all the messages waiting
+      for it at once and enqueues them with one lock and notify per
+      receiver.
+
+      Attributes:
+        threshold (int)  : members from which a room's messages are
+                           handed to the workers
+        queues (list)    : per worker, the (room, message, receivers)
+                           waiting to be delivered
+        pending (list)   : per worker, mapping room name to its messages
+                           submitted and not yet delivered
+        has_work (list)  : per worker, the Condition for its queue
+        broadcasts (int) : messages delivered by the workers
+        deliveries (int) : receivers the workers enqueued to
+  """
+  def __init__(self, workers: int, threshold: int, deliver):
+    self.threshold  = threshold
+    self.deliver    = deliver
+    self.queues     = [[] for _ in range(workers)]
+    self.pending    = [{} for _ in range(workers)]
+    self.has_work   = [threading.Condition() for _ in range(workers)]
+    self.broadcasts = 0
+    self.deliveries = 0
+    for index in range(workers):
+      threading.Thread(target=self.__worker, args=(index,), daemon=True).start()
+
+  def submit(self, room: str, message: Status, receivers: set, before=None):
+    """ Hand the delivery of message to the worker of room if the room has
+        threshold members or more, or messages still waiting, and return
+        True; return False if the caller has to deliver it. If the message
+        is taken, before() is called first, while no worker can deliver it
+        yet.
+    """
+    index = hash(room) % len(self.queues)
+    pending = self.pending[index]
+    self.has_work[index].acquire()
+    taken = len(receivers) >= self.threshold or room in pending
+    if taken:
+      if before != None:
+        before()
+      self.queues[index].append((room, message, receivers))
+      pending[room] = pending.get(room, 0) + 1
+      self.has_work[index].notify()
+    self.has_work[index].release()
+    return taken
+
+  def __worker(self, index: int):
+    has_work = self.has_work[index]
+    pending  = self.pending[index]
+    while True:
+      has_work.acquire()
+      while len(self.queues[index]) == 0:
+        has_work.wait()
+      jobs = self.queues[index]
+      self.queues[index] = []
+      has_work.release()
+
+      batches = {}
+      deliveries = 0
+      for _, message, receivers in jobs:
+        deliveries += len(receivers)
+        for receiver in receivers:
+          batches.setdefault(receiver, []).append(message)
+      self.deliver(batches)
+
+      has_work.acquire()
+      self.broadcasts += len(jobs)
+      self.deliveries += deliveries
+      for room, _, _ in jobs:
+        pending[room] -= 1
+        if pending[room] == 0:
+          del pending[room]
+      has_work.release()
+
+
+class PresenceAggregator:
+  """ Coalesces the join, leave and disconnect statuses of each room over
+      interval seconds. Members that opted in get them as one
+      PresenceStatus per room per tick; a user joining and leaving within
+      one tick cancels out. The user whose membership changed, and members
+      that did not opt in, still get the individual status right away.
+
+      Attributes:
+        pending (dict)   : mapping room name to a dict mapping user name to
+                           True if the user joined in this tick, False if
+                           it left
+        diverted (int)   : individual statuses replaced by digests
+        digests (int)    : digests sent
+  """
+  def __init__(self, interval: float, deliver):
+    self.interval = interval
+    self.deliver  = deliver
+    self.pending  = {}
+    self.diverted = 0
+    self.digests  = 0
+    self.lock     = threading.Lock()
+    threading.Thread(target=self.__ticker, daemon=True).start()
+
+  @staticmethod
+  def is_change(message: Status):
+    return (message.code == 200
+            and isinstance(message, (JoinStatus, LeaveStatus, DisconnectStatus)))
+
+  def divert(self, roomName: str, message: Status, receivers, subscribers: set):
+    """ Record message, a membership change, for the subscribers among
+        receivers. Return the receivers that still get message.
+    """
+    subscribers = subscribers - { message.username }
+    if len(subscribers) == 0:
+      return receivers
+    joined = isinstance(message, JoinStatus)
+    self.lock.acquire()
+    changes = self.pending.setdefault(roomName, {})
+    if changes.get(message.username, joined) != joined:
+      del changes[message.username]   # joined and left within the tick
+    else:
+      changes[message.username] = joined
+    self.diverted += len(subscribers)
+    self.lock.release()
+    return [receiver for receiver in receivers if receiver not in subscribers]
+
+  def __ticker(self):
+    while True:
+      time.sleep(self.interval)
+      self.lock.acquire()
+      pending = self.pending
+      self.pending = {}
+      self.lock.release()
+      for roomName in pending:
+        changes = pending[roomName]
+        if len(changes) == 0:
+          continue
+        joined = { username for username in changes if changes[username] }
+        left   = { username for username in changes if not changes[username] }
+        self.deliver(roomName, PresenceStatus(200, "success", roomName, joined, left))
+        self.digests += 1
+
+
+class RoomLog:
+  """ The messages sent to a room in delivery mode 'log': a ring of the
+      newest capacity messages, read by every member's sending thread from
+      its own cursor, so a message costs one append whatever the size of
+      the room. A reader that finds nothing new is woken by the next append.
+      A reader more than capacity messages behind misses the oldest ones.
+
+      Attributes:
+        entries (deque)  : (stamp, message) of the newest messages, where
+                           stamp orders messages across rooms
+        next (int)       : sequence number of the next message appended
+        size (int)       : encoded size of the messages in the ring
+        waiting (set)    : User objects to wake at the next append
+        overruns (int)   : messages readers missed
+  """
+  def __init__(self, capacity: int, stamps):
+    self.entries  = collections.deque(maxlen=capacity)
+    self.stamps   = stamps
+    self.next     = 0
+    self.size     = 0
+    self.waiting  = set()
+    self.overruns = 0
+    self.lock     = threading.Lock()
+
+  def append(self, message: Status):
+    self.lock.acquire()
+    if len(self.entries) == self.entries.maxlen:
+      self.size -= len(self.entries[0][1].encoded())
+    self.entries.append((next(self.stamps), message))
+    self.size += len(message.encoded())
+    self.next += 1
+    waiting = self.waiting
+    self.waiting = set()
+    self.lock.release()
+    for user in waiting:
+      user.wake()
+
+  def read(self, cursor: int, reader: User):
+    """ Return the (stamp, message) entries from sequence number cursor
+        on, the cursor past them and the number of messages that were
+        dropped before reader got to them. If there is nothing to read,
+        reader is woken by the next append.
+    """
+    self.lock.acquire()
+    start  = self.next - len(self.entries)
+    missed = max(0, start - cursor)
+    cursor = max(cursor, start)
+    entries = list(itertools.islice(self.entries, cursor - start, None))
+    if len(entries) == 0:
+      self.waiting.add(reader)
+    self.overruns += missed
+    self.lock.release()
+    return entries, cursor + len(entries), missed
+
+
 class Room:
 
-  def __init__(self, roomName: str, creator: User):
+  def __init__(self, roomName: str, creator: User, log: RoomLog = None):
     self.name    = roomName
     self.creator = creator
     self.users   = {}
-    self.users[creator.name] = creator
+    self.log     = log
+    self.join(creator)
 
   def join(self, user: User):
     self.users[user.name] = user
+    if self.log != None:
+      user.follow(self.name, self.log)
 
   def leave(self, username: str):
     """ Remove a user from user dict. If user doesn't exist in this room,
         remove nothing and return False. Otherwise, return True.
     """
     if username in self.users:
+      if self.log != None:
+        self.users[username].unfollow(self.name)
       del self.users[username]
       return True
     return False
 
 
-class Table:
+class BaseTable:
+  """ The part of the server's data structure that does not depend on how
+      users, connections and rooms are stored and locked: sessions, flood
+      control counters, batching, room delivery and statistics. Table keeps
+      everything behind one lock and ShardedTable splits it into shards;
+      both provide the lookups below that the shared code goes through.
+
+      Attributes:
+        sessions (dict)      : mapping session token to user name
+        backlog (int)        : messages kept for a detached session
+        message_rate (float) : deliveries per second a user's messages may
+                               cause, 0 for no flood control
+        message_burst (float): deliveries a user may cause at once
+        flood (dict)         : allowed and limited counts and deliveries of
+                               users that are gone
+        broadcaster (Broadcaster): delivers the messages of large rooms,
+                               or None to deliver all of them inline
+        delivery (str)       : 'queue' to copy a room message into every
+                               member's queue, 'log' to append it to the
+                               room's RoomLog
+        log_size (int)       : messages a RoomLog keeps
+        batching (threading.local): per thread, the messages held back by
+                               batch() for each receiver
+        presence (PresenceAggregator): coalesces membership changes for
+                               users with presence digests, or None; every
+                               member reads the same RoomLog, so there is
+                               none in delivery mode 'log'
+        lock (threading.Lock): lock for sessions and flood counters
+  """
+  def __init__(self, lock, backlog: int = 256, message_rate: float = 0,
+               message_burst: float = 0, broadcast_threshold: int = 0,
+               broadcast_workers: int = 4, delivery: str = 'queue',
+               log_size: int = 1024, presence_interval: float = 0):
+    self.sessions   = {}
+    self.backlog    = backlog
+    self.message_rate  = message_rate
+    self.message_burst = message_burst
+    self.flood      = { 'allowed': 0, 'limited': 0, 'delivered': 0 }
+    self.lock       = lock
+    self.delivery   = delivery
+    self.log_size   = log_size
+    self.stamps     = itertools.count()
+    self.batching   = threading.local()
+    self.broadcaster = None
+    if broadcast_threshold > 0:
+      self.broadcaster = Broadcaster(
+        broadcast_workers, broadcast_threshold, self.enqueue_batches)
+    self.presence   = None
+    if presence_interval > 0 and delivery != 'log':
+      self.presence = PresenceAggregator(presence_interval, self.deliver_digest)
+
+  def has_presence(self):
+    """ Return True if membership changes can be sent as PresenceStatus
+        digests.
+    """
+    return self.presence != None
+
+  def set_presence(self, username: str, on: bool):
+    """ Choose whether username gets membership changes of its rooms as
+        PresenceStatus digests.
+    """
+    user = self._get_user(username)
+    if user != None:
+      user.presence = on
+
+  def open_session(self, username: str):
+    """ Issue a session token for a registered user. Return the token, or
+        None if the user does not exist.
+    """
+    user = self._get_user(username)
+    if user == None:
+      return None
+    token = secrets.token_hex(8)
+    self.lock.acquire()
+    user.token = token
+    self.sessions[token] = username
+    self.lock.release()
+    return token
+
+  def list_rooms(self):
+    return set(self._map_rooms(lambda room: room.name))
+
+  def list_room_users(self, roomName: str):
+    return self._in_room(roomName, lambda room: set(room.users) if room != None else set())
+
+  def charge_messages(self, username: str, cost: int):
+    """ Charge the flood control of username for a message causing cost
+        deliveries. Return 0 if the message may be sent, or the seconds to
+        wait before it may.
+    """
+    user = self._get_user(username)
+    if user == None or user.bucket == None:
+      return 0
+    return user.bucket.consume(cost)
+
+  def flood_stats(self, top: int = 5):
+    """ Return the flood control counters of all users, present and gone,
+        and the top users by limited messages as (username, limited).
+    """
+    self.lock.acquire()
+    totals = dict(self.flood)
+    self.lock.release()
+    limited = []
+    for user in self._all_users():
+      if user.bucket != None:
+        totals['allowed']   += user.bucket.allowed
+        totals['limited']   += user.bucket.limited
+        totals['delivered'] += user.bucket.delivered
+        if user.bucket.limited != 0:
+          limited.append((user.name, user.bucket.limited))
+    limited.sort(key=lambda item: item[1], reverse=True)
+    return totals, limited[:top]
+
+  def log_stats(self, top: int = 5):
+    """ Return the messages readers missed in all room logs, and the top
+        users by how far behind they read as (username, messages).
+    """
+    overruns = sum(self._map_rooms(lambda room: room.log.overruns if room.log != None else 0))
+    lagging = [(user.name, user.log_lag()) for user in self._all_users()]
+    lagging = [item for item in lagging if item[1] != 0]
+    lagging.sort(key=lambda item: item[1], reverse=True)
+    return overruns, lagging[:top]
+
+  def queued_bytes(self):
+    """ Return the encoded size of all the messages waiting in queues.
+    """
+    return sum(user.queued_bytes for user in self._all_users())
+
+  def memory_usage(self):
+    """ Return what the memory accountant needs to estimate the memory the
+        table holds: a list of (username, queued messages, queued bytes,
+        rooms joined, seconds the oldest queued message has waited, detached)
+        for every user, and a dict mapping room name to its number of
+        members and the messages and bytes in its log.
+    """
+    now = time.monotonic()
+    rooms = {}
+    memberships = {}
+    for name, size, messages, log_bytes, members in self._map_rooms(lambda room: (
+        room.name, len(room.users),
+        len(room.log.entries) if room.log != None else 0,
+        room.log.size if room.log != None else 0, list(room.users))):
+      rooms[name] = (size, messages, log_bytes)
+      for username in members:
+        memberships[username] = memberships.get(username, 0) + 1
+    users = []
+    for user in self._all_users():
+      waited = now - user.queued_since if user.queued_since != None else 0.0
+      users.append((user.name, len(user.msg_queue), user.queued_bytes,
+                    memberships.get(user.name, 0), waited, user.detached))
+    return users, rooms
+
+  def trim_queue(self, username: str, keep: int):
+    """ Drop the oldest messages queued for username so that at most keep
+        are left. Return the number of messages dropped and their bytes.
+    """
+    user = self._get_user(username)
+    if user == None:
+      return 0, 0
+    return user.trim(keep)
+
+  def enqueue_message(self, message: Status, receivers: list):
+    """ Enqueue a message object in to target users' message queue given in the
+        receiver list. Inside batch() the message is held back until the
+        batch ends.
+    """
+    pending = getattr(self.batching, 'pending', None)
+    if pending != None:
+      for receiver in receivers:
+        pending.setdefault(receiver, []).append(message)
+      return
+    for user in self._get_users(receivers):
+      user.enqueue_message(message)
+
+  @contextlib.contextmanager
+  def batch(self):
+    """ Run the commands of one read from a client as a batch: the
+        messages they enqueue are kept per receiver and enqueued at the
+        end, in order, with one lock and notify of each receiver's queue.
+        The commands still take the locks for each change of the table, so
+        other clients and the broadcaster are not held up by the batch. A
+        room message the broadcaster or a room log takes gets what is held
+        for its receivers enqueued first, so the messages keep their order.
+        Batches of one thread do not nest.
+    """
+    self.batching.pending = {}
+    try:
+      yield
+    finally:
+      pending = self.batching.pending
+      self.batching.pending = None
+      self.enqueue_batches(pending)
+
+  def run_command(self, cmd, conn, addr):
+    """ Run cmd, a command the connection at addr sent, and return its
+        status. Table runs it right away in the calling thread; ActorTable
+        hands it to the actors of the rooms it touches.
+    """
+    return cmd.execute(conn, addr)
+
+  def run_in_rooms(self, roomNames: list, job):
+    """ Run job, work on the rooms roomNames that no connection waits for,
+        like the notifications of a disconnection. Table runs it right away
+        in the calling thread; ActorTable hands it to the rooms' actors.
+    """
+    job()
+
+  def deliver_to_room(self, roomName: str, message: Status, receivers: set):
+    """ Enqueue a message sent to a room to the room's receivers. The
+        messages of large rooms are delivered by the broadcaster. In
+        delivery mode 'log' the message is appended to the room's log
+        instead, and only receivers that are not members of the room (a
+        user that just left) get it in their queue. Otherwise membership
+        changes go to users with presence digests through the presence
+        aggregator.
+    """
+    if self.presence != None and PresenceAggregator.is_change(message):
+      subscribers = { user.name for user in self._get_users(receivers) if user.presence }
+      receivers = self.presence.divert(roomName, message, receivers, subscribers)
+    if self.delivery == 'log':
+      room, outsiders = self._in_room(roomName, lambda room: (room, [
+        receiver for receiver in receivers if room == None or receiver not in room.users]))
+      if room != None:
+        self._release_held(receivers)   # what the batch holds was sent before
+        room.log.append(message)
+      self.enqueue_message(message, outsiders)
+    elif self.broadcaster == None or not self.broadcaster.submit(
+        roomName, message, receivers, lambda: self._release_held(receivers)):
+      self.enqueue_message(message, receivers)
+
+  def deliver_digest(self, roomName: str, digest: PresenceStatus):
+    """ Deliver a presence digest to the members of the room that want it.
+    """
+    subscribers = self._in_room(roomName, lambda room: set() if room == None else
+      { name for name in room.users if room.users[name].presence })
+    self.deliver_to_room(roomName, digest, subscribers)
+
+  def enqueue_batches(self, batches: dict):
+    """ Enqueue the list of message objects batches maps every receiver to,
+        with one lock of each receiver's queue.
+    """
+    for user in self._get_users(batches):
+      user.enqueue_messages(batches[user.name])
+
+  def _release_held(self, receivers: set = None):
+    """ Enqueue now what the batch of this thread holds for receivers, or
+        for everyone, ahead of messages to them another thread is taking;
+        the rest of the batch is still enqueued at its end.
+    """
+    pending = getattr(self.batching, 'pending', None)
+    if pending == None:
+      return
+    if receivers == None:
+      receivers = list(pending)
+    held = { receiver: pending.pop(receiver) for receiver in receivers if receiver in pending }
+    if len(held) != 0:
+      self.enqueue_batches(held)
+
+  def flush_message_queue(self, addr):
+    """ Return a list of message objects that are to send back to client at
+        address addr.
+        __NOTE__:
+        This function call will be blocked until the message queue of user
+        at addr has already been enqueued some Status object.
+    """
+    username = self._username_at(addr)
+    user = self._get_user(username) if username != None else None
+    if user == None:
+      # the user has been removed but the conn entry may not be cleared yet
+      raise UserDisconnectedException
+    return user.get_messages(addr) # return when message available
+
+  def has_room(self, roomName: str):
+    """ Helper function for code outside of the Table object determine whether
+        the room exist in current rooms dict.
+        The code outside of the Table object must use this function instead of
+        access rooms dict directly without acquiring a lock.
+    """
+    return self._in_room(roomName, lambda room: room != None)
+
+  def has_username(self, username: str):
+    """ Helper function for code outside of the Table object determine whether
+        the username exist in current users dict.
+        The code outside of the Table object must use this function instead of
+        access users dict directly without acquiring a lock.
+    """
+    return self._get_user(username) != None
+
+  def has_addr(self, addr):
+    """ Helper function for code outside of the Table object determine whether
+        the given addr exist in current conns dict.
+        The code outside of the Table object must use this function instead of
+        access conns dict directly without acquiring a lock.
+    """
+    return self._username_at(addr) != None
+
+  def get_username_by_addr(self, addr):
+    """ Return username that corresponds to given address.
+        This function should always be called after validate the given addr.
+        If the hash of addr is not presented, it is an internal error of
+        our server code except ConnectionResetError, in which case the AddrError
+        exception should be handled. In other cases, the addr must have a
+        corresponding username in the database after registration.
+    """
+    username = self._username_at(addr)
+    if username == None:
+      # error occurs due to server code itself except the server handle
+      # ConnectionResetError. This is because two thread can catch ConnectionResetError
+      # concurrently, and one of the thread can clear user's connection record first.
+      # and another thread will catch this AddrError exception.
+      raise AddrError()
+    return username
+
+  def _get_user(self, username: str):
+    """ Return the User object of username, or None.
+    """
+    raise NotImplementedError
+
+  def _get_users(self, usernames):
+    """ Return the User objects of usernames that exist.
+    """
+    raise NotImplementedError
+
+  def _all_users(self):
+    """ Return a list of all the User objects.
+    """
+    raise NotImplementedError
+
+  def _username_at(self, addr):
+    """ Return the name of the user connected from addr, or None.
+    """
+    raise NotImplementedError
+
+  def _in_room(self, roomName: str, visit):
+    """ Return visit(room), called with the Room object of roomName, or
+        None, while the room cannot change.
+    """
+    raise NotImplementedError
+
+  def _map_rooms(self, visit):
+    """ Return the list of visit(room) for every room, each called while
+        the room cannot change.
+    """
+    raise NotImplementedError
+
+  @staticmethod
+  def _valid_name(name: str, error: str):
+    if len(name) != 20:
+      return Status(403, error)
+    for c in range(len(name)):
+      if name[c] in { '$', '#', '&' }:
+        return Status(403, error)
+    return Status(200, "success")
+
+  def _retire_bucket(self, user: User):
+    """ Add the flood counters of a user that is gone to flood. Called with
+        lock held.
+    """
+    if user.bucket != None:
+      self.flood['allowed']   += user.bucket.allowed
+      self.flood['limited']   += user.bucket.limited
+      self.flood['delivered'] += user.bucket.delivered
+
+  def __str__(self):
+    string = "users:\n"
+    for user in self._all_users():
+      string += user.name + "  " + str(user.addr) + '\n'
+    string += "\n"
+    for room in self._map_rooms(lambda room: (room.name, list(room.users.values()))):
+      string += room[0] + ":\n"
+      for user in room[1]:
+        string += user.name + "  " + str(user.addr) + '\n'
+      string += "\n"
+    return string
+
+
+class Table(BaseTable):
   """ The concurrent data structure for storeing user, room, connection
-      data. 
+      data. Everything is kept behind one lock; see BaseTable for what is
+      shared with ShardedTable.
 
       Attributes:
         rooms (dict)         : mapping room name to Room object
@@ -100,20 +904,25 @@ class Table:
         conns (dict)         : mapping address to user name
         lock (threading.Lock): lock for concurrent data structure
   """
-  def __init__(self, lock):
+  def __init__(self, lock, backlog: int = 256, message_rate: float = 0,
+               message_burst: float = 0, broadcast_threshold: int = 0,
+               broadcast_workers: int = 4, delivery: str = 'queue',
+               log_size: int = 1024, presence_interval: float = 0):
+    super().__init__(lock, backlog, message_rate, message_burst, broadcast_threshold,
+                     broadcast_workers, delivery, log_size, presence_interval)
     self.rooms      = {}
     self.users      = {}
     self.conns      = {}
-    self.lock       = lock
-    
+
   def user_registration(self, username: str, conn, addr):
     self.lock.acquire()
     status = self.__valid_registration(username, addr)
     if status.code not in { 401, 402, 403 }:
       self.users[username] = User(username, conn, addr)
+      if self.message_rate > 0:
+        self.users[username].bucket = TokenBucket(
+          self.message_rate, max(1, self.message_burst))
       self.conns[hash(addr)] = username
-      print("hash", addr, hash(addr))
-      print(self)
     self.lock.release()
     return status
 
@@ -134,10 +943,77 @@ class Table:
     if status.code == 200:
       # flush_message_queue will be returned
       self.users[username].disconnection_release()  
+      self.sessions.pop(self.users[username].token, None)
+      self._retire_bucket(self.users[username])
       del self.users[username]
     self.lock.release()
     return to_notify, status
 
+  def detach_user(self, addr):
+    """ Detach the user at addr from its lost connection instead of
+        disconnecting it, if the user has a session. The user keeps its
+        name and rooms, and its queue keeps the newest messages.
+
+        Returns:
+          The session token and the detach count to pass to expire_session,
+          or None if the user has no session and must be disconnected.
+          Raises AddrError if the connection record is already cleared.
+    """
+    self.lock.acquire()
+    if hash(addr) not in self.conns:
+      self.lock.release()
+      raise AddrError()
+    username = self.conns[hash(addr)]
+    if username not in self.users or self.users[username].token == None:
+      self.lock.release()
+      return None
+    user = self.users[username]
+    del self.conns[hash(addr)]
+    user.detach(self.backlog)
+    self.lock.release()
+    return user.token, user.detaches
+
+  def resume_session(self, token: str, conn, addr):
+    """ Attach a detached session to the connection at addr.
+        A 430 error code is returned if the token is unknown or expired, a
+        431 error code if the session is still attached to a connection.
+    """
+    self.lock.acquire()
+    username = self.sessions.get(token)
+    if username == None:
+      status = ResumeStatus(430, "Session not found or expired", '', set(), 0)
+    elif not self.users[username].detached:
+      status = ResumeStatus(431, "Session still attached", username, set(), 0)
+    else:
+      dropped = self.users[username].attach(conn, addr)
+      self.conns[hash(addr)] = username
+      rooms = { room for room in self.rooms if username in self.rooms[room].users }
+      status = ResumeStatus(200, "success", username, rooms, dropped)
+    self.lock.release()
+    return status
+
+  def expire_session(self, token: str, detaches: int):
+    """ Remove a session that was not resumed after its detach number
+        detaches, together with its user, like user_disconnection does.
+
+        Returns:
+          The username and the set of room names to notify, or None and
+          None if the session has been resumed or removed since.
+    """
+    self.lock.acquire()
+    username = self.sessions.get(token)
+    if (username == None or not self.users[username].detached
+        or self.users[username].detaches != detaches):
+      self.lock.release()
+      return None, None
+    del self.sessions[token]
+    to_notify, _ = self.__clear_disconnected_user(username)
+    self.users[username].disconnection_release()
+    self._retire_bucket(self.users[username])
+    del self.users[username]
+    self.lock.release()
+    return username, to_notify
+
   def clear_user_conn(self, addr):
     """ Remove addr entry from conn dict. If the hash of addr does not
         exist, return a Status object with error code 462 to indicate
@@ -173,7 +1049,6 @@ class Table:
         status = self.__valid_joining(roomName, username)
         if status.code == 200:
           self.rooms[roomName].join(self.users[username])
-    print(self)
     self.lock.release()
     return status
 
@@ -199,93 +1074,73 @@ class Table:
     self.lock.release()
     return status
 
-  def list_rooms(self):
+  def evict_user(self, username: str, notice: Status):
+    """ Remove a user, connected or detached, to free memory, like
+        user_disconnection does, together with its session and connection
+        record. A connected user is sent notice before its sending thread
+        stops.
+
+        Returns:
+          The set of room names to notify, or None if the user is gone.
+    """
     self.lock.acquire()
-    rooms = {room for room in self.rooms}
+    to_notify, status = self.__clear_disconnected_user(username)
+    if status.code == 200:
+      user = self.users[username]
+      self.sessions.pop(user.token, None)
+      if not user.detached:
+        self.conns.pop(hash(user.addr), None)
+      self._retire_bucket(user)
+      del self.users[username]
+      user.evict(notice)
     self.lock.release()
-    return rooms
+    return to_notify
 
-  def list_room_users(self, roomName: str):
+  def counts(self):
+    """ Return the numbers of users, connection records and room
+        memberships.
+    """
     self.lock.acquire()
-    if roomName in self.rooms:
-      users = { username for username in self.rooms[roomName].users }
+    counts = (len(self.users), len(self.conns),
+              sum(len(room.users) for room in self.rooms.values()))
     self.lock.release()
-    return users
+    return counts
 
-  def enqueue_message(self, message: Status, receivers: list):
-    """ Enqueue a message object in to target users' message queue given in the 
-        receiver list. 
-    """
-    for receiver in receivers:
-      if receiver in self.users:
-        self.users[receiver].enqueue_message(message)
+  def _get_user(self, username: str):
+    self.lock.acquire()
+    user = self.users.get(username)
+    self.lock.release()
+    return user
 
-  def flush_message_queue(self, addr):
-    """ Return a list of message objects that are to send back to client at 
-        address addr. 
-        __NOTE__:
-        This function call will be blocked until the message queue of user 
-        at addr has already been enqueued some Status object. 
-    """
-    if hash(addr) not in self.conns:
-      raise UserDisconnectedException
-    username = self.conns[hash(addr)]
-    message = self.users[username].get_messages() # return when message available
-    return message
+  def _get_users(self, usernames):
+    self.lock.acquire()
+    users = [self.users[username] for username in usernames if username in self.users]
+    self.lock.release()
+    return users
 
-  def has_room(self, roomName: str):
-    """ Helper function for code outside of the Table object determine whether
-        the room exist in current rooms dict. 
-        The code outside of the Table object must use this function instead of
-        access rooms dict directly without acquiring a lock.
-    """
+  def _all_users(self):
     self.lock.acquire()
-    has = roomName in self.rooms
+    users = list(self.users.values())
     self.lock.release()
-    return has
+    return users
 
-  def has_username(self, username: str):
-    """ Helper function for code outside of the Table object determine whether
-        the username exist in current users dict.
-        The code outside of the Table object must use this function instead of
-        access users dict directly without acquiring a lock.
-    """
+  def _username_at(self, addr):
     self.lock.acquire()
-    has = username in self.users
+    username = self.conns.get(hash(addr))
     self.lock.release()
-    return has
+    return username
 
-  def has_addr(self, addr):
-    """ Helper function for code outside of the Table object determine whether 
-        the given addr exist in current conns dict.
-        The code outside of the Table object must use this function instead of
-        access conns dict directly without acquiring a lock.
-    """
+  def _in_room(self, roomName: str, visit):
     self.lock.acquire()
-    has = hash(addr) in self.conns
+    result = visit(self.rooms.get(roomName))
     self.lock.release()
-    return has
+    return result
 
-  def get_username_by_addr(self, addr):
-    """ Return username that corresponds to given address.
-        This function should always be called after validate the given addr.
-        If the hash of addr is not presented, it is an internal error of 
-        our server code except ConnectionResetError, in which case the AddrError
-        exception should be handled. In other cases, the addr must have a 
-        corresponding username in the database after registration.
-    """
+  def _map_rooms(self, visit):
     self.lock.acquire()
-    if hash(addr) in self.conns:
-      username = self.conns[hash(addr)]
-    else:
-      self.lock.release()
-      # error occurs due to server code itself except the server handle 
-      # ConnectionResetError. This is because two thread can catch ConnectionResetError
-      # concurrently, and one of the thread can clear user's connection record first.
-      # and another thread will catch this AddrError exception.
-      raise AddrError()   
+    results = [visit(room) for room in self.rooms.values()]
     self.lock.release()
-    return username
+    return results
 
   def __create_room(self, roomName: str, creator: User):
     if len(roomName) != 20:
@@ -293,7 +1148,10 @@ class Table:
     for c in range(len(roomName)):
       if roomName[c] in { '$', '#', '&' }:
         return Status(403, "Invalid room name format")
-    self.rooms[roomName] = Room(roomName, creator)
+    log = None
+    if self.delivery == 'log':
+      log = RoomLog(self.log_size, self.stamps)
+    self.rooms[roomName] = Room(roomName, creator, log)
     return JoinStatus(200, "success", roomName, creator.name, True)
 
   def __valid_registration(self, username: str, addr):
@@ -335,19 +1193,846 @@ class Table:
       if self.rooms[room].leave(username):
         to_notify.add(room)
     return to_notify, Status(200, "success")
-    
-  def __str__(self):
-    string = "users:\n"
-    for name in self.users:
-      string += self.users[name].name + "  " + str(self.users[name].addr) + '\n'
-    string += "\n"
-    for room in self.rooms:
-      string += self.rooms[room].name + ":\n"
-      for name in self.rooms[room].users:
-        string += self.rooms[room].users[name].name + "  " + str(self.rooms[room].users[name].addr) + '\n'
-      string += "\n"
-    return string
-  
+
+
+class ShardedTable(BaseTable):
+  """ A drop-in replacement for Table that splits its dicts into shards,
+      each with its own lock, so commands on different rooms and users do
+      not wait on one lock. Rooms are sharded by the hash of the room name,
+      users by the hash of the username and connections by the hash of the
+      address; sessions and flood counters stay behind lock.
+
+      A thread holding several locks takes them in this order: lock, a
+      user shard, a connection shard, then room shards by increasing index.
+      Operations on several rooms (disconnecting a user, resuming a session,
+      listing rooms) take the room shards in that fixed order.
+
+      Attributes:
+        user_shards (list)   : per shard, mapping user name to User object
+        conn_shards (list)   : per shard, mapping address to user name
+        room_shards (list)   : per shard, mapping room name to Room object
+        user_locks (list)    : lock of each user shard
+        conn_locks (list)    : lock of each connection shard
+        room_locks (list)    : lock of each room shard
+        locks (list)         : lock and all the shard locks
+  """
+  def __init__(self, lock, backlog: int = 256, message_rate: float = 0,
+               message_burst: float = 0, broadcast_threshold: int = 0,
+               broadcast_workers: int = 4, delivery: str = 'queue',
+               log_size: int = 1024, shards: int = 16, new_lock=threading.Lock,
+               presence_interval: float = 0):
+    self.user_shards = [{} for _ in range(shards)]
+    self.conn_shards = [{} for _ in range(shards)]
+    self.room_shards = [{} for _ in range(shards)]
+    self.user_locks  = [new_lock() for _ in range(shards)]
+    self.conn_locks  = [new_lock() for _ in range(shards)]
+    self.room_locks  = [new_lock() for _ in range(shards)]
+    self.locks       = [lock] + self.user_locks + self.conn_locks + self.room_locks
+    super().__init__(lock, backlog, message_rate, message_burst, broadcast_threshold,
+                     broadcast_workers, delivery, log_size, presence_interval)
+
+  def user_registration(self, username: str, conn, addr):
+    status = BaseTable._valid_name(username, "Invalid username format")
+    if status.code != 200:
+      return status
+    u = self.__user_shard(username)
+    c = self.__conn_shard(addr)
+    self.user_locks[u].acquire()
+    self.conn_locks[c].acquire()
+    if hash(addr) in self.conn_shards[c]:
+      status = RegistrationStatus(401, "Duplicated registration", username)
+    elif username in self.user_shards[u]:
+      status = RegistrationStatus(402, "Username existed", username)
+    else:
+      user = User(username, conn, addr)
+      if self.message_rate > 0:
+        user.bucket = TokenBucket(self.message_rate, max(1, self.message_burst))
+      self.user_shards[u][username] = user
+      self.conn_shards[c][hash(addr)] = username
+      status = RegistrationStatus(200, "success", username)
+    self.conn_locks[c].release()
+    self.user_locks[u].release()
+    return status
+
+  def user_disconnection(self, username: str):
+    """ Remove the user from all the rooms and from the users, like
+        Table.user_disconnection. The connection entry is not removed.
+    """
+    user = self.__pop_user(username)
+    if user == None:
+      return None, DisconnectStatus(461, "Disconnect user not found", username)
+    to_notify = self.__leave_all(username)
+    user.disconnection_release()
+    self.lock.acquire()
+    self.sessions.pop(user.token, None)
+    self._retire_bucket(user)
+    self.lock.release()
+    return to_notify, Status(200, "success")
+
+  def detach_user(self, addr):
+    """ See Table.detach_user.
+    """
+    username = self.get_username_by_addr(addr)
+    user = self._get_user(username)
+    if user == None or user.token == None:
+      return None
+    c = self.__conn_shard(addr)
+    self.conn_locks[c].acquire()
+    if self.conn_shards[c].get(hash(addr)) != username:
+      self.conn_locks[c].release()
+      raise AddrError()   # another thread detached it first
+    del self.conn_shards[c][hash(addr)]
+    self.conn_locks[c].release()
+    user.detach(self.backlog)
+    return user.token, user.detaches
+
+  def resume_session(self, token: str, conn, addr):
+    """ See Table.resume_session.
+    """
+    self.lock.acquire()
+    username = self.sessions.get(token)
+    user = self._get_user(username) if username != None else None
+    if user == None:
+      status = ResumeStatus(430, "Session not found or expired", '', set(), 0)
+    elif not user.detached:
+      status = ResumeStatus(431, "Session still attached", username, set(), 0)
+    else:
+      dropped = user.attach(conn, addr)
+      c = self.__conn_shard(addr)
+      self.conn_locks[c].acquire()
+      self.conn_shards[c][hash(addr)] = username
+      self.conn_locks[c].release()
+      status = ResumeStatus(200, "success", username, self.__rooms_of(username), dropped)
+    self.lock.release()
+    return status
+
+  def expire_session(self, token: str, detaches: int):
+    """ See Table.expire_session.
+    """
+    self.lock.acquire()
+    username = self.sessions.get(token)
+    user = self._get_user(username) if username != None else None
+    if user == None or not user.detached or user.detaches != detaches:
+      self.lock.release()
+      return None, None
+    del self.sessions[token]
+    self.__pop_user(username)
+    to_notify = self.__leave_all(username)
+    user.disconnection_release()
+    self._retire_bucket(user)
+    self.lock.release()
+    return username, to_notify
+
+  def clear_user_conn(self, addr):
+    c = self.__conn_shard(addr)
+    self.conn_locks[c].acquire()
+    if hash(addr) not in self.conn_shards[c]:
+      status = Status(462, "Disconnect cannot find address")
+    else:
+      del self.conn_shards[c][hash(addr)]
+      status = Status(200, "success")
+    self.conn_locks[c].release()
+    return status
+
+  def join_room(self, roomName: str, username: str):
+    """ See Table.join_room. The user's shard stays locked until the user
+        is in the room, so a disconnection or eviction either happens
+        before the join, which then fails, or removes the user from the
+        room after it.
+    """
+    u = self.__user_shard(username)
+    self.user_locks[u].acquire()
+    user = self.user_shards[u].get(username)
+    if user == None:
+      self.user_locks[u].release()
+      return JoinStatus(499, "User requested not found", roomName, username)
+    r = self.__room_shard(roomName)
+    self.room_locks[r].acquire()
+    rooms = self.room_shards[r]
+    if roomName not in rooms:
+      status = BaseTable._valid_name(roomName, "Invalid room name format")
+      if status.code == 200:
+        log = None
+        if self.delivery == 'log':
+          log = RoomLog(self.log_size, self.stamps)
+        rooms[roomName] = Room(roomName, user, log)
+        status = JoinStatus(200, "success", roomName, username, True)
+    elif username in rooms[roomName].users:
+      status = JoinStatus(498, "Duplicated joining", roomName, username)
+    else:
+      rooms[roomName].join(user)
+      status = JoinStatus(200, "success", roomName, username)
+    self.room_locks[r].release()
+    self.user_locks[u].release()
+    return status
+
+  def leave_room(self, roomName: str, username: str):
+    """ See Table.leave_room.
+    """
+    if not self.has_username(username):
+      return Status(499, "User not found")
+    r = self.__room_shard(roomName)
+    self.room_locks[r].acquire()
+    if roomName not in self.room_shards[r]:
+      status = LeaveStatus(450, "Room to leave not found", roomName, username)
+    elif self.room_shards[r][roomName].leave(username):
+      status = LeaveStatus(200, "success", roomName, username)
+    else:
+      status = LeaveStatus(451, "User not found in room to leave", roomName, username)
+    self.room_locks[r].release()
+    return status
+
+  def evict_user(self, username: str, notice: Status):
+    """ See Table.evict_user.
+    """
+    user = self.__pop_user(username)
+    if user == None:
+      return None
+    to_notify = self.__leave_all(username)
+    if not user.detached:
+      c = self.__conn_shard(user.addr)
+      self.conn_locks[c].acquire()
+      self.conn_shards[c].pop(hash(user.addr), None)
+      self.conn_locks[c].release()
+    self.lock.acquire()
+    self.sessions.pop(user.token, None)
+    self._retire_bucket(user)
+    self.lock.release()
+    user.evict(notice)
+    return to_notify
+
+  def counts(self):
+    """ See Table.counts.
+    """
+    users = conns = 0
+    for index in range(len(self.user_shards)):
+      self.user_locks[index].acquire()
+      users += len(self.user_shards[index])
+      self.user_locks[index].release()
+      self.conn_locks[index].acquire()
+      conns += len(self.conn_shards[index])
+      self.conn_locks[index].release()
+    return users, conns, sum(self._map_rooms(lambda room: len(room.users)))
+
+  def _get_user(self, username: str):
+    u = self.__user_shard(username)
+    self.user_locks[u].acquire()
+    user = self.user_shards[u].get(username)
+    self.user_locks[u].release()
+    return user
+
+  def _get_users(self, usernames):
+    """ Return the User objects of usernames that exist, taking each user
+        shard lock once.
+    """
+    by_shard = {}
+    for username in usernames:
+      by_shard.setdefault(self.__user_shard(username), []).append(username)
+    users = []
+    for u in by_shard:
+      self.user_locks[u].acquire()
+      shard = self.user_shards[u]
+      users.extend(shard[username] for username in by_shard[u] if username in shard)
+      self.user_locks[u].release()
+    return users
+
+  def _all_users(self):
+    users = []
+    for u in range(len(self.user_shards)):
+      self.user_locks[u].acquire()
+      users.extend(self.user_shards[u].values())
+      self.user_locks[u].release()
+    return users
+
+  def _username_at(self, addr):
+    c = self.__conn_shard(addr)
+    self.conn_locks[c].acquire()
+    username = self.conn_shards[c].get(hash(addr))
+    self.conn_locks[c].release()
+    return username
+
+  def _in_room(self, roomName: str, visit):
+    r = self.__room_shard(roomName)
+    self.room_locks[r].acquire()
+    result = visit(self.room_shards[r].get(roomName))
+    self.room_locks[r].release()
+    return result
+
+  def _map_rooms(self, visit):
+    results = []
+    for r in range(len(self.room_shards)):
+      self.room_locks[r].acquire()
+      results.extend(visit(room) for room in self.room_shards[r].values())
+      self.room_locks[r].release()
+    return results
+
+  def __user_shard(self, username: str):
+    return hash(username) % len(self.user_shards)
+
+  def __conn_shard(self, addr):
+    return hash(addr) % len(self.conn_shards)
+
+  def __room_shard(self, roomName: str):
+    return hash(roomName) % len(self.room_shards)
+
+  def __pop_user(self, username: str):
+    u = self.__user_shard(username)
+    self.user_locks[u].acquire()
+    user = self.user_shards[u].pop(username, None)
+    self.user_locks[u].release()
+    return user
+
+  def __leave_all(self, username: str):
+    """ Remove username from every room, holding all the room shards in
+        increasing order. Return the names of the rooms it left.
+    """
+    to_notify = set()
+    for lock in self.room_locks:
+      lock.acquire()
+    for shard in self.room_shards:
+      for room in shard.values():
+        if room.leave(username):
+          to_notify.add(room.name)
+    for lock in reversed(self.room_locks):
+      lock.release()
+    return to_notify
+
+  def __rooms_of(self, username: str):
+    rooms = set()
+    for r in range(len(self.room_shards)):
+      self.room_locks[r].acquire()
+      rooms.update(name for name, room in self.room_shards[r].items() if username in room.users)
+      self.room_locks[r].release()
+    return rooms
+
+
+class RoomActors:
+  """ A fixed pool of worker threads, each owning the rooms whose name
+      hashes to it and running the jobs posted for it from its inbox one
+      at a time, in the order they were posted.
+      A job for several actors runs once all of them have reached it,
+      while they wait; such jobs are posted to every inbox under one lock,
+      so all actors see them in the same order and cannot wait on each
+      other in a cycle. The thread running a job may use the rooms of all
+      the actors it was posted to. Work on the rooms of every actor is
+      gathered from each actor on its own, so they need not meet for it.
+
+      Attributes:
+        inboxes (list) : per actor, the jobs waiting to run
+        has_job (list) : per actor, the Condition for its inbox
+        local (threading.local): per thread, the actors of the job it runs
+        jobs (int)     : jobs run
+  """
+  def __init__(self, actors: int):
+    self.inboxes   = [[] for _ in range(actors)]
+    self.has_job   = [threading.Condition() for _ in range(actors)]
+    self.post_lock = threading.Lock()
+    self.local     = threading.local()
+    self.jobs      = 0
+    for index in range(actors):
+      threading.Thread(target=self.__actor, args=(index,), daemon=True).start()
+
+  def owner(self, roomName: str):
+    return hash(roomName) % len(self.inboxes)
+
+  def post(self, owners: set, job):
+    """ Post job to the actors owners. Return an Event that is set once it
+        has run.
+    """
+    owners = sorted(owners)
+    done = threading.Event()
+    run = lambda: self.__run(owners, job, done)
+    if len(owners) == 1:
+      self.__post(owners[0], run)
+      return done
+    gate = threading.Barrier(len(owners), action=run)
+    self.post_lock.acquire()
+    for index in owners:
+      self.__post(index, gate.wait)
+    self.post_lock.release()
+    return done
+
+  def call(self, owners: set, job):
+    """ Run job on the actors owners and return what it returns: right away
+        if the calling thread runs a job of all of them, otherwise once they
+        have run it. An actor must not call it for other actors than the
+        ones of the job it runs.
+    """
+    if set(owners) <= getattr(self.local, 'held', set()):
+      return job()
+    return RoomActors.__wait([self.__submit(owners, job)])[0]
+
+  def gather(self, job):
+    """ Run job(index) on every actor index on its own and return the list
+        of what they return. Only threads that are not actors may call it.
+    """
+    return RoomActors.__wait([self.__submit({ index }, lambda index=index: job(index))
+                              for index in range(len(self.inboxes))])
+
+  def __submit(self, owners: set, job):
+    outcome = {}
+    def capture():
+      try:
+        outcome['result'] = job()
+      except Exception as e:
+        outcome['error'] = e
+    return self.post(owners, capture), outcome
+
+  @staticmethod
+  def __wait(submitted: list):
+    results = []
+    for done, outcome in submitted:
+      done.wait()
+      if 'error' in outcome:
+        raise outcome['error']
+      results.append(outcome['result'])
+    return results
+
+  def __post(self, index: int, job):
+    self.has_job[index].acquire()
+    self.inboxes[index].append(job)
+    self.has_job[index].notify()
+    self.has_job[index].release()
+
+  def __run(self, owners: list, job, done: threading.Event):
+    self.local.held = set(owners)
+    try:
+      job()
+    except Exception as _:   # a failed command must not stop the rooms of the actor
+      traceback.print_exc()
+    finally:
+      self.local.held = set()
+      done.set()
+
+  def __actor(self, index: int):
+    has_job = self.has_job[index]
+    while True:
+      has_job.acquire()
+      while len(self.inboxes[index]) == 0:
+        has_job.wait()
+      jobs = self.inboxes[index]
+      self.inboxes[index] = []
+      has_job.release()
+      for job in jobs:
+        job()
+      has_job.acquire()
+      self.jobs += len(jobs)
+      has_job.release()
+
+
+class ActorTable(Table):
+  """ A Table whose rooms are each owned by one of a pool of actor threads
+      and kept in a dict of that actor, which only the thread running one
+      of its jobs uses, without a lock. A command that touches rooms is
+      posted to the actors of its rooms instead of running in the client's
+      receiving thread, so the commands of a room run one at a time in order
+      and a large fan-out does not hold up its sender. The commands of one
+      connection still run in the order they were sent: the receiving
+      thread waits for the connection's last command before it posts one
+      to other actors or runs one on no room itself. Users, connections and
+      sessions stay in Table's dicts behind Table.lock, which is never held
+      while waiting for an actor; Table.rooms stays empty.
+
+      Attributes:
+        actors (RoomActors): the actor threads
+        room_shards (list) : per actor, mapping room name to Room object
+        chain (threading.local): per receiving thread, the actors of the
+                             last command it posted and the Event set once
+                             that has run
+  """
+  def __init__(self, lock, backlog: int = 256, message_rate: float = 0,
+               message_burst: float = 0, broadcast_threshold: int = 0,
+               broadcast_workers: int = 4, delivery: str = 'queue',
+               log_size: int = 1024, actors: int = 8, presence_interval: float = 0):
+    super().__init__(lock, backlog, message_rate, message_burst, broadcast_threshold,
+                     broadcast_workers, delivery, log_size, presence_interval)
+    self.actors      = RoomActors(actors)
+    self.room_shards = [{} for _ in range(actors)]
+    self.chain       = threading.local()
+
+  def run_command(self, cmd, conn, addr):
+    """ Post cmd to the actors of the rooms it touches and return None; the
+        command enqueues its status itself. A command on no room runs in the
+        calling thread. Either waits for the last command of the connection
+        first, unless that was posted to the same actors, whose inboxes
+        keep the order.
+    """
+    owners = self.__owners(cmd.touched_rooms())
+    last = getattr(self.chain, 'last', None)
+    if last != None and (len(owners) == 0 or not owners <= last[0]):
+      last[1].wait()
+    if len(owners) == 0:
+      return cmd.execute(conn, addr)
+    self._release_held()   # the statuses of the commands before it go first
+    self.chain.last = (owners, self.actors.post(owners, lambda: self.__execute(cmd, conn, addr)))
+    return None
+
+  def run_in_rooms(self, roomNames: list, job):
+    """ Post job to the actors of roomNames.
+    """
+    self.actors.post(self.__owners(roomNames), job)
+
+  def user_disconnection(self, username: str):
+    """ See Table.user_disconnection.
+    """
+    self.lock.acquire()
+    user = self.users.pop(username, None)
+    if user != None:
+      self.sessions.pop(user.token, None)
+      self._retire_bucket(user)
+    self.lock.release()
+    if user == None:
+      return None, DisconnectStatus(461, "Disconnect user not found", username)
+    to_notify = self.__leave_all(username)
+    user.disconnection_release()
+    return to_notify, Status(200, "success")
+
+  def resume_session(self, token: str, conn, addr):
+    """ See Table.resume_session.
+    """
+    self.lock.acquire()
+    username = self.sessions.get(token)
+    status = None
+    if username == None:
+      status = ResumeStatus(430, "Session not found or expired", '', set(), 0)
+    elif not self.users[username].detached:
+      status = ResumeStatus(431, "Session still attached", username, set(), 0)
+    else:
+      dropped = self.users[username].attach(conn, addr)
+      self.conns[hash(addr)] = username
+    self.lock.release()
+    if status == None:
+      status = ResumeStatus(200, "success", username, self.__rooms_of(username), dropped)
+    return status
+
+  def expire_session(self, token: str, detaches: int):
+    """ See Table.expire_session.
+    """
+    self.lock.acquire()
+    username = self.sessions.get(token)
+    if (username == None or not self.users[username].detached
+        or self.users[username].detaches != detaches):
+      self.lock.release()
+      return None, None
+    del self.sessions[token]
+    user = self.users.pop(username)
+    self._retire_bucket(user)
+    self.lock.release()
+    to_notify = self.__leave_all(username)
+    user.disconnection_release()
+    return username, to_notify
+
+  def join_room(self, roomName: str, username: str):
+    """ See Table.join_room. The user is looked up on the actor of the room,
+        so a disconnection either happens before, and the join fails, or
+        removes the user from the room after it.
+    """
+    return self.__in_shard(roomName, lambda rooms: self.__join(rooms, roomName, username))
+
+  def leave_room(self, roomName: str, username: str):
+    """ See Table.leave_room.
+    """
+    if not self.has_username(username):
+      return Status(499, "User not found")
+    return self.__in_shard(roomName, lambda rooms: self.__leave(rooms, roomName, username))
+
+  def evict_user(self, username: str, notice: Status):
+    """ See Table.evict_user.
+    """
+    self.lock.acquire()
+    user = self.users.pop(username, None)
+    if user != None:
+      self.sessions.pop(user.token, None)
+      if not user.detached:
+        self.conns.pop(hash(user.addr), None)
+      self._retire_bucket(user)
+    self.lock.release()
+    if user == None:
+      return None
+    to_notify = self.__leave_all(username)
+    user.evict(notice)
+    return to_notify
+
+  def counts(self):
+    """ See Table.counts.
+    """
+    self.lock.acquire()
+    users, conns = len(self.users), len(self.conns)
+    self.lock.release()
+    return users, conns, sum(self._map_rooms(lambda room: len(room.users)))
+
+  def _in_room(self, roomName: str, visit):
+    return self.__in_shard(roomName, lambda rooms: visit(rooms.get(roomName)))
+
+  def _map_rooms(self, visit):
+    results = self.actors.gather(lambda index: [
+      visit(room) for room in self.room_shards[index].values()])
+    return [result for part in results for result in part]
+
+  def __owners(self, roomNames: list):
+    return { self.actors.owner(roomName) for roomName in roomNames }
+
+  def __in_shard(self, roomName: str, visit):
+    """ Return visit(rooms), called on the actor owning roomName with its
+        dict of rooms.
+    """
+    index = self.actors.owner(roomName)
+    return self.actors.call({ index }, lambda: visit(self.room_shards[index]))
+
+  def __execute(self, cmd, conn, addr):
+    try:
+      cmd.execute(conn, addr)
+    except AddrError as _:  # disconnected since the command was read
+      pass
+
+  def __join(self, rooms: dict, roomName: str, username: str):
+    user = self._get_user(username)
+    if user == None:
+      return JoinStatus(499, "User requested not found", roomName, username)
+    if roomName not in rooms:
+      status = BaseTable._valid_name(roomName, "Invalid room name format")
+      if status.code == 200:
+        log = None
+        if self.delivery == 'log':
+          log = RoomLog(self.log_size, self.stamps)
+        rooms[roomName] = Room(roomName, user, log)
+        status = JoinStatus(200, "success", roomName, username, True)
+    elif username in rooms[roomName].users:
+      status = JoinStatus(498, "Duplicated joining", roomName, username)
+    else:
+      rooms[roomName].join(user)
+      status = JoinStatus(200, "success", roomName, username)
+    return status
+
+  def __leave(self, rooms: dict, roomName: str, username: str):
+    if roomName not in rooms:
+      return LeaveStatus(450, "Room to leave not found", roomName, username)
+    if rooms[roomName].leave(username):
+      return LeaveStatus(200, "success", roomName, username)
+    return LeaveStatus(451, "User not found in room to leave", roomName, username)
+
+  def __leave_all(self, username: str):
+    """ Remove username from every room, on each actor. Return the names of
+        the rooms it left.
+    """
+    return set(self._map_rooms(lambda room: room.name if room.leave(username) else None)) - { None }
+
+  def __rooms_of(self, username: str):
+    return set(self._map_rooms(lambda room: room.name if username in room.users else None)) - { None }
+
+
+class AdmissionController:
+  """ Decides whether the server takes new clients. It is overloaded while
+      any of the live connections, the bytes waiting in users' queues or
+      the mean command latency of the last interval is above its limit; a
+      limit of 0 is not checked. update() is called every interval with a
+      new sample, record_latency() after every command.
+
+      Attributes:
+        connections (int)   : live connections in the last sample
+        queued_bytes (int)  : bytes waiting in queues in the last sample
+        latency (float)     : mean command latency of the last interval
+        rejected (int)      : connections and registrations turned away
+  """
+  def __init__(self, max_connections: int, max_queued_bytes: int, max_latency: float):
+    self.max_connections  = max_connections
+    self.max_queued_bytes = max_queued_bytes
+    self.max_latency      = max_latency
+    self.connections      = 0
+    self.queued_bytes     = 0
+    self.latency          = 0.0
+    self.rejected         = 0
+    self.latency_sum      = 0.0
+    self.latency_count    = 0
+    self.lock             = threading.Lock()
+
+  def limited(self):
+    """ Return True if any of the limits is checked.
+    """
+    return self.max_connections > 0 or self.max_queued_bytes > 0 or self.max_latency > 0
+
+  def record_latency(self, seconds: float):
+    self.lock.acquire()
+    self.latency_sum += seconds
+    self.latency_count += 1
+    self.lock.release()
+
+  def update(self, connections: int, queued_bytes: int):
+    self.lock.acquire()
+    self.connections  = connections
+    self.queued_bytes = queued_bytes
+    self.latency = self.latency_sum / self.latency_count if self.latency_count else 0.0
+    self.latency_sum   = 0.0
+    self.latency_count = 0
+    self.lock.release()
+
+  def admit(self):
+    """ Return None if a new client may come in, else the busy Status to
+        send it.
+    """
+    self.lock.acquire()
+    overloaded = (
+      (self.max_connections > 0 and self.connections >= self.max_connections)
+      or (self.max_queued_bytes > 0 and self.queued_bytes >= self.max_queued_bytes)
+      or (self.max_latency > 0 and self.latency >= self.max_latency))
+    if overloaded:
+      self.rejected += 1
+    self.lock.release()
+    if overloaded:
+      return Status(503, "Server busy, try again later")
+    return None
+
+
+class MemoryAccountant:
+  """ Keeps the memory the table holds under a ceiling. The bytes of users,
+      rooms and memberships are estimates of the Python objects behind
+      them; a queued message counts its encoded size plus the Status
+      object. When the total is over limit, the largest queues are trimmed
+      to their newest trim_to messages first, then users are evicted until
+      the total is back under the low watermark: detached sessions first,
+      then the users whose queue has gone longest without being sent,
+      then the users holding the most bytes. A passive reader that keeps
+      up with its rooms is never preferred over one that stopped reading.
+      Affected users are sent a 507 PressureStatus.
+
+      Attributes:
+        limit (int)        : bytes allowed, 0 for no limit
+        trim_to (int)      : messages a trimmed queue keeps
+        total (int)        : estimated bytes at the last check
+        users (dict)       : mapping user name to its estimated bytes
+        rooms (dict)       : mapping room name to its estimated bytes
+        trimmed (int)      : messages dropped from queues
+        evicted (int)      : users evicted
+  """
+  USER_BYTES       = 2048   # User object, its lock, condition and dict entries
+  ROOM_BYTES       = 1024   # Room object and its dict entries
+  MEMBERSHIP_BYTES = 200    # a user's entry in a room's users dict
+  MESSAGE_BYTES    = 400    # Status object and its queue slot
+
+  # after acting, bring the total down to this fraction of limit
+  LOW_WATERMARK = 0.9
+
+  def __init__(self, limit: int, trim_to: int = 64):
+    self.limit   = limit
+    self.trim_to = trim_to
+    self.total   = 0
+    self.users   = {}
+    self.rooms   = {}
+    self.trimmed = 0
+    self.evicted = 0
+
+  def measure(self, table: Table):
+    """ Estimate the bytes of every user and room in table. Return the
+        usage of the users as returned by Table.memory_usage().
+    """
+    users, rooms = table.memory_usage()
+    self.users = {}
+    for username, messages, queued_bytes, memberships, _, _ in users:
+      self.users[username] = (MemoryAccountant.USER_BYTES + queued_bytes
+        + messages * MemoryAccountant.MESSAGE_BYTES
+        + memberships * MemoryAccountant.MEMBERSHIP_BYTES)
+    self.rooms = {}
+    for room in rooms:
+      _, messages, log_bytes = rooms[room]
+      self.rooms[room] = (MemoryAccountant.ROOM_BYTES + log_bytes
+        + messages * MemoryAccountant.MESSAGE_BYTES)
+    self.total = sum(self.users.values()) + sum(self.rooms.values())
+    return users
+
+  def enforce(self, table: Table):
+    """ Measure table and, if it is over limit, trim queues. Return the
+        names of the users to evict with evict_user(), slowest first; the
+        caller evicts them and notifies their rooms.
+    """
+    users = self.measure(table)
+    if self.limit <= 0 or self.total <= self.limit:
+      return []
+    target = self.limit * MemoryAccountant.LOW_WATERMARK
+    total  = self.total
+
+    users.sort(key=lambda usage: usage[2], reverse=True)  # largest queues first
+    for username, messages, _, _, _, _ in users:
+      if total <= target:
+        break
+      if messages <= self.trim_to:
+        continue
+      dropped, freed = table.trim_queue(username, self.trim_to)
+      if dropped != 0:
+        freed += dropped * MemoryAccountant.MESSAGE_BYTES
+        total -= freed
+        self.users[username] -= freed
+        self.trimmed += dropped
+        notice = PressureStatus(507, "Server memory low, oldest messages dropped", dropped)
+        table.enqueue_message(notice, [username])
+
+    to_evict = []
+    # detached first, then the longest stalled queue, then the largest user
+    users.sort(key=lambda usage: (usage[5], usage[4], self.users[usage[0]]), reverse=True)
+    for username, _, _, _, _, _ in users:
+      if total <= target:
+        break
+      to_evict.append(username)
+      total -= self.users[username]
+    self.evicted += len(to_evict)
+    return to_evict
+
+
+class ConnectionLimits:
+  """ Counts open connections per client IP address, and connections that
+      have not registered yet, so a flood of connections cannot take all
+      the server's threads.
+
+      Attributes:
+        max_unregistered (int): connections allowed in the registration
+                                phrase at once, 0 for no limit
+        max_per_ip (int)      : open connections allowed per IP address,
+                                0 for no limit
+        unregistered (int)    : connections in the registration phrase
+        per_ip (dict)         : mapping IP address to open connections
+        open (int)            : open connections
+  """
+  def __init__(self, max_unregistered: int, max_per_ip: int):
+    self.max_unregistered = max_unregistered
+    self.max_per_ip       = max_per_ip
+    self.unregistered     = 0
+    self.per_ip           = {}
+    self.open             = 0
+    self.lock             = threading.Lock()
+
+  def admit(self, ip: str):
+    """ Count a new connection from ip. Return None if it is admitted, or
+        the error Status to send before closing it.
+    """
+    self.lock.acquire()
+    try:
+      if self.max_unregistered > 0 and self.unregistered >= self.max_unregistered:
+        return Status(503, "Too many unregistered connections, try again later")
+      if self.max_per_ip > 0 and self.per_ip.get(ip, 0) >= self.max_per_ip:
+        return Status(421, "Too many connections from address " + ip)
+      self.unregistered += 1
+      self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+      self.open += 1
+      return None
+    finally:
+      self.lock.release()
+
+  def registered(self):
+    self.lock.acquire()
+    self.unregistered -= 1
+    self.lock.release()
+
+  def release(self, ip: str, registered: bool):
+    """ Count an admitted connection as closed.
+    """
+    self.lock.acquire()
+    if not registered:
+      self.unregistered -= 1
+    self.per_ip[ip] -= 1
+    self.open -= 1
+    if self.per_ip[ip] == 0:
+      del self.per_ip[ip]
+    self.lock.release()
+
 
 class RunningSignal:
 
@@ -0,0 +1,245 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# A long-running soak test that looks for leaked threads, Table entries and
+# memory in the server.
+#
+# The server runs inside this process so its Table can be inspected. Churn
+# threads repeatedly connect, register a fresh username, join rooms, send
+# room and private messages and then end the session in one of three ways:
+# a disconnect command, a plain close without the command, or an abrupt
+# reset (SO_LINGER 0), which makes both server threads of the connection
+# race through UserDisconnect.
+#
+# Every interval the program samples the thread count, the numbers of
+# users, connection records and room memberships in the table, and the
+# memory traced by tracemalloc with its top growing allocation sites. After a warm-up the
+# samples must stay bounded: the second half of the run may not exceed the
+# first half by more than the tolerance. When the churn stops, every thread
+# and Table entry created for the sessions must be gone. The program exits
+# with status 1 if either check fails.
+
+import argparse
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from server import Server
+from clientlib import Client
+from app import CmdExecution
+
+
+class Churner(threading.Thread):
+  """ A thread that opens, uses and ends one session after another.
+  """
+  def __init__(self, port: int, rooms: list, number: int, stop: threading.Event,
+               messages: int, seed: int):
+    super().__init__(daemon=True)
+    self.port     = port
+    self.rooms    = rooms
+    self.number   = number
+    self.stop     = stop
+    self.messages = messages
+    self.rng      = random.Random(seed)
+    self.cycles   = { 'disconnect': 0, 'close': 0, 'reset': 0 }
+    self.errors   = 0
+
+  def run(self):
+    sequence = 0
+    while not self.stop.is_set():
+      username = CmdExecution.room_name_sanitize(
+        'soak-' + str(self.number) + '-' + str(sequence))
+      sequence += 1
+      try:
+        self.cycle(username)
+      except OSError as _:
+        self.errors += 1
+
+  def cycle(self, username: str):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(5)
+    s.connect(('localhost', self.port))
+    client = Client(s)
+    client.register(username)
+    client.set_username(username)
+    s.recv(10240)
+    joined = self.rng.sample(self.rooms, self.rng.randint(1, len(self.rooms)))
+    for room in joined:
+      client.join(room)
+    for i in range(self.messages):
+      if self.rng.random() < 0.7:
+        client.room_message(joined[:1], 'soak message ' + str(i))
+      else:
+        client.private_message([username], 'soak message ' + str(i))
+      self.drain(s)
+
+    ending = self.rng.choice(list(self.cycles))
+    if ending == 'disconnect':
+      client.disconnect()
+      self.drain(s)
+    elif ending == 'reset':
+      # close with RST instead of FIN
+      s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    s.close()
+    self.cycles[ending] += 1
+
+  @staticmethod
+  def drain(s):
+    s.setblocking(False)
+    try:
+      while s.recv(65536):
+        pass
+    except (BlockingIOError, ConnectionError):
+      pass
+    finally:
+      s.settimeout(5)
+
+
+class Discard:
+  """ A stdout replacement that drops the server's log lines.
+  """
+  def write(self, text: str):
+    return len(text)
+
+  def flush(self):
+    pass
+
+
+class Sample:
+
+  def __init__(self, elapsed: float, server: Server):
+    self.users, self.conns, self.members = server.database.counts()
+    self.elapsed = elapsed
+    self.threads = threading.active_count()
+    self.memory  = tracemalloc.get_traced_memory()[0]
+
+  METRICS = ('threads', 'users', 'conns', 'members', 'memory')
+
+
+def bounded(samples: list, metric: str, tolerance: float, slack: float):
+  """ A metric is bounded when the peak of the second half of the samples
+      does not exceed the peak of the first half by more than tolerance
+      (a fraction) plus slack (absolute).
+  """
+  half = len(samples) // 2
+  first  = max(getattr(sample, metric) for sample in samples[:half])
+  second = max(getattr(sample, metric) for sample in samples[half:])
+  return second <= first * (1 + tolerance) + slack, first, second
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument(
+    '-d', '--duration', type=float, help="seconds to soak", default=600.0)
+
+  parser.add_argument(
+    '-c', '--churners', type=int, help="concurrent churning clients", default=8)
+
+  parser.add_argument(
+    '-i', '--interval', type=float, help="seconds between samples", default=10.0)
+
+  parser.add_argument(
+    '-w', '--warmup', type=float, help="seconds before samples count", default=30.0)
+
+  parser.add_argument(
+    '--rooms', type=int, help="number of rooms sessions join", default=5)
+
+  parser.add_argument(
+    '--messages', type=int, help="messages sent per session", default=5)
+
+  parser.add_argument(
+    '--tolerance', type=float, help="allowed growth in percent", default=20.0)
+
+  parser.add_argument(
+    '--memory-slack', type=int, help="allowed memory growth in KB on top of tolerance",
+    default=256)
+
+  parser.add_argument(
+    '--settle', type=float, help="seconds allowed to reclaim sessions after churn", default=10.0)
+
+  parser.add_argument(
+    '--top', type=int, help="allocation sites reported per sample", default=3)
+
+  parser.add_argument(
+    '--seed', type=int, help="random seed", default=1)
+
+  args = parser.parse_args()
+  out = sys.stdout
+
+  # the server logs every command; keep this program's own output readable
+  sys.stdout = Discard()
+  tracemalloc.start()
+  server = Server(0)
+  port = server.s.getsockname()[1]
+  threading.Thread(target=server.run, daemon=True).start()
+  server.started.wait()
+  baseline_threads = threading.active_count()
+  baseline_snapshot = tracemalloc.take_snapshot()
+
+  rooms = [CmdExecution.room_name_sanitize('soak-room-' + str(i)) for i in range(args.rooms)]
+  stop = threading.Event()
+  churners = [
+    Churner(port, rooms, i, stop, args.messages, args.seed + i) for i in range(args.churners)
+  ]
+  for churner in churners:
+    churner.start()
+
+  start = time.monotonic()
+  samples = []
+  while time.monotonic() - start < args.duration:
+    time.sleep(min(args.interval, max(0, args.duration - (time.monotonic() - start))))
+    sample = Sample(time.monotonic() - start, server)
+    cycles = sum(sum(c.cycles.values()) for c in churners)
+    print("%8.0fs threads %5d users %5d conns %5d members %6d memory %8.1f KB cycles %d" % (
+      sample.elapsed, sample.threads, sample.users, sample.conns, sample.members,
+      sample.memory / 1024, cycles), file=out)
+    top = tracemalloc.take_snapshot().compare_to(baseline_snapshot, 'lineno')[:args.top]
+    for stat in top:
+      print("           " + str(stat), file=out)
+    if sample.elapsed >= args.warmup:
+      samples.append(sample)
+
+  stop.set()
+  for churner in churners:
+    churner.join()
+
+  failed = False
+  if len(samples) >= 4:
+    for metric in Sample.METRICS:
+      slack = args.memory_slack * 1024 if metric == 'memory' else 2 * args.churners
+      ok, first, second = bounded(samples, metric, args.tolerance / 100, slack)
+      print("%-8s first half peak %10d second half peak %10d %s" % (
+        metric, first, second, 'ok' if ok else 'GROWING'), file=out)
+      failed = failed or not ok
+  else:
+    print("too few samples after warm-up to check growth", file=out)
+
+  # once the churn stops every session must be reclaimed
+  deadline = time.monotonic() + args.settle
+  while time.monotonic() < deadline:
+    final = Sample(time.monotonic() - start, server)
+    if (final.threads <= baseline_threads and final.users == 0
+        and final.conns == 0 and final.members == 0):
+      break
+    time.sleep(0.1)
+  leaked = final.threads > baseline_threads or final.users or final.conns or final.members
+  print("after churn: threads %d (baseline %d) users %d conns %d members %d %s" % (
+    final.threads, baseline_threads, final.users, final.conns, final.members,
+    'LEAKED' if leaked else 'ok'), file=out)
+
+  cycles = {}
+  for churner in churners:
+    for ending in churner.cycles:
+      cycles[ending] = cycles.get(ending, 0) + churner.cycles[ending]
+  print("sessions:", ', '.join(k + ' ' + str(cycles[k]) for k in cycles),
+        "client errors:", sum(c.errors for c in churners), file=out)
+
+  if failed or leaked:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,5 +1,8 @@
 # Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
 
+import zlib
+
+
 class Error(Exception):
   """ Base class for client errors.
   """
@@ -26,6 +29,83 @@ class UserDisconnectedException(Exception):
   pass
 
 
+class FrameDecoder:
+  """ Incremental decoder that splits a byte stream into '$'-delimited frames.
+
+      Unlike running a regex over a single recv() result, a frame that is
+      split across several reads is kept in the buffer until its closing
+      '$' arrives. '$' is a single byte in utf-8 and never appears inside a
+      multi-byte sequence, so splitting happens before decoding.
+
+      After start_inflate() the rest of the stream is a deflate stream, as
+      sent by FrameCompressor, and is decompressed before splitting.
+
+      Attributes:
+        buffer (bytearray): bytes received but not yet returned as frames
+        inflater          : zlib decompressor once inflating, else None
+  """
+  def __init__(self):
+    self.buffer = bytearray()
+    self.inflater = None
+
+  def feed(self, data: bytes):
+    if self.inflater != None:
+      data = self.inflater.decompress(data)
+    self.buffer += data
+
+  def start_inflate(self):
+    """ Decompress the stream from the end of the last returned frame on.
+        Call it right after the frame that switches the stream, e.g. the
+        RegistrationStatus of a registration with the 'deflate' option.
+    """
+    rest = bytes(self.buffer)
+    self.buffer.clear()
+    self.inflater = zlib.decompressobj()
+    self.feed(rest)
+
+  def next_frame(self):
+    """ Return the next complete frame without its '$' delimiters, or None
+        if the buffer does not hold a complete frame yet.
+    """
+    while True:
+      start = self.buffer.find(b'$')
+      if start < 0:
+        self.buffer.clear()
+        return None
+      end = self.buffer.find(b'$', start + 1)
+      if end < 0:
+        del self.buffer[:start]
+        return None
+      if end == start + 1:    # '$$', the second '$' opens the next frame
+        del self.buffer[:end]
+        continue
+      frame = bytes(self.buffer[start + 1:end])
+      del self.buffer[:end + 1]
+      return frame.decode(encoding="utf-8")
+
+  def __iter__(self):
+    frame = self.next_frame()
+    while frame != None:
+      yield frame
+      frame = self.next_frame()
+
+
+class FrameCompressor:
+  """ Compresses everything sent on one connection into a single deflate
+      stream, so the dictionary built from earlier frames (padded names,
+      status messages) is shared by all later ones.
+
+      Every compress() call ends with a sync flush: the receiver can decode
+      all frames of a batch as soon as the batch arrives, at the cost of a
+      few bytes per call. Callers should pass a whole batch at once.
+  """
+  def __init__(self, level: int = 6):
+    self.compressor = zlib.compressobj(level)
+
+  def compress(self, data: bytes):
+    return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
 class Status:
   """ Class for status code and status message
       Produce a byte object as a server response to client
@@ -37,22 +117,42 @@ class Status:
   def to_bytes(self):
     return ('$' + str(self.code) + self.message + '$').encode(encoding="utf-8")
 
+  def encoded(self):
+    """ Return to_bytes(), encoding the status only the first time: a status
+        enqueued for every member of a room is then encoded once. The status
+        must not change after this is called.
+    """
+    wire = getattr(self, 'wire', None)
+    if wire == None:
+      wire = self.to_bytes()
+      self.wire = wire
+    return wire
+
   @staticmethod
   def parse(bytes):
     code = int(bytes[:3])
     message = bytes[3:]
     return Status(code, message)
 
+  def format(self):
+    """ Return the text print() writes for this status, without the
+        final newline.
+    """
+    return str(self.code) + " " + self.message
+
   def print(self):
-    print(str(self.code) + " " + self.message)
+    print(self.format())
 
 
 class RegistrationStatus(Status):
-  """ Class for server to send back to client for user registration
+  """ Class for server to send back to client for user registration.
+      The session token is only sent to a client that registered with the
+      'resume' option.
   """
-  def __init__(self, code: int, message: str, username: str):
+  def __init__(self, code: int, message: str, username: str, token: str = ''):
     super().__init__(code, message)
     self.username     = username
+    self.token        = token
     self.command_code = '00001'
 
   def to_bytes(self):
@@ -61,6 +161,7 @@ class RegistrationStatus(Status):
       + self.command_code
       + self.username + '#'
       + self.message
+      + ('#' + self.token if self.token else '')
       + '$').encode(encoding="utf-8")
   
   @staticmethod
@@ -77,20 +178,21 @@ class RegistrationStatus(Status):
     rest = bytes[8:]
     args = rest.split('#')
     
-    if len(args) != 2:
+    if len(args) not in { 2, 3 }:
       return None
 
     username = args[0]
     message = args[1]
+    token = args[2] if len(args) == 3 else ''
 
     # print('parsed registration status: ', code, message, username)
-    return RegistrationStatus(code, message, username)
+    return RegistrationStatus(code, message, username, token)
     
-  def print(self):
+  def format(self):
     if self.code == 200:
-      print("[Registration] " + self.username + ": " + self.message)
+      return "[Registration] " + self.username + ": " + self.message
     else:
-      print("[Error code " + str(self.code) + "] " + self.message)
+      return "[Error code " + str(self.code) + "] " + self.message
 
 
 class JoinStatus(Status):
@@ -148,14 +250,14 @@ class JoinStatus(Status):
     # print('parsed join status: ', code, message, room, username, creation)
     return JoinStatus(code, message, room, username, creation)
 
-  def print(self):
+  def format(self):
     if self.code == 200:
       if self.is_creation:
-        print("[Room] " + self.roomName + " " + self.username + " created")
+        return "[Room] " + self.roomName + " " + self.username + " created"
       else:
-        print("[Room] " + self.roomName + " " + self.username + " joined")
+        return "[Room] " + self.roomName + " " + self.username + " joined"
     else:
-      print("[Error code " + str(self.code) + "] " + self.message)
+      return "[Error code " + str(self.code) + "] " + self.message
 
 
 class MessageStatus(Status):
@@ -237,17 +339,17 @@ class MessageStatus(Status):
     else:
       return MessageStatus(code, message, send_to_room, sender, '', name, data)
 
-  def print(self):
+  def format(self):
     if self.to_room:
       if self.code == 200:
-        print("[Room] " + self.room + " " + self.sender + " sent: " + self.data)
+        return "[Room] " + self.room + " " + self.sender + " sent: " + self.data
       else:
-        print("[Error code " + str(self.code) + "] " + self.room + " " + self.message)
+        return "[Error code " + str(self.code) + "] " + self.room + " " + self.message
     else:
       if self.code == 200:
-        print("[Private] " + self.sender + " sent to " + self.username + ": " + self.data)
+        return "[Private] " + self.sender + " sent to " + self.username + ": " + self.data
       else:
-        print("[Error code " + str(self.code) + "] " + self.username + " " + self.message)
+        return "[Error code " + str(self.code) + "] " + self.username + " " + self.message
 
 
 class DisconnectStatus(Status):
@@ -301,14 +403,14 @@ class DisconnectStatus(Status):
       addr = None
     return DisconnectStatus(code, message, name, room, addr)
 
-  def print(self):
+  def format(self):
     if self.code == 200:
       if self.room == '':
-        print("[Disconnection] " + self.username + " disconnected.")
+        return "[Disconnection] " + self.username + " disconnected."
       else:
-        print("[Room] " + self.room + " " + self.username + " disconnected.")
+        return "[Room] " + self.room + " " + self.username + " disconnected."
     else:
-      print("[Error code " + str(self.code) + "] " + self.message)
+      return "[Error code " + str(self.code) + "] " + self.message
 
 
 class LeaveStatus(Status):
@@ -346,11 +448,11 @@ class LeaveStatus(Status):
 
     return LeaveStatus(code, message, room, username)
 
-  def print(self):
+  def format(self):
     if self.code == 200:
-      print("[Room] " + self.room + " " + self.username + " leaved")
+      return "[Room] " + self.room + " " + self.username + " leaved"
     else:
-      print("[Error code " + str(self.code) + "] " + self.message)
+      return "[Error code " + str(self.code) + "] " + self.message
 
 
 class RoomUserListStatus(Status):
@@ -389,13 +491,12 @@ class RoomUserListStatus(Status):
     userlist = set(args[0].split('&'))
     return RoomUserListStatus(code, message, room, userlist)
 
-  def print(self):
+  def format(self):
     if self.code == 200:
-      print("[Room] " + self.room + " " + "\nCurrent joined users:")
-      for user in self.userlist:
-        print(user)
+      return "\n".join(["[Room] " + self.room + " " + "\nCurrent joined users:"]
+        + list(self.userlist))
     else:
-      print("[Error code " + str(self.code) + "] " + self.message )
+      return "[Error code " + str(self.code) + "] " + self.message
 
 
 class ListRoomStatus(Status):
@@ -430,10 +531,214 @@ class ListRoomStatus(Status):
     rooms = set(rest[0].split('&'))
     return ListRoomStatus(code, message, rooms)
 
-  def print(self):
+  def format(self):
+    if self.code == 200:
+      return "\n".join(["[Room] Current room list:"] + list(self.rooms))
+    else:
+      return "[Error code " + str(self.code) + "] " + self.message
+
+
+class ResumeStatus(Status):
+  """ Class for server to send back to client resuming a session. The
+      rooms are the rooms the session is still a member of; dropped is the
+      number of messages that did not fit in the backlog while detached.
+      The backlog itself is sent right after this status.
+  """
+  def __init__(self, code: int, message: str, username: str, rooms: set, dropped: int):
+    super().__init__(code, message)
+    self.username     = username
+    self.rooms        = rooms
+    self.dropped      = dropped
+    self.command_code = '00012'
+
+  def to_bytes(self):
+    return ('$'
+      + str(self.code)
+      + self.command_code
+      + self.username + '#'
+      + '&'.join(self.rooms) + '#'
+      + str(self.dropped) + '#'
+      + self.message
+      + '$').encode(encoding="utf-8")
+
+  @staticmethod
+  def parse(bytes):
+    if len(bytes) < 11:
+      return None
+
+    code = int(bytes[:3])
+    command_code = bytes[3:8]
+    if command_code != '00012':
+      return None
+    args = bytes[8:].split('#')
+    if len(args) != 4:
+      return None
+    rooms = { room for room in args[1].split('&') if room != '' }
+    return ResumeStatus(code, args[3], args[0], rooms, int(args[2]))
+
+  def format(self):
     if self.code == 200:
-      print("[Room] Current room list:")
-      for room in self.rooms:
-        print(room)
+      return ("[Resumed] " + self.username + ": " + str(len(self.rooms)) + " rooms, "
+        + str(self.dropped) + " messages dropped")
+    else:
+      return "[Error code " + str(self.code) + "] " + self.message
+
+
+class HeartbeatStatus(Status):
+  """ PING (00008) or PONG (00009) sent by the server. The server pings a
+      connection that has been silent for a while; a client answers with a
+      pong command echoing data. A ping command from a client is answered
+      with a PONG status.
+  """
+  PING = '00008'
+  PONG = '00009'
+
+  def __init__(self, code: int, message: str, command_code: str, data: str = ''):
+    super().__init__(code, message)
+    self.command_code = command_code
+    self.data         = data
+
+  def to_bytes(self):
+    return ('$'
+      + str(self.code)
+      + self.command_code
+      + self.data + '#'
+      + self.message
+      + '$').encode(encoding="utf-8")
+
+  @staticmethod
+  def parse(bytes):
+    if len(bytes) < 9:
+      return None
+
+    code = int(bytes[:3])
+    command_code = bytes[3:8]
+    if command_code not in { HeartbeatStatus.PING, HeartbeatStatus.PONG }:
+      return None
+    args = bytes[8:].split('#')
+    if len(args) != 2:
+      return None
+    return HeartbeatStatus(code, args[1], command_code, args[0])
+
+  def format(self):
+    kind = "[Ping] " if self.command_code == HeartbeatStatus.PING else "[Pong] "
+    return kind + self.data
+
+
+class PressureStatus(Status):
+  """ Class for server to tell a client what it did to stay under its memory
+      ceiling (error code 507): dropped is the number of the oldest queued
+      messages of the client that were discarded, and evicted is True if
+      the client's session was removed and the connection is being closed.
+  """
+  def __init__(self, code: int, message: str, dropped: int, evicted: bool = False):
+    super().__init__(code, message)
+    self.dropped      = dropped
+    self.evicted      = evicted
+    self.command_code = '00011'
+
+  def to_bytes(self):
+    return ('$'
+      + str(self.code)
+      + self.command_code
+      + str(self.dropped) + '#'
+      + ('1' if self.evicted else '0') + '#'
+      + self.message
+      + '$').encode(encoding="utf-8")
+
+  @staticmethod
+  def parse(bytes):
+    if len(bytes) < 12:
+      return None
+
+    code = int(bytes[:3])
+    command_code = bytes[3:8]
+    if command_code != '00011':
+      return None
+    args = bytes[8:].split('#')
+    if len(args) != 3:
+      return None
+    return PressureStatus(code, args[2], int(args[0]), args[1] == '1')
+
+  def format(self):
+    if self.evicted:
+      return "[Evicted] " + self.message
     else:
-      print("[Error code " + str(self.code) + "] " + self.message)
+      return ("[Error code " + str(self.code) + "] " + self.message + ": "
+        + str(self.dropped) + " messages dropped")
+
+
+class PresenceStatus(Status):
+  """ Digest of the membership changes of a room over one presence tick,
+      sent instead of the individual join, leave and disconnect statuses
+      to members that registered with the 'presence' option. joined and
+      left are the users whose membership changed in the tick; a user that
+      joined and left again within it is in neither. A disconnected user
+      is in left.
+  """
+  def __init__(self, code: int, message: str, room: str, joined: set, left: set):
+    super().__init__(code, message)
+    self.room         = room
+    self.joined       = joined
+    self.left         = left
+    self.command_code = '00013'
+
+  def to_bytes(self):
+    return ('$'
+      + str(self.code)
+      + self.command_code
+      + self.room + '#'
+      + '&'.join(self.joined) + '#'
+      + '&'.join(self.left) + '#'
+      + self.message
+      + '$').encode(encoding="utf-8")
+
+  @staticmethod
+  def parse(bytes):
+    if len(bytes) < 11:
+      return None
+
+    code = int(bytes[:3])
+    command_code = bytes[3:8]
+    if command_code != '00013':
+      return None
+    args = bytes[8:].split('#')
+    if len(args) != 4:
+      return None
+    joined = { user for user in args[1].split('&') if user != '' }
+    left   = { user for user in args[2].split('&') if user != '' }
+    return PresenceStatus(code, args[3], args[0], joined, left)
+
+  def format(self):
+    changes = ["+" + user.strip() for user in sorted(self.joined)]
+    changes += ["-" + user.strip() for user in sorted(self.left)]
+    return "[Presence] " + self.room.strip() + ": " + " ".join(changes)
+
+
+STATUS_CLASSES = {
+  '00001': RegistrationStatus,
+  '00002': JoinStatus,
+  '00003': MessageStatus,
+  '00004': MessageStatus,
+  '00005': LeaveStatus,
+  '00006': RoomUserListStatus,
+  '00007': ListRoomStatus,
+  '00008': HeartbeatStatus,
+  '00009': HeartbeatStatus,
+  '00010': DisconnectStatus,
+  '00011': PressureStatus,
+  '00012': ResumeStatus,
+  '00013': PresenceStatus,
+}
+
+
+def parse_status(msg: str):
+  """ Parse a frame without its '$' delimiters into the Status subclass of
+      its command code. Frames without a known command code, or that the
+      subclass cannot parse, become a plain Status.
+  """
+  if len(msg) >= 8 and msg[3:8] in STATUS_CLASSES:
+    status = STATUS_CLASSES[msg[3:8]].parse(msg)
+    if status != None:
+      return status
+  return Status.parse(msg)
@@ -13,18 +13,15 @@
 #
 # This program assumes that the rooms have been created by running application
 # in order to let running application display messages the "testers" send.
+#
+# This program only exercises the server by hand. To generate real load and
+# measure throughput and delivery latency, use loadtest.py instead.
 
 import socket
-import sys
 import time
 import argparse
 from multiprocessing import Process
-from status import (
-  Status, RegistrationStatus, JoinStatus, MessageStatus, DisconnectStatus,
-  LeaveStatus, RoomUserListStatus, ListRoomStatus)
-from server import RunningSignal
-from clientlib import (
-  EmptyUsernameException, ClientApiArgumentError, Client)
+from clientlib import Client
 from app import CmdExecution
 
 def join_room(client, socket, room):
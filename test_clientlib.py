@@ -0,0 +1,161 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# Unit tests for how AsyncClient in clientlib.py matches the statuses it
+# receives to the futures of the commands in flight. The server side is a
+# StreamReader the tests feed with status frames and a writer that keeps
+# what the client wrote.
+
+import asyncio
+import unittest
+from clientlib import AsyncClient
+from status import (
+  FrameCompressor, Status, RegistrationStatus, JoinStatus, MessageStatus, ListRoomStatus,
+  HeartbeatStatus)
+
+
+def pad(name: str):
+  return name.ljust(20)
+
+
+class FakeWriter:
+  """ The writing half of a connection, keeping every write.
+  """
+  def __init__(self):
+    self.written = bytearray()
+    self.closed  = False
+
+  def write(self, data: bytes):
+    self.written += data
+
+  async def drain(self):
+    pass
+
+  def close(self):
+    self.closed = True
+
+
+class AsyncClientTest(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self):
+    self.reader = asyncio.StreamReader()
+    self.writer = FakeWriter()
+    self.client = AsyncClient(self.reader, self.writer)
+    self.events = []
+    self.client.on_event = self.events.append
+    self.alice, self.bob = pad('alice'), pad('bob')
+    self.first, self.second = pad('first'), pad('second')
+
+  async def asyncTearDown(self):
+    self.reader.feed_eof()
+    await self.client.receiving
+
+  def reply(self, *statuses):
+    for status in statuses:
+      self.reader.feed_data(status.to_bytes())
+
+  async def settle(self):
+    """ Let the receiving task dispatch what has been fed.
+    """
+    for _ in range(5):
+      await asyncio.sleep(0)
+
+  async def register(self):
+    future = self.client.register(self.alice)
+    self.reply(RegistrationStatus(200, "success", self.alice))
+    return await asyncio.wait_for(future, 1)
+
+  async def test_register_sets_username(self):
+    status = await self.register()
+    self.assertEqual((status.code, self.client.username), (200, self.alice))
+    self.assertEqual(bytes(self.writer.written), b'$00001' + self.alice.encode() + b'$')
+
+  async def test_replies_matched_by_room_and_user(self):
+    await self.register()
+    first, second = self.client.join(self.first), self.client.join(self.second)
+    # another user joining one of the rooms is an event, not the reply
+    self.reply(JoinStatus(200, "success", self.second, self.bob))
+    await self.settle()
+    self.assertFalse(first.done() or second.done())
+    self.reply(JoinStatus(200, "success", self.first, self.alice, True),
+               JoinStatus(200, "success", self.second, self.alice))
+    self.assertEqual((await asyncio.wait_for(first, 1)).roomName, self.first)
+    self.assertEqual((await asyncio.wait_for(second, 1)).roomName, self.second)
+    self.assertEqual([status.username for status in self.events], [self.bob])
+    self.assertEqual(self.client.pending, [])
+
+  async def test_plain_error_goes_to_oldest_command_producing_it(self):
+    await self.register()
+    rooms = self.client.list_rooms()
+    join = self.client.join(self.first)
+    self.reply(Status(403, "Invalid room name format"))
+    self.assertEqual((await asyncio.wait_for(join, 1)).code, 403)
+    self.assertFalse(rooms.done())
+    self.reply(ListRoomStatus(200, "success", { self.first }))
+    self.assertEqual((await asyncio.wait_for(rooms, 1)).rooms, { self.first })
+
+  async def test_message_error_is_not_taken_for_a_reply(self):
+    await self.register()
+    self.client.room_message({ self.first }, 'hello')
+    rooms = self.client.list_rooms()
+    self.reply(Status(410, "Room count not matching"))
+    await self.settle()
+    self.assertFalse(rooms.done())
+    self.assertEqual([status.code for status in self.events], [410])
+    self.reply(ListRoomStatus(200, "success", set()))
+    await asyncio.wait_for(rooms, 1)
+    self.assertEqual(self.client.pending, [])
+
+  async def test_echo_retires_message_per_room(self):
+    await self.register()
+    self.client.room_message({ self.first, self.second }, 'hello')
+    for room in (self.first, self.second):
+      self.reply(MessageStatus(200, "success", True, self.alice, room, '', 'hello'))
+      message = await asyncio.wait_for(self.client.__anext__(), 1)
+      self.assertEqual(message.room, room)
+      if room == self.first:
+        self.assertEqual(self.client.pending, [('00003', { self.second }, None)])
+    self.assertEqual(self.client.pending, [])
+
+  async def test_later_reply_retires_earlier_messages(self):
+    await self.register()
+    self.client.private_message({ self.bob }, 'hello')
+    join = self.client.join(self.first)
+    self.client.room_message({ self.first }, 'hello')
+    self.reply(JoinStatus(200, "success", self.first, self.alice, True))
+    await asyncio.wait_for(join, 1)
+    self.assertEqual(self.client.pending, [('00003', { self.first }, None)])
+
+  async def test_ping_answered(self):
+    await self.register()
+    self.writer.written.clear()
+    self.reply(HeartbeatStatus(200, "success", HeartbeatStatus.PING, 'data'))
+    await self.settle()
+    self.assertEqual(bytes(self.writer.written), b'$00009data$')
+    self.assertEqual(self.events, [])
+
+  async def test_closed_connection_fails_pending(self):
+    await self.register()
+    join = self.client.join(self.first)
+    self.reader.feed_eof()
+    with self.assertRaises(ConnectionError):
+      await asyncio.wait_for(join, 1)
+    self.assertTrue(self.client.client.disconnected)
+
+  async def test_deflate_after_registration(self):
+    future = self.client.register(self.alice, { 'deflate' })
+    compressor = FrameCompressor()
+    deflated = compressor.compress(
+      JoinStatus(200, "success", self.first, self.bob, True).to_bytes())
+    # the compressed stream follows the registration reply in the same read
+    self.reader.feed_data(RegistrationStatus(200, "success", self.alice).to_bytes()
+                          + deflated[:3])
+    await asyncio.wait_for(future, 1)
+    join = self.client.join(self.first)
+    self.reader.feed_data(deflated[3:] + compressor.compress(
+      JoinStatus(200, "success", self.first, self.alice).to_bytes()))
+    self.assertEqual((await asyncio.wait_for(join, 1)).username, self.alice)
+    self.assertEqual([status.username for status in self.events], [self.bob])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,309 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# Unit tests for the server's data structures in serverlib.py: flood
+# control, detached sessions, room log cursors, presence digests, and the
+# same sequence of commands giving the same results on Table, ShardedTable
+# and ActorTable.
+
+import itertools
+import threading
+import time
+import unittest
+from serverlib import (
+  TokenBucket, User, RoomLog, PresenceAggregator, Table, ShardedTable, ActorTable)
+from status import Status, JoinStatus, LeaveStatus, PressureStatus, PresenceStatus
+
+
+def pad(name: str):
+  return name.ljust(20)
+
+
+def wait_for(condition, timeout: float = 2.0):
+  """ Poll condition until it is true or timeout seconds have passed.
+      Return the last value of condition.
+  """
+  deadline = time.monotonic() + timeout
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+
+class TokenBucketTest(unittest.TestCase):
+
+  def test_burst_then_limited(self):
+    bucket = TokenBucket(1, 3)
+    for _ in range(3):
+      self.assertEqual(bucket.consume(1), 0)
+    self.assertAlmostEqual(bucket.consume(1), 1.0, delta=0.1)
+    self.assertEqual((bucket.allowed, bucket.limited, bucket.delivered), (3, 1, 3))
+
+  def test_refill_up_to_burst(self):
+    bucket = TokenBucket(2, 3)
+    bucket.consume(3)
+    bucket.time -= 1       # a second has passed
+    self.assertEqual(bucket.consume(2), 0)
+    bucket.time -= 60
+    bucket.consume(0)
+    self.assertAlmostEqual(bucket.tokens, 3, delta=0.1)
+
+  def test_cost_above_burst_leaves_debt(self):
+    bucket = TokenBucket(1, 3)
+    self.assertEqual(bucket.consume(5), 0)
+    self.assertAlmostEqual(bucket.tokens, -2, delta=0.1)
+    # the next message waits until the debt and its own token are paid
+    self.assertAlmostEqual(bucket.consume(1), 3.0, delta=0.1)
+    self.assertEqual(bucket.delivered, 5)
+
+  def test_cost_above_burst_waits_for_full_bucket(self):
+    bucket = TokenBucket(1, 3)
+    bucket.consume(2)
+    self.assertAlmostEqual(bucket.consume(10), 2.0, delta=0.1)
+
+
+class SessionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.table = Table(threading.Lock(), backlog=2)
+    self.alice = pad('alice')
+    self.room  = pad('room')
+    self.table.user_registration(self.alice, None, ('alice', 1))
+    self.table.join_room(self.room, self.alice)
+    self.token = self.table.open_session(self.alice)
+
+  def test_resume_after_detach(self):
+    self.assertEqual(self.table.detach_user(('alice', 1)), (self.token, 1))
+    self.assertFalse(self.table.has_addr(('alice', 1)))
+    status = self.table.resume_session(self.token, None, ('alice', 2))
+    self.assertEqual((status.code, status.username, status.rooms, status.dropped),
+                     (200, self.alice, { self.room }, 0))
+    self.assertEqual(self.table.get_username_by_addr(('alice', 2)), self.alice)
+
+  def test_resume_attached_session(self):
+    self.assertEqual(self.table.resume_session(self.token, None, ('alice', 2)).code, 431)
+
+  def test_resume_unknown_token(self):
+    self.assertEqual(self.table.resume_session('nothing', None, ('alice', 2)).code, 430)
+
+  def test_detach_without_session(self):
+    self.table.user_registration(pad('bob'), None, ('bob', 1))
+    self.assertEqual(self.table.detach_user(('bob', 1)), None)
+
+  def test_detached_queue_keeps_backlog(self):
+    self.table.detach_user(('alice', 1))
+    for i in range(5):
+      self.table.enqueue_message(Status(200, str(i)), [self.alice])
+    status = self.table.resume_session(self.token, None, ('alice', 2))
+    self.assertEqual(status.dropped, 3)
+    messages = self.table.flush_message_queue(('alice', 2))
+    self.assertEqual([msg.message for msg in messages], ['3', '4'])
+
+  def test_expire_after_detach(self):
+    self.table.detach_user(('alice', 1))
+    self.assertEqual(self.table.expire_session(self.token, 1), (self.alice, { self.room }))
+    self.assertFalse(self.table.has_username(self.alice))
+    self.assertEqual(self.table.list_room_users(self.room), set())
+    self.assertEqual(self.table.resume_session(self.token, None, ('alice', 2)).code, 430)
+
+  def test_expire_of_resumed_session(self):
+    self.table.detach_user(('alice', 1))
+    self.table.resume_session(self.token, None, ('alice', 2))
+    self.assertEqual(self.table.expire_session(self.token, 1), (None, None))
+    # a later detach is not expired by the timer of the earlier one
+    self.assertEqual(self.table.detach_user(('alice', 2)), (self.token, 2))
+    self.assertEqual(self.table.expire_session(self.token, 1), (None, None))
+    self.assertTrue(self.table.has_username(self.alice))
+
+
+class RoomLogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stamps = itertools.count()
+    self.user = User(pad('alice'), None, ('alice', 1))
+
+  def test_cursor_starts_at_next_message(self):
+    log = RoomLog(8, self.stamps)
+    log.append(Status(200, 'before'))
+    self.user.follow('room', log)
+    log.append(Status(200, 'after'))
+    self.assertEqual([msg.message for msg in self.user.get_messages()], ['after'])
+    self.assertEqual(self.user.cursors['room'][1], 2)
+    self.assertEqual(self.user.log_lag(), 0)
+
+  def test_rooms_read_in_append_order(self):
+    first, second = RoomLog(8, self.stamps), RoomLog(8, self.stamps)
+    self.user.follow('first', first)
+    self.user.follow('second', second)
+    first.append(Status(200, 'a'))
+    second.append(Status(200, 'b'))
+    first.append(Status(200, 'c'))
+    self.assertEqual(self.user.log_lag(), 2)
+    self.assertEqual([msg.message for msg in self.user.get_messages()], ['a', 'b', 'c'])
+
+  def test_overrun_reports_missed_messages(self):
+    log = RoomLog(2, self.stamps)
+    self.user.follow('room', log)
+    for i in range(5):
+      log.append(Status(200, str(i)))
+    messages = self.user.get_messages()
+    self.assertIsInstance(messages[0], PressureStatus)
+    self.assertEqual((messages[0].code, messages[0].dropped), (507, 3))
+    self.assertEqual([msg.message for msg in messages[1:]], ['3', '4'])
+    self.assertEqual(log.overruns, 3)
+
+  def test_logged_messages_go_before_later_queued_ones(self):
+    log = RoomLog(8, self.stamps)
+    self.user.follow('room', log)
+    log.append(Status(200, 'logged'))
+    self.user.enqueue_message(Status(200, 'queued'))
+    log.append(Status(200, 'logged later'))
+    self.assertEqual([msg.message for msg in self.user.get_messages()],
+                     ['logged', 'queued', 'logged later'])
+
+  def test_append_wakes_reader(self):
+    log = RoomLog(8, self.stamps)
+    self.user.follow('room', log)
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(self.user.get_messages()))
+    reader.start()
+    self.assertTrue(wait_for(lambda: self.user in log.waiting))
+    log.append(Status(200, 'wake'))
+    reader.join(2)
+    self.assertEqual([msg.message for msg in received], ['wake'])
+
+  def test_unfollow_stops_reading(self):
+    log = RoomLog(8, self.stamps)
+    self.user.follow('room', log)
+    self.user.unfollow('room')
+    log.append(Status(200, 'missed'))
+    self.user.enqueue_message(Status(200, 'queued'))
+    self.assertEqual([msg.message for msg in self.user.get_messages()], ['queued'])
+
+
+class PresenceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.room = pad('room')
+    self.alice, self.bob, self.carol = pad('alice'), pad('bob'), pad('carol')
+
+  def test_aggregator_coalesces_tick(self):
+    digests = []
+    delivered = threading.Event()
+    def deliver(roomName, digest):
+      digests.append((roomName, digest))
+      delivered.set()
+    aggregator = PresenceAggregator(0.05, deliver)
+    receivers = [self.alice, self.bob]
+    # bob joins and leaves within the tick, carol joins
+    self.assertEqual(aggregator.divert(
+      self.room, JoinStatus(200, "success", self.room, self.bob), receivers, { self.alice }),
+      [self.bob])
+    aggregator.divert(self.room, LeaveStatus(200, "success", self.room, self.bob),
+                      receivers, { self.alice })
+    aggregator.divert(self.room, JoinStatus(200, "success", self.room, self.carol),
+                      receivers, { self.alice })
+    self.assertTrue(delivered.wait(2))
+    roomName, digest = digests[0]
+    self.assertEqual((roomName, digest.joined, digest.left), (self.room, { self.carol }, set()))
+    self.assertEqual(aggregator.diverted, 3)
+
+  def test_aggregator_without_subscribers(self):
+    aggregator = PresenceAggregator(3600, lambda roomName, digest: None)
+    receivers = [self.alice, self.bob]
+    # the user whose membership changed always gets the status itself
+    self.assertIs(aggregator.divert(
+      self.room, JoinStatus(200, "success", self.room, self.bob), receivers, { self.bob }),
+      receivers)
+    self.assertEqual(aggregator.pending, {})
+
+  def test_table_delivers_digest_to_subscribers(self):
+    table = Table(threading.Lock(), presence_interval=0.05)
+    self.assertTrue(table.has_presence())
+    for username in (self.alice, self.bob):
+      table.user_registration(username, None, (username, 1))
+      table.join_room(self.room, username)
+    table.set_presence(self.alice, True)
+    table.deliver_to_room(self.room, JoinStatus(200, "success", self.room, self.bob),
+                          table.list_room_users(self.room))
+    self.assertIsInstance(table.flush_message_queue((self.bob, 1))[0], JoinStatus)
+    messages = table.flush_message_queue((self.alice, 1))
+    self.assertEqual(len(messages), 1)
+    self.assertIsInstance(messages[0], PresenceStatus)
+    self.assertEqual(messages[0].joined, { self.bob })
+
+  def test_no_digests_in_log_delivery(self):
+    table = Table(threading.Lock(), delivery='log', presence_interval=0.05)
+    self.assertFalse(table.has_presence())
+
+
+def exercise(table):
+  """ Run a sequence of commands through the table and return what they
+      returned, in a form that compares equal between table types.
+  """
+  alice, bob, carol = pad('alice'), pad('bob'), pad('carol')
+  first, second = pad('first'), pad('second')
+  results = []
+  record = results.append
+  record([table.user_registration(name, None, (name, 1)).code
+          for name in (alice, bob, carol)])
+  record(table.user_registration(bob, None, ('other', 1)).code)
+  record(table.user_registration('short', None, ('short', 1)).code)
+  for roomName, username in ((first, alice), (first, bob), (first, bob), (second, alice),
+                             (second, carol), (first, pad('nobody')), ('short', alice)):
+    status = table.join_room(roomName, username)
+    record((status.code, getattr(status, 'is_creation', None)))
+  for roomName, username in ((second, bob), (pad('none'), alice), (first, pad('nobody'))):
+    record(table.leave_room(roomName, username).code)
+  record(table.leave_room(second, carol).code)
+  record(table.list_rooms())
+  record(table.list_room_users(first))
+  record(table.counts())
+  record((table.has_room(first), table.has_room(pad('none')), table.has_username(bob),
+          table.has_addr((bob, 1)), table.get_username_by_addr((bob, 1))))
+
+  table.deliver_to_room(first, Status(200, 'hello'), table.list_room_users(first))
+  record([msg.message for msg in table.flush_message_queue((bob, 1))])
+
+  token = table.open_session(alice)
+  record(table.detach_user((alice, 1)) == (token, 1))
+  status = table.resume_session(token, None, (alice, 2))
+  record((status.code, status.username, status.rooms))
+  record(table.resume_session(token, None, (alice, 3)).code)
+  table.detach_user((alice, 2))
+  record(table.expire_session(token, 1))
+  record(table.expire_session(token, 2))
+  record(table.resume_session(token, None, (alice, 3)).code)
+
+  to_notify, status = table.user_disconnection(bob)
+  record((to_notify, status.code))
+  to_notify, status = table.user_disconnection(bob)
+  record((to_notify, status.code))
+  record((table.clear_user_conn((bob, 1)).code, table.clear_user_conn((bob, 1)).code))
+  table.join_room(first, carol)
+  record(table.evict_user(carol, Status(508, "evicted")))
+  record(table.evict_user(carol, Status(508, "evicted")))
+  record(table.counts())
+  record(table.flood_stats())
+  return results
+
+
+class TableParityTest(unittest.TestCase):
+
+  def test_sharded_table_matches_table(self):
+    expected = exercise(Table(threading.Lock()))
+    self.assertEqual(exercise(ShardedTable(threading.Lock(), shards=4)), expected)
+
+  def test_actor_table_matches_table(self):
+    expected = exercise(Table(threading.Lock()))
+    self.assertEqual(exercise(ActorTable(threading.Lock(), actors=4)), expected)
+
+  def test_log_delivery_matches_table(self):
+    expected = exercise(Table(threading.Lock()))
+    for table in (Table(threading.Lock(), delivery='log'),
+                  ShardedTable(threading.Lock(), delivery='log', shards=4),
+                  ActorTable(threading.Lock(), delivery='log', actors=4)):
+      with self.subTest(table=type(table).__name__):
+        self.assertEqual(exercise(table), expected)
+
+
+if __name__ == '__main__':
+  unittest.main()
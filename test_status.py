@@ -0,0 +1,84 @@
+# Copyright (c) 2020 Yiming Lin <yl6@pdx.edu>
+#
+# Unit tests for the frame decoding of status.py: frames split across reads,
+# '$' delimiters shared by adjacent frames, and the switch to a deflate
+# stream after the registration reply.
+
+import unittest
+from status import FrameDecoder, FrameCompressor, JoinStatus, PresenceStatus, parse_status
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+  def test_frames_split_across_reads(self):
+    decoder = FrameDecoder()
+    decoder.feed(b'$200000')
+    self.assertEqual(list(decoder), [])
+    decoder.feed(b'01alice#success$$20')
+    self.assertEqual(list(decoder), ['20000001alice#success'])
+    decoder.feed(b'000007$')
+    self.assertEqual(list(decoder), ['20000007'])
+    self.assertEqual(decoder.buffer, bytearray())
+
+  def test_adjacent_frames_in_one_read(self):
+    decoder = FrameDecoder()
+    decoder.feed(b'$first$$second$third$')
+    # 'third' is the gap between two frames, not a frame
+    self.assertEqual(list(decoder), ['first', 'second'])
+    self.assertEqual(decoder.buffer, bytearray(b'$'))
+
+  def test_bytes_before_a_frame_are_dropped(self):
+    decoder = FrameDecoder()
+    decoder.feed(b'noise')
+    self.assertEqual(decoder.next_frame(), None)
+    self.assertEqual(decoder.buffer, bytearray())
+    decoder.feed(b'junk$frame$')
+    self.assertEqual(list(decoder), ['frame'])
+
+  def test_multibyte_character_split_across_reads(self):
+    encoded = '$café 漢字$'.encode(encoding="utf-8")
+    decoder = FrameDecoder()
+    for i in range(len(encoded)):
+      decoder.feed(encoded[i:i + 1])
+    self.assertEqual(list(decoder), ['café 漢字'])
+
+  def test_inflate_after_plain_frame(self):
+    compressor = FrameCompressor()
+    deflated = compressor.compress(b'$second$$third$')
+    decoder = FrameDecoder()
+    # the compressed stream arrives in the same read as the plain frame
+    decoder.feed(b'$first$' + deflated[:5])
+    self.assertEqual(decoder.next_frame(), 'first')
+    decoder.start_inflate()
+    self.assertEqual(list(decoder), [])
+    decoder.feed(deflated[5:])
+    self.assertEqual(list(decoder), ['second', 'third'])
+
+  def test_inflate_shares_dictionary_across_batches(self):
+    compressor = FrameCompressor()
+    decoder = FrameDecoder()
+    decoder.start_inflate()
+    frames = []
+    for i in range(3):
+      status = JoinStatus(200, "success", 'room'.ljust(20), ('user' + str(i)).ljust(20))
+      decoder.feed(compressor.compress(status.to_bytes()))
+      frames.extend(decoder)
+    self.assertEqual([parse_status(frame).username for frame in frames],
+                     [('user' + str(i)).ljust(20) for i in range(3)])
+
+
+class ParseStatusTest(unittest.TestCase):
+
+  def test_presence_digest_round_trip(self):
+    digest = PresenceStatus(200, "success", 'room'.ljust(20), { 'a'.ljust(20) }, set())
+    decoder = FrameDecoder()
+    decoder.feed(digest.to_bytes())
+    status = parse_status(decoder.next_frame())
+    self.assertIsInstance(status, PresenceStatus)
+    self.assertEqual(status.room, 'room'.ljust(20))
+    self.assertEqual(status.joined, { 'a'.ljust(20) })
+    self.assertEqual(status.left, set())
+
+
+if __name__ == '__main__':
+  unittest.main()